@@ -36,10 +36,15 @@ class CoAttention(nn.Module):
         :return att_text_features (batch_size, max_seq_len, hidden_dim)
                 att_img_features (batch_size, max_seq_len, hidden_dim)
         """
+        if getattr(self.args, "co_attention_impl", "factorized") == "factorized":
+            return self.factorized_forward(text_features, img_features)
+
+        seq_len = text_features.size(1)  # max_seq_length, or the longest example with dynamic padding
+
         ############### 1. Word-guided visual attention ###############
         # 1.1. Repeat the vectors -> [batch_size, max_seq_len, num_img_region, hidden_dim]
         text_features_rep = text_features.unsqueeze(2).repeat(1, 1, self.args.num_img_region, 1)
-        img_features_rep = img_features.unsqueeze(1).repeat(1, self.args.max_seq_length, 1, 1)
+        img_features_rep = img_features.unsqueeze(1).repeat(1, seq_len, 1, 1)
 
         # 1.2. Feed to single layer (d*k) -> [batch_size, max_seq_len, num_img_region, hidden_dim]
         text_features_rep = self.text_linear_1(text_features_rep)
@@ -57,8 +62,8 @@ class CoAttention(nn.Module):
 
         ############### 2. Visual-guided textual Attention ###############
         # 2.1 Repeat the vectors -> [batch_size, max_seq_len, max_seq_len, hidden_dim]
-        img_features_rep = att_img_features.unsqueeze(2).repeat(1, 1, self.args.max_seq_length, 1)
-        text_features_rep = text_features.unsqueeze(1).repeat(1, self.args.max_seq_length, 1, 1)
+        img_features_rep = att_img_features.unsqueeze(2).repeat(1, 1, seq_len, 1)
+        text_features_rep = text_features.unsqueeze(1).repeat(1, seq_len, 1, 1)
 
         # 2.2 Feed to single layer (d*k) -> [batch_size, max_seq_len, max_seq_len, hidden_dim]
         img_features_rep = self.img_linear_2(img_features_rep)
@@ -77,6 +82,38 @@ class CoAttention(nn.Module):
 
         return att_text_features, att_img_features
 
+    @staticmethod
+    def additive_scores(queries, keys, query_linear, key_linear, att_linear):
+        """
+        att_linear(tanh(cat[query_linear(q), key_linear(k)])) for every (q, k) pair.
+        tanh is element-wise and att_linear is linear, so the score splits into a query term and a key term:
+        each side is projected once and the two are broadcast-added -> [batch_size, num_queries, num_keys]
+        """
+        hidden_dim = query_linear.out_features
+        att_weight = att_linear.weight.squeeze(0)
+        query_scores = torch.matmul(torch.tanh(query_linear(queries)), att_weight[:hidden_dim])
+        key_scores = torch.matmul(torch.tanh(key_linear(keys)), att_weight[hidden_dim:])
+        return query_scores.unsqueeze(2) + key_scores.unsqueeze(1) + att_linear.bias
+
+    def factorized_forward(self, text_features, img_features):
+        """
+        Same attention as the repeat implementation, without materializing the
+        [batch_size, max_seq_len, num_img_region | max_seq_len, hidden_dim] tensors.
+        """
+        # 1. Word-guided visual attention -> [batch_size, max_seq_len, num_img_region]
+        visual_att = self.additive_scores(text_features, img_features,
+                                          self.text_linear_1, self.img_linear_1, self.att_linear_1)
+        visual_att = torch.softmax(visual_att, dim=-1)
+        att_img_features = torch.matmul(visual_att, img_features)  # Vt_hat
+
+        # 2. Visual-guided textual attention -> [batch_size, max_seq_len, max_seq_len]
+        textual_att = self.additive_scores(att_img_features, text_features,
+                                           self.img_linear_2, self.text_linear_2, self.att_linear_2)
+        textual_att = torch.softmax(textual_att, dim=-1)
+        att_text_features = torch.matmul(textual_att, text_features)  # Ht_hat
+
+        return att_text_features, att_img_features
+
 
 class GMF(nn.Module):
     """GMF (Gated Multimodal Fusion)"""
@@ -1,10 +1,18 @@
 from GridFeature.resnet import resnet
 from GridFeature.resnet import *
+import io
+import logging
 import os
+import torch
 from torchvision import transforms
 from PIL import Image
-from utils.utils_metrics import get_entities
+from utils.utils_feature_store import FeatureStore, ImageTable
+from utils.utils_tokenization import convert_with_image_stage, encode_text
 
+logger = logging.getLogger(__name__)
+
+FAIL_IMAGE = '17_06_4705.jpg'
+RESNET_ROOT = "GridFeature/resnet/"
 
 
 class InputExample(object):
@@ -63,13 +71,15 @@ class InputFeatures(object):
 class MMInputFeatures(object):
     """A single set of features of data."""
 
-    def __init__(self, input_ids, input_mask,valid_mask,segment_ids,label_ids,image):
+    def __init__(self, input_ids, input_mask,valid_mask,segment_ids,label_ids,image,img_index=None):
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.valid_mask = valid_mask
         self.segment_ids = segment_ids
         self.label_ids = label_ids
         self.image = image
+        # row of the image in the image table / feature store, replaces image
+        self.img_index = img_index
 
 
 def convert_mm_examples_to_features(examples,
@@ -87,7 +97,10 @@ def convert_mm_examples_to_features(examples,
         pad_token_segment_id=0,
         pad_token_label_id=-100,
         sequence_a_segment_id=0,
-        mask_padding_with_zero=True,crop_size=224
+        mask_padding_with_zero=True,crop_size=224,
+        feature_store=None,
+        image_table=None,
+        text_features=None,
         ):
     """Loads a data file into a list of `InputBatch`s."""
 
@@ -96,130 +109,66 @@ def convert_mm_examples_to_features(examples,
                 - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
                 - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
             `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+            The text is encoded by `utils_tokenization.encode_text`, or taken from `text_features` (its output
+            for the same examples, e.g. read back from the text cache). The features are left unpadded, batches
+            are padded to their longest example by `utils_ner.DynamicPaddingCollator`.
         """
     transform = getTransform(crop_size)
-    label_map = {label: i for i, label in enumerate(label_list)}
-    span_labels = []
-    for label in label_list:
-        label = label.split('-')[-1]
-        if label not in span_labels:
-            span_labels.append(label)
-    span_map = {label: i for i, label in enumerate(span_labels)}
-    features = []
-    for (ex_index, example) in enumerate(examples):
-        try:
-            image_name = example.img_id
-            image_path = os.path.join(path_img, image_name)
-
-            if not os.path.exists(image_path):
-                print(image_path)
+    # Every distinct image is transformed once into `image_table` and the features only keep its row.
+    # Without a table from the caller the images are put back on the features themselves.
+    own_table = image_table is None
+    if own_table and feature_store is None:
+        image_table = ImageTable()
+    failed_rows = set()
+    if text_features is None:
+        text_features = encode_text(examples, label_list, max_seq_length, tokenizer,
+                                    cls_token_at_end=cls_token_at_end,
+                                    cls_token=cls_token,
+                                    cls_token_segment_id=cls_token_segment_id,
+                                    sep_token=sep_token,
+                                    sep_token_extra=sep_token_extra,
+                                    pad_token=pad_token,
+                                    pad_token_segment_id=pad_token_segment_id,
+                                    pad_token_label_id=pad_token_label_id,
+                                    sequence_a_segment_id=sequence_a_segment_id,
+                                    mask_padding_with_zero=mask_padding_with_zero)
+
+    def load_row(img_index):
+        if image_table.values[img_index] is None and img_index not in failed_rows:
             try:
-                image = image_process(image_path, transform)
+                image_table.values[img_index] = {
+                    'image': read_image(path_img, image_table.names[img_index], transform, fail_image=None)}
             except:
-                # print('image has problem!')
-                image_path_fail = os.path.join(path_img, '17_06_4705.jpg')
-                image = image_process(image_path_fail, transform)
-        except:
-            continue
-        tokens = []
-        valid_mask = []
-        for word in example.words:
-            word_tokens = tokenizer.tokenize(word)
-            # bert-base-multilingual-cased sometimes output "nothing ([]) when calling tokenize with just a space.
-            for i, word_token in enumerate(word_tokens):
-                if i == 0:
-                    valid_mask.append(1)
-                else:
-                    valid_mask.append(0)
-                tokens.append(word_token)
-        label_ids = [label_map[label] for label in example.labels]
-        entities = get_entities(example.labels)
-        start_ids = [span_map['O']] * len(label_ids)
-        end_ids = [span_map['O']] * len(label_ids)
-        for entity in entities:
-            start_ids[entity[1]] = span_map[entity[0]]
-            end_ids[entity[-1]] = span_map[entity[0]]
-        # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
-        special_tokens_count = 3 if sep_token_extra else 2
-        if len(tokens) > max_seq_length - special_tokens_count:
-            tokens = tokens[: (max_seq_length - special_tokens_count)]
-            label_ids = label_ids[: (max_seq_length - special_tokens_count)]
-            valid_mask = valid_mask[: (max_seq_length - special_tokens_count)]
-            start_ids = start_ids[: (max_seq_length - special_tokens_count)]
-            end_ids = end_ids[: (max_seq_length - special_tokens_count)]
-
-        tokens += [sep_token]
-        label_ids += [pad_token_label_id]
-        start_ids += [pad_token_label_id]
-        end_ids += [pad_token_label_id]
-        valid_mask.append(1)
-        if sep_token_extra:
-            # roberta uses an extra separator b/w pairs of sentences
-            tokens += [sep_token]
-            label_ids += [pad_token_label_id]
-            start_ids += [pad_token_label_id]
-            end_ids += [pad_token_label_id]
-            valid_mask.append(1)
-        segment_ids = [sequence_a_segment_id] * len(tokens)
-
-        if cls_token_at_end:
-            tokens += [cls_token]
-            label_ids += [pad_token_label_id]
-            start_ids += [pad_token_label_id]
-            end_ids += [pad_token_label_id]
-            segment_ids += [cls_token_segment_id]
-            valid_mask.append(1)
-        else:
-            tokens = [cls_token] + tokens
-            label_ids = [pad_token_label_id] + label_ids
-            start_ids = [pad_token_label_id] + start_ids
-            end_ids = [pad_token_label_id] + end_ids
-            segment_ids = [cls_token_segment_id] + segment_ids
-            valid_mask.insert(0, 1)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
-        if pad_on_left:
-            input_ids = ([pad_token] * padding_length) + input_ids
-            input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
-            segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
-            label_ids = ([pad_token_label_id] * padding_length) + label_ids
-            start_ids = ([pad_token_label_id] * padding_length) + start_ids
-            end_ids = ([pad_token_label_id] * padding_length) + end_ids
-            valid_mask = ([0] * padding_length) + valid_mask
-        else:
-            input_ids += [pad_token] * padding_length
-            input_mask += [0 if mask_padding_with_zero else 1] * padding_length
-            segment_ids += [pad_token_segment_id] * padding_length
-            label_ids += [pad_token_label_id] * padding_length
-            start_ids += [pad_token_label_id] * padding_length
-            end_ids += [pad_token_label_id] * padding_length
-            valid_mask += [0] * padding_length
-        while (len(label_ids) < max_seq_length):
-            label_ids.append(pad_token_label_id)
-            start_ids.append(pad_token_label_id)
-            end_ids.append(pad_token_label_id)
-
-        features.append(
-            MMInputFeatures(input_ids=input_ids,
-                          input_mask=input_mask,
-                          valid_mask=valid_mask,
-                          segment_ids=segment_ids,
-                          label_ids=label_ids,
-                          image=image)
-        )
-    return features
-
-def getTransform(crop_size):
-    transform = transforms.Compose([
-        transforms.RandomCrop(crop_size),  # args.crop_size, by default it is set to be 224
-        transforms.RandomHorizontalFlip(),
+                failed_rows.add(img_index)
+        return image_table.values[img_index]
+
+    def image_stage(ex_index, example):
+        if feature_store is not None:
+            # the grid features were already extracted, only keep the row
+            return dict(image=None, img_index=feature_store.row(example.img_id, FAIL_IMAGE))
+        img_index = image_table.add(path_img, example.img_id, FAIL_IMAGE)
+        if load_row(img_index) is None:
+            # broken file, its examples share the row of FAIL_IMAGE
+            img_index = image_table.fail(img_index, path_img, FAIL_IMAGE)
+            if load_row(img_index) is None:
+                logger.warning("Can not read %s nor %s, skipping the example",
+                               os.path.join(path_img, example.img_id), FAIL_IMAGE)
+                return None
+        if own_table:
+            return dict(image=image_table.values[img_index]['image'], img_index=None)
+        return dict(image=None, img_index=img_index)
+
+    return convert_with_image_stage(examples, text_features, image_stage, MMInputFeatures)
+
+def getTransform(crop_size, train=True):
+    """Random crop and flip of `crop_size` for training the CNN, a center crop when `train` is False."""
+    if train:
+        crops = [transforms.RandomCrop(crop_size),  # args.crop_size, by default it is set to be 224
+                 transforms.RandomHorizontalFlip()]
+    else:
+        # the grid feature store and predictions are computed once, they must not depend on a random draw
+        crops = [transforms.CenterCrop(crop_size)]
+    transform = transforms.Compose(crops + [
         transforms.ToTensor(),
         transforms.Normalize((0.485, 0.456, 0.406),
                              (0.229, 0.224, 0.225))])
@@ -230,3 +179,78 @@ def image_process(image_path, transform):
     image = transform(image)
     return image
 
+
+
+def image_process_bytes(image_bytes, transform):
+    """`image_process` for an encoded image (e.g. the bytes of a jpg file) instead of a path."""
+    image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+    return transform(image)
+
+
+def read_image(path_img, image_name, transform, fail_image=FAIL_IMAGE):
+    """Loads and transforms one image, falling back to `fail_image` when it is broken (raises without one)."""
+    try:
+        return image_process(os.path.join(path_img, image_name), transform)
+    except:
+        # print('image has problem!')
+        if fail_image is None:
+            raise
+        return image_process(os.path.join(path_img, fail_image), transform)
+
+
+def load_grid_encoder(fine_tune_cnn, device, resnet_root=RESNET_ROOT):
+    net = getattr(resnet, 'resnet152')()
+    net.load_state_dict(torch.load(os.path.join(resnet_root, 'resnet152.pth')))
+    return myResnet(net, fine_tune_cnn, device).to(device)
+
+
+def build_grid_feature_store(img_ids, path_img, store_dir, encoder, crop_size=224, batch_size=32,
+                             precision="float32"):
+    """
+    Runs the frozen ResNet-152 once for every distinct image and saves its 2048x7x7 `att` grid under `store_dir`,
+    in `precision` (see `utils_feature_store.PRECISIONS`, int8 per feature channel). Training and evaluation then
+    read the grids instead of running the encoder.
+    """
+    transform = getTransform(crop_size, train=False)
+    image_table = ImageTable()
+    # the row of FAIL_IMAGE must exist before the store is allocated, broken images are moved to it
+    image_table.add(path_img, FAIL_IMAGE)
+    for img_id in sorted(set(img_ids)):
+        image_table.add(path_img, img_id, FAIL_IMAGE)
+    writer = FeatureStore.create(store_dir, image_table.keys, {
+        'att': ((2048, 7, 7), 'float32'),
+    }, aliases=image_table.aliases, precisions={'att': precision}, channel_axes={'att': 0},
+        config={'crop_size': crop_size, 'crop': 'center'})
+    encoder.eval()
+    for start in range(0, len(image_table), batch_size):
+        rows, images = [], []
+        for row in range(start, min(start + batch_size, len(image_table))):
+            try:
+                images.append(read_image(path_img, image_table.names[row], transform, fail_image=None))
+                rows.append(row)
+            except Exception:
+                if image_table.fail(row, path_img, FAIL_IMAGE) == row:
+                    logger.warning("Can not read %s, its row is left zero filled", FAIL_IMAGE)
+                else:
+                    logger.warning("Can not read %s, using the grid of %s", image_table.names[row], FAIL_IMAGE)
+        if not rows:
+            continue
+        with torch.no_grad():
+            _, _, att = encoder(torch.stack(images).to(encoder.device))
+        for i, row in enumerate(rows):
+            writer.write(row, att=att[i])
+    writer.aliases = image_table.aliases
+    writer.close()
+    return FeatureStore(store_dir)
+
+
+def grid_visual_inputs(inputs, encoder, feature_store=None):
+    """Replaces the image of `inputs` by its ResNet grid, from the store when there is one."""
+    if feature_store is not None:
+        # upcast on the device, from the storage precision
+        image_attention = feature_store.get(inputs.pop('img_index'), names=['att'],
+                                            device=inputs['input_ids'].device)['att'].float()
+    else:
+        image_features, image_means, image_attention = encoder(inputs.pop('image'))
+    inputs['visual_embeds_att'] = image_attention.view(-1, 2048, 49).permute(0, 2, 1)  # self.batch_size, 49, 2048
+    return inputs
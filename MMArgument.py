@@ -22,7 +22,11 @@ class ModelArguments:
     tokenizer_name: Optional[str] = field(
         default=None, metadata={"help": "Pretrained tokenizer name or path if not the same as model_name"}
     )
-    use_fast: bool = field(default=False, metadata={"help": "Set this flag to use fast tokenization."})
+    use_fast: bool = field(
+        default=False,
+        metadata={"help": "Set this flag to use fast tokenization, sentences are then encoded in batches during "
+                          "feature conversion."},
+    )
     # If you want to tweak more attributes on your tokenizer, you should do it in a distinct script,
     # or just modify its tokenizer_config.json.
     cache_dir: Optional[str] = field(
@@ -31,6 +35,21 @@ class ModelArguments:
     feature_type: Optional[str] = field(
         default="Object", metadata={"help": "Feature type in NER Experiments (e.g. Object, Grid, Pixel etc)"}
     )
+    co_attention_impl: str = field(
+        default="factorized",
+        metadata={"help": "CoAttention implementation: factorized (projects text and image once) or repeat "
+                          "(builds the repeated 4-D tensors, original implementation)"},
+    )
+    frcnn_model_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Faster R-CNN weights for the Object features, a hub name or a local directory "
+                          "(defaults to $FRCNN_MODEL_PATH or unc-nlp/frcnn-vg-finetuned)"},
+    )
+    crf_normalizer: str = field(
+        default="sequential",
+        metadata={"help": "CRF partition function: sequential (forward algorithm, one timestep at a time) or scan "
+                          "(log-semiring matrix products as a balanced tree). Saved in the model config"},
+    )
 
 @dataclass
 class DataTrainingArguments:
@@ -62,6 +81,115 @@ class DataTrainingArguments:
     task_name: str = field(
         default="twitter2017",metadata={"help": "The task's name, can be twitter2017 or twitter2015"}
     )
+    crop_size: int = field(
+        default=224, metadata={"help": "Size of the crop fed to ResNet-152 for the Grid features: a random crop and "
+                                       "flip when fine tuning the CNN, a center crop for the grid feature store and "
+                                       "predictions"}
+    )
+    image_batch_size: int = field(
+        default=16, metadata={"help": "Number of images decoded and preprocessed together during feature conversion"}
+    )
+    num_image_workers: int = field(
+        default=4, metadata={"help": "Number of threads preprocessing images during feature conversion"}
+    )
+    grid_feature_store: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory of the precomputed ResNet-152 grid features, used when fine_tune_cnn is off. "
+                          "Defaults to <data_dir>/cached_grid_features, it is built on first use."},
+    )
+    grid_feature_fp16: bool = field(
+        default=False, metadata={"help": "Store the precomputed grid features in fp16, same as feature_precision "
+                                         "float16 for the grid features"}
+    )
+    feature_precision: str = field(
+        default="float32",
+        metadata={"help": "Storage precision of the precomputed ROI and grid features: float32, float16, bfloat16 "
+                          "or int8 (quantized per feature channel). They are upcast to float32 on the device."},
+    )
+    object_feature_store: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory of the precomputed Faster R-CNN region features, suffixed with _<precision> "
+                          "unless feature_precision is float32. It is built on first use, afterwards the detector "
+                          "is not run during training. A store built with another precision, detector or data "
+                          "is refused."},
+    )
+    dynamic_padding: bool = field(
+        default=True,
+        metadata={"help": "Pad every batch to its longest example and batch training examples of similar length "
+                          "together, instead of padding everything to max_seq_length"},
+    )
+    conversion_workers: int = field(
+        default=1,
+        metadata={"help": "Number of processes building the feature cache. Above 1 the examples are converted in "
+                          "shards on a process pool, and an interrupted build resumes from the completed shards"},
+    )
+    conversion_shard_size: int = field(
+        default=1000, metadata={"help": "Number of examples per shard when conversion_workers > 1"}
+    )
+    streaming: bool = field(
+        default=False,
+        metadata={"help": "Read and convert the splits chunk by chunk while training instead of building all the "
+                          "features up front, for corpora that do not fit in memory"},
+    )
+    stream_chunk_size: int = field(
+        default=1024, metadata={"help": "Number of examples converted together by the streaming dataset"}
+    )
+    stream_write_through: bool = field(
+        default=False,
+        metadata={"help": "Save every chunk converted by the streaming dataset to the cache and reuse the saved "
+                          "chunks, so an interrupted pass resumes where it stopped"},
+    )
+    predict_file: Optional[str] = field(
+        default=None,
+        metadata={"help": "Sentences tagged with --do_predict, a CoNLL file (tags optional) or a JSONL file with "
+                          "tokens and img_id per line. Defaults to <data_dir>/test.txt"},
+    )
+    predict_output: Optional[str] = field(
+        default=None,
+        metadata={"help": "JSONL file the predictions are appended to, <output_dir>/predictions.jsonl by default. "
+                          "An existing file is resumed after its last complete line"},
+    )
+    predict_chunk_size: int = field(
+        default=256, metadata={"help": "Number of sentences read, tagged and written together by --do_predict"}
+    )
+    predict_offset: Optional[int] = field(
+        default=None,
+        metadata={"help": "Restart --do_predict at this sentence of predict_file instead of after the last line of "
+                          "predict_output"},
+    )
+
+
+@dataclass
+class ServingArguments:
+    """
+    Arguments of the inference server (serve_ner.py), the model is described by the other argument classes.
+    """
+
+    checkpoint_dir: Optional[str] = field(
+        default=None, metadata={"help": "Directory of the trained weights (pytorch_model.bin), output_dir by default"}
+    )
+    host: str = field(default="127.0.0.1", metadata={"help": "Address the HTTP server listens on"})
+    port: int = field(default=8080, metadata={"help": "Port the HTTP server listens on"})
+    unix_socket: Optional[str] = field(
+        default=None, metadata={"help": "Listen on this Unix socket instead of host:port"}
+    )
+    max_batch_size: int = field(
+        default=16, metadata={"help": "Maximum number of concurrent requests tagged together in one micro-batch"}
+    )
+    max_wait_ms: float = field(
+        default=10.0,
+        metadata={"help": "How long the first request of a micro-batch waits for others to join it"},
+    )
+    max_queue_size: int = field(
+        default=256,
+        metadata={"help": "Requests allowed to wait for a micro-batch, the next ones get a 503 (0: no bound)"},
+    )
+    model_timeout_s: float = field(
+        default=30.0,
+        metadata={"help": "Time budget of the model for one request, queueing included. A request not answered "
+                          "within max_wait_ms plus this budget gets a 504"},
+    )
+
 
 #
 #Merging all the arguments of the Three arguments
@@ -70,4 +198,4 @@ class MMArgument(ModelArguments,DataTrainingArguments,TrainingArguments):
     def __init__(self,*iterables):
         for ArgumentClass in iterables:
             for name,value in vars(ArgumentClass).items():
-                setattr(self,"name",value)
\ No newline at end of file
+                setattr(self,name,value)
\ No newline at end of file
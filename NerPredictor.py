@@ -0,0 +1,253 @@
+import inspect
+import itertools
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import WEIGHTS_NAME, AutoConfig, AutoTokenizer
+
+from bert_ner import AutoModelForNER
+from utils.utils_metrics import get_entities_bio
+from utils.utils_ner import InputExample, MMNerTask, preprocess_words
+from utils.utils_tokenization import TEXT_FIELDS, encode_text
+
+logger = logging.getLogger(__name__)
+
+'''
+tags raw (tokens, image) pairs with a trained model, outside of the CoNLL splits; the model, the tokenizer and the
+visual encoder are loaded once. Used by the inference server (serve_ner.py) and the predict mode of the run scripts
+'''
+
+
+class NerPredictor:
+    def __init__(self, args, model, tokenizer, labels, path_image=None):
+        self.args = args
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.labels = labels
+        self.device = args.device
+        self.max_seq_length = args.max_seq_length
+        self.feature_type = args.feature_type
+        # images that are missing or cannot be decoded are replaced by FAIL_IMAGE, as in the datasets
+        self.path_image = path_image
+        self.accepts_visual_pos = "visual_pos" in inspect.signature(self.model.forward).parameters
+        if self.feature_type == 'Object':
+            import ObjectFeatureExtractor
+            if getattr(args, "frcnn_model_path", None):
+                ObjectFeatureExtractor.FRCNN_MODEL_PATH = args.frcnn_model_path
+            self.encoder_cfg = ObjectFeatureExtractor.get_frcnn_cfg()
+            self.encoder = ObjectFeatureExtractor.get_frcnn()
+            self.image_preprocessor = ObjectFeatureExtractor.get_image_preprocessor()
+        elif self.feature_type == 'Grid':
+            import GridFeatureExtractor
+            self.encoder = GridFeatureExtractor.load_grid_encoder(False, self.device).eval()
+            self.transform = GridFeatureExtractor.getTransform(args.crop_size, train=False)
+        else:
+            raise ValueError("no visual encoder for the feature type {}".format(self.feature_type))
+
+    @classmethod
+    def from_args(cls, args, checkpoint_dir=None, path_image=None):
+        """Builds the model like the run scripts do, with the trained weights of `checkpoint_dir` (output_dir)."""
+        labels = MMNerTask().get_labels(args.labels)
+        config = AutoConfig.from_pretrained(
+            args.config_name if args.config_name else args.model_name_or_path,
+            num_labels=len(labels),
+            id2label={i: label for i, label in enumerate(labels)},
+            label2id={label: i for i, label in enumerate(labels)},
+            cache_dir=args.cache_dir,
+            crf_normalizer=args.crf_normalizer,
+        )
+        tokenizer = AutoTokenizer.from_pretrained(
+            args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
+            cache_dir=args.cache_dir,
+            use_fast=args.use_fast,
+        )
+        model = AutoModelForNER.from_pretrained(args.model_name_or_path, args, config=config)
+        load_trained_weights(model, checkpoint_dir or args.output_dir)
+        model.to(args.device)
+        return cls(args, model, tokenizer, labels, path_image=path_image)
+
+    def _fallback_image(self):
+        assert self.path_image is not None, "the image is missing or broken and there is no path_image"
+        if self.feature_type == 'Object':
+            import ObjectFeatureExtractor
+            return ObjectFeatureExtractor.read_image(self.path_image, ObjectFeatureExtractor.FAIL_IMAGE)
+        import GridFeatureExtractor
+        return GridFeatureExtractor.read_image(self.path_image, GridFeatureExtractor.FAIL_IMAGE, self.transform)
+
+    def read_image_bytes(self, img_id: Optional[str]) -> Optional[bytes]:
+        if img_id is None or self.path_image is None:
+            return None
+        try:
+            with open(os.path.join(self.path_image, img_id), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def decode_image(self, image_bytes: Optional[bytes]):
+        try:
+            assert image_bytes, "no image"
+            if self.feature_type == 'Object':
+                import ObjectFeatureExtractor
+                return ObjectFeatureExtractor.decode_image_bytes(image_bytes)
+            import GridFeatureExtractor
+            return GridFeatureExtractor.image_process_bytes(image_bytes, self.transform)
+        except Exception:
+            return self._fallback_image()
+
+    def visual_inputs(self, images) -> dict:
+        """Runs the visual encoder once over the decoded images of a batch."""
+        if self.feature_type == 'Object':
+            images, sizes, scales_yx = self.image_preprocessor(list(images))
+            output_dict = self.encoder(
+                images,
+                sizes,
+                scales_yx=scales_yx,
+                padding="max_detections",
+                max_detections=self.encoder_cfg.max_detections,
+                return_tensors='pt'
+            )
+            return {"visual_feats": output_dict["roi_features"].to(self.device),
+                    "visual_pos": output_dict["normalized_boxes"].to(self.device)}
+        _, _, image_attention = self.encoder(torch.stack(list(images)).to(self.device))
+        return {"visual_feats": image_attention.view(-1, 2048, 49).permute(0, 2, 1)}
+
+    @torch.no_grad()
+    def tag_ids(self, text, visual):
+        """Label ids of the valid (compacted) positions, -1 where there is none."""
+        max_len = int(text["seq_length"].max())
+        tensors = {name: torch.from_numpy(text[name][:, :max_len]).to(self.device) for name in TEXT_FIELDS}
+        inputs = {
+            "input_ids": tensors["input_ids"],
+            "attention_mask": tensors["input_mask"],
+            "valid_mask": tensors["valid_mask"],
+            "token_type_ids": tensors["segment_ids"],
+            "visual_feats": visual["visual_feats"],
+        }
+        if self.accepts_visual_pos and "visual_pos" in visual:
+            inputs["visual_pos"] = visual["visual_pos"]
+        if hasattr(self.model, "crf"):
+            tags = self.model(**inputs, decode=True)[0]
+        else:
+            tags = self.model(**inputs)[0].argmax(-1)
+        return tags.cpu().numpy()
+
+    def predict(self, batch: Sequence[Tuple[List[str], Optional[bytes]]]) -> List[dict]:
+        """
+        Tags a batch of (tokens, encoded image) pairs in one forward pass.
+        Returns, per pair, the BIO tag of every token and the entity spans, with inclusive token offsets.
+        """
+        return self.predict_decoded([(tokens, self.decode_image(image_bytes)) for tokens, image_bytes in batch])
+
+    def predict_decoded(self, batch) -> List[dict]:
+        """`predict` for already decoded images."""
+        if not batch:
+            return []
+        examples = [InputExample(guid=str(i), words=preprocess_words(tokens), labels=["O"] * len(tokens), img_id="")
+                    for i, (tokens, _) in enumerate(batch)]
+        text = encode_text(examples, self.labels, self.max_seq_length, self.tokenizer)
+        tags = self.tag_ids(text, self.visual_inputs(image for _, image in batch))
+        results = []
+        for row, (tokens, _) in enumerate(batch):
+            # valid positions are [CLS], the first sub-token of every word that was not truncated, then [SEP]
+            num_words = min(int(text["valid_mask"][row].sum()) - 2, len(tokens))
+            word_tags = [self.labels[i] if i >= 0 else "O" for i in tags[row, 1:1 + num_words]]
+            word_tags += ["O"] * (len(tokens) - len(word_tags))
+            entities = sorted(get_entities_bio(word_tags), key=lambda entity: entity[1])
+            results.append({
+                "tags": word_tags,
+                "entities": [{"type": type_, "start": start, "end": end, "text": " ".join(tokens[start:end + 1])}
+                             for type_, start, end in entities],
+            })
+        return results
+
+    def predict_file(self, input_path, output_path, chunk_size=256, batch_size=32, offset=None,
+                     num_image_workers=4) -> int:
+        """
+        Tags every sentence of `input_path` (see `iter_predict_records`) and appends one JSON line per sentence to
+        `output_path`. The input is read `chunk_size` sentences at a time and the output is flushed after every
+        chunk, the images are read `batch_size` at a time, so memory does not grow with the input.
+
+        Every line carries the `index` of its sentence in the input. An existing output is resumed after its last
+        complete line, or at sentence `offset` when given. Returns the number of sentences tagged.
+        """
+        start = resume_offset(output_path, offset)
+        if start:
+            logger.info("Resuming the predictions of %s at sentence %d", input_path, start)
+        records = itertools.islice(iter_predict_records(input_path), start, None)
+        index = start
+        with open(output_path, "a", encoding="utf-8") as output, ThreadPoolExecutor(num_image_workers) as pool:
+            while True:
+                chunk = list(itertools.islice(records, chunk_size))
+                if not chunk:
+                    break
+                results = []
+                for batch_start in range(0, len(chunk), batch_size):
+                    batch = chunk[batch_start: batch_start + batch_size]
+                    images = pool.map(lambda record: self.decode_image(self.read_image_bytes(record["img_id"])), batch)
+                    results += self.predict_decoded([(record["tokens"], image) for record, image in zip(batch, images)])
+                for record, result in zip(chunk, results):
+                    output.write(json.dumps(dict(index=index, tokens=record["tokens"], img_id=record["img_id"],
+                                                 **result)) + "\n")
+                    index += 1
+                output.flush()
+                os.fsync(output.fileno())
+                logger.info("Tagged %d sentences of %s", index, input_path)
+        return index - start
+
+
+def load_trained_weights(model, checkpoint_dir):
+    """Loads the weights saved by the run scripts (save_pretrained into output_dir), when there are some."""
+    weights = os.path.join(checkpoint_dir, WEIGHTS_NAME)
+    if os.path.isfile(weights):
+        logger.info("Loading the trained weights from %s", weights)
+        model.load_state_dict(torch.load(weights, map_location="cpu"))
+    else:
+        logger.warning("No trained weights in %s, the model is not fine-tuned", weights)
+    return model
+
+
+def iter_predict_records(path) -> Iterator[dict]:
+    """
+    Sentences to tag, one {"tokens", "img_id"} dict at a time: from a JSONL file with the same keys per line, or
+    from a CoNLL file like the splits (IMGID lines, one word per line, the tags are optional and ignored).
+    """
+    if path.endswith(".jsonl") or path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield {"tokens": record["tokens"], "img_id": record.get("img_id")}
+    else:
+        for sentence in MMNerTask.iter_sentences_from_path(path, unlabeled=True):
+            yield {"tokens": sentence[0], "img_id": sentence[2] if len(sentence) > 2 else None}
+
+
+def resume_offset(output_path, offset=None) -> int:
+    """
+    Sentence to restart a prediction output from: after its last complete line, or `offset` when given. The lines
+    of the restarted sentences and a torn last line (an interrupted write) are cut off the output. An `offset` after
+    the last prediction of an existing output raises a ValueError, the sentences in between would be missing.
+    """
+    if not os.path.exists(output_path):
+        return offset or 0
+    next_index, position, size = 0, 0, os.path.getsize(output_path)
+    with open(output_path, "rb+") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            index = json.loads(line)["index"]
+            if offset is not None and index >= offset:
+                break
+            next_index, position = index + 1, position + len(line)
+        if offset is not None and position and offset > next_index:
+            raise ValueError("{} ends at sentence {}, restarting it at {} would leave out the sentences in "
+                             "between".format(output_path, next_index, offset))
+        if position < size:
+            logger.warning("Cutting %d bytes (restarted sentences or a torn line) off %s", size - position,
+                           output_path)
+            f.truncate(position)
+    return offset if offset is not None else next_index
@@ -1,10 +1,17 @@
 import getopt
+import glob
+import itertools
 import json
+import multiprocessing
 import os
+import queue
+import shutil
 
 # import numpy as np
 import sys
+import threading
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import datasets
 import numpy as np
@@ -12,12 +19,19 @@ import torch
 
 from modeling_frcnn import GeneralizedRCNN
 from processing_image import Preprocess
-from utils import Config
+from utils import Config, img_tensorize
 
 
 """
 USAGE:
-``python extracting_data.py -i <img_dir> -o <dataset_file>.datasets <batch_size>``
+``python extracting_data.py -i <img_dir> -o <dataset_file>.datasets -b <batch_size> [-w <num_workers>]
+[-c <chunk_size>] [-t <decode_threads>]``
+
+Every worker process writes its own checkpoint chunks of `chunk_size` images next to the output
+(``<dataset_file>.chunks/``); an interrupted job run again with the same arguments skips the images already in
+the output or in a chunk. The chunks are merged into the output at the end.
+Images are keyed by their file name without the extension (`img_id`). The images that cannot be decoded are
+listed in ``<dataset_file>.failed`` and skipped by the next runs, delete that file to retry them.
 """
 
 
@@ -29,7 +43,7 @@ DEFAULT_SCHEMA = datasets.Features(
             "attr_ids": datasets.Sequence(length=CONFIG.MAX_DETECTIONS, feature=datasets.Value("float32")),
             "attr_probs": datasets.Sequence(length=CONFIG.MAX_DETECTIONS, feature=datasets.Value("float32")),
             "boxes": datasets.Array2D((CONFIG.MAX_DETECTIONS, 4), dtype="float32"),
-            "img_id": datasets.Value("int32"),
+            "img_id": datasets.Value("string"),
             "obj_ids": datasets.Sequence(length=CONFIG.MAX_DETECTIONS, feature=datasets.Value("float32")),
             "obj_probs": datasets.Sequence(length=CONFIG.MAX_DETECTIONS, feature=datasets.Value("float32")),
             "roi_features": datasets.Array2D((CONFIG.MAX_DETECTIONS, 2048), dtype="float32"),
@@ -46,7 +60,14 @@ class Extract:
         outputfile = None
         subset_list = None
         batch_size = 1
-        opts, args = getopt.getopt(argv, "i:o:b:s", ["inputdir=", "outfile=", "batch_size=", "subset_list="])
+        num_workers = 1
+        chunk_size = 1024
+        decode_threads = 4
+        opts, args = getopt.getopt(
+            argv,
+            "i:o:b:s:w:c:t:",
+            ["inputdir=", "outfile=", "batch_size=", "subset_list=", "num_workers=", "chunk_size=", "decode_threads="],
+        )
         for opt, arg in opts:
             if opt in ("-i", "--inputdir"):
                 inputdir = arg
@@ -56,52 +77,126 @@ class Extract:
                 batch_size = int(arg)
             elif opt in ("-s", "--subset_list"):
                 subset_list = arg
+            elif opt in ("-w", "--num_workers"):
+                num_workers = int(arg)
+            elif opt in ("-c", "--chunk_size"):
+                chunk_size = int(arg)
+            elif opt in ("-t", "--decode_threads"):
+                decode_threads = int(arg)
 
         assert inputdir is not None  # and os.path.isdir(inputdir), f"{inputdir}"
-        assert outputfile is not None and not os.path.isfile(outputfile), f"{outputfile}"
+        assert outputfile is not None, "specify the output file with -o"
+        self.argv = argv
+        self.inputdir = os.path.realpath(inputdir)
+        self.outputfile = os.path.realpath(outputfile)
+        self.chunk_dir = self.outputfile + ".chunks"
+        self.failed_file = self.outputfile + ".failed"
         if subset_list is not None:
             with open(os.path.realpath(subset_list)) as f:
-                self.subset_list = set(map(lambda x: self._vqa_file_split()[0], tryload(f)))
+                self.subset_list = set(map(lambda x: self._vqa_file_split(x)[0], tryload(f)))
         else:
             self.subset_list = None
 
         self.config = CONFIG
         if torch.cuda.is_available():
             self.config.model.device = "cuda"
-        self.inputdir = os.path.realpath(inputdir)
-        self.outputfile = os.path.realpath(outputfile)
-        self.preprocess = Preprocess(self.config)
-        self.model = GeneralizedRCNN.from_pretrained("unc-nlp/frcnn-vg-finetuned", config=self.config)
         self.batch = batch_size if batch_size != 0 else 1
+        self.num_workers = max(num_workers, 1)
+        self.chunk_size = max(chunk_size, self.batch)
+        self.decode_threads = max(decode_threads, 1)
         self.schema = DEFAULT_SCHEMA
+        # loaded on first use, the parent of the worker processes never needs them
+        self._preprocess = None
+        self._model = None
+
+    @property
+    def preprocess(self):
+        if self._preprocess is None:
+            self._preprocess = Preprocess(self.config)
+        return self._preprocess
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = GeneralizedRCNN.from_pretrained("unc-nlp/frcnn-vg-finetuned", config=self.config)
+        return self._model
 
     def _vqa_file_split(self, file):
-        img_id = int(file.split(".")[0].split("_")[-1])
+        # the whole stem, twitter images such as 17_06_4705.jpg and 17_05_4705.jpg share their last number
+        img_id = os.path.splitext(os.path.basename(file.strip()))[0]
         filepath = os.path.join(self.inputdir, file)
         return (img_id, filepath)
 
-    @property
-    def file_generator(self):
-        batch = []
-        for i, file in enumerate(os.listdir(self.inputdir)):
-            if self.subset_list is not None and i not in self.subset_list:
+    def files(self):
+        """(img_id, filepath) of every image of the input directory that is not extracted yet, in a fixed order."""
+        done = self.done_img_ids()
+        failed = self.failed_img_ids()
+        files = []
+        for file in sorted(os.listdir(self.inputdir)):
+            img_id, filepath = self._vqa_file_split(file)
+            if self.subset_list is not None and img_id not in self.subset_list:
                 continue
-            batch.append(self._vqa_file_split(file))
+            if img_id not in done and img_id not in failed:
+                files.append((img_id, filepath))
+        if done or failed:
+            print(f"Resuming: {len(done)} image(s) already extracted, {len(failed)} failed before "
+                  f"(listed in {self.failed_file}), {len(files)} left")
+        return files
+
+    def file_generator(self, files):
+        batch = []
+        for file in files:
+            batch.append(file)
             if len(batch) == self.batch:
                 temp = batch
                 batch = []
                 yield list(map(list, zip(*temp)))
-
-        for i in range(1):
+        if batch:
             yield list(map(list, zip(*batch)))
 
-    def __call__(self):
-        # make writer
-        if not TEST:
-            writer = datasets.ArrowWriter(features=self.schema, path=self.outputfile)
-        # do file generator
-        for i, (img_ids, filepaths) in enumerate(self.file_generator):
-            images, sizes, scales_yx = self.preprocess(filepaths)
+    def batch_generator(self, files, prefetch=2):
+        """
+        Producer side of the extraction: the images are decoded on `decode_threads` threads and the next batches
+        are preprocessed in a background thread while the detector runs on the current one. Images that cannot
+        be decoded are skipped and recorded as failed.
+        """
+        batches = queue.Queue(maxsize=prefetch)
+
+        def decode(img_id, filepath):
+            try:
+                return torch.as_tensor(img_tensorize(filepath, input_format=self.preprocess.input_format))
+            except Exception as e:
+                print(f"Skipping {filepath}: {e}")
+                self._record_failed(img_id, filepath, e)
+                return None
+
+        def produce():
+            try:
+                with ThreadPoolExecutor(self.decode_threads) as pool:
+                    for img_ids, filepaths in self.file_generator(files):
+                        decoded = [(img_id, image) for img_id, image in zip(img_ids, pool.map(decode, img_ids, filepaths))
+                                   if image is not None]
+                        if decoded:
+                            img_ids, images = map(list, zip(*decoded))
+                            batches.put((img_ids, self.preprocess(images)))
+                batches.put(None)
+            except BaseException as e:
+                batches.put(e)
+
+        threading.Thread(target=produce, daemon=True).start()
+        while True:
+            item = batches.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def extract(self, files, worker=0):
+        """Consumer side: runs the detector batch by batch and checkpoints every `chunk_size` images."""
+        chunk, chunk_images = [], 0
+        chunk_index = self._next_chunk_index(worker)
+        for i, (img_ids, (images, sizes, scales_yx)) in enumerate(self.batch_generator(files)):
             output_dict = self.model(
                 images,
                 sizes,
@@ -113,16 +208,89 @@ class Extract:
                 location="cpu",
             )
             output_dict["boxes"] = output_dict.pop("normalized_boxes")
-            if not TEST:
-                output_dict["img_id"] = np.array(img_ids)
-                batch = self.schema.encode_batch(output_dict)
-                writer.write_batch(batch)
             if TEST:
                 break
-            # finalizer the writer
+            output_dict["img_id"] = np.array(img_ids)
+            chunk.append(self.schema.encode_batch(output_dict))
+            chunk_images += len(img_ids)
+            if chunk_images >= self.chunk_size:
+                self._write_chunk(chunk, worker, chunk_index)
+                chunk, chunk_images = [], 0
+                chunk_index += 1
+        if chunk:
+            self._write_chunk(chunk, worker, chunk_index)
+
+    def _chunk_paths(self, worker="*"):
+        return sorted(glob.glob(os.path.join(self.chunk_dir, f"chunk_{worker}_*.arrow")))
+
+    def _next_chunk_index(self, worker):
+        indices = [int(os.path.basename(path)[:-len(".arrow")].split("_")[-1]) for path in self._chunk_paths(worker)]
+        return max(indices) + 1 if indices else 0
+
+    def _write_chunk(self, batches, worker, chunk_index):
+        # renamed into place once complete, an interrupted chunk is extracted again on resume
+        path = os.path.join(self.chunk_dir, f"chunk_{worker}_{chunk_index:06d}.arrow")
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        writer = datasets.ArrowWriter(features=self.schema, path=path + ".tmp")
+        for batch in batches:
+            writer.write_batch(batch)
+        writer.finalize()
+        os.replace(path + ".tmp", path)
+
+    def _record_failed(self, img_id, filepath, error):
+        # one short line per append, the decode threads and the workers share the file
+        with open(self.failed_file, "a") as f:
+            f.write("{}\t{}\t{}\n".format(img_id, filepath, str(error).replace("\n", " ")[:200]))
+
+    def failed_img_ids(self):
+        if not os.path.isfile(self.failed_file):
+            return set()
+        with open(self.failed_file) as f:
+            return {line.split("\t")[0] for line in f if line.strip()}
+
+    def done_img_ids(self):
+        paths = ([self.outputfile] if os.path.isfile(self.outputfile) else []) + self._chunk_paths()
+        return set(itertools.chain.from_iterable(datasets.Dataset.from_file(path)["img_id"] for path in paths))
+
+    def merge(self):
+        """Appends the checkpoint chunks of all workers to the output file and removes them."""
+        chunks = self._chunk_paths()
+        if not chunks:
+            return
+        paths = ([self.outputfile] if os.path.isfile(self.outputfile) else []) + chunks
+        writer = datasets.ArrowWriter(features=self.schema, path=self.outputfile + ".tmp")
+        for path in paths:
+            writer.write_table(datasets.Dataset.from_file(path).data.table)
+        num_examples, num_bytes = writer.finalize()
+        os.replace(self.outputfile + ".tmp", self.outputfile)
+        shutil.rmtree(self.chunk_dir)
+        print(f"Success! You wrote {num_examples} entry(s) and {num_bytes >> 20} mb")
+
+    def __call__(self):
+        files = self.files()
+        if self.num_workers == 1 or TEST:
+            self.extract(files)
+        else:
+            # every worker extracts an interleaved shard of the remaining images into its own chunks
+            context = multiprocessing.get_context("spawn")
+            workers = [
+                context.Process(target=_extract_worker, args=(self.argv, worker, files[worker:: self.num_workers]))
+                for worker in range(self.num_workers)
+            ]
+            for process in workers:
+                process.start()
+            for process in workers:
+                process.join()
+            failed = [worker for worker, process in enumerate(workers) if process.exitcode != 0]
+            assert not failed, f"worker(s) {failed} failed, run again to resume"
         if not TEST:
-            num_examples, num_bytes = writer.finalize()
-            print(f"Success! You wrote {num_examples} entry(s) and {num_bytes >> 20} mb")
+            self.merge()
+
+
+def _extract_worker(argv, worker, files):
+    extract = Extract(argv)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // extract.num_workers))
+    extract.extract(files, worker)
 
 
 def tryload(stream):
@@ -113,6 +113,50 @@ def pad_list_tensors(
         return list_tensors
 
 
+def pad_detections(
+    detections,
+    image_index,
+    rank,
+    num_images,
+    max_detections=None,
+    return_tensors=None,
+    padding=None,
+    pad_value=0,
+    location=None,
+):
+    """
+    `pad_list_tensors` for all fields of `ROIOutputs.batched_inference` at once: the concatenated detections of
+    the batch are scattered into (num_images, max_detections, ...) tensors filled with `pad_value`.
+    """
+    if location is None:
+        location = "cpu"
+    assert return_tensors in {"pt", "np", None}
+    assert padding in {"max_detections", "max_batch", None}
+    preds_per_image = torch.bincount(image_index, minlength=num_images).tolist()
+    if padding is None:
+        return OrderedDict(
+            (name, pad_list_tensors(list(tensor.split(preds_per_image, dim=0)), preds_per_image,
+                                    return_tensors=return_tensors, location=location))
+            for name, tensor in detections.items()
+        )
+    if padding == "max_detections":
+        assert max_detections is not None, "specify max number of detections per batch"
+    elif padding == "max_batch":
+        max_detections = max(preds_per_image)
+    padded = OrderedDict()
+    for name, tensor in detections.items():
+        new = tensor.new_full((num_images, max_detections) + tuple(tensor.shape[1:]), pad_value)
+        new[image_index, rank] = tensor
+        if location == "cpu":
+            new = new.cpu()
+        if return_tensors == "np":
+            new = new.numpy()
+        elif return_tensors is None:
+            new = new.tolist()
+        padded[name] = new
+    return padded
+
+
 def do_nms(boxes, scores, image_shape, score_thresh, nms_thresh, mind, maxd):
     scores = scores[:, :-1]
     num_bbox_reg_classes = boxes.shape[1] // 4
@@ -139,6 +183,52 @@ def do_nms(boxes, scores, image_shape, score_thresh, nms_thresh, mind, maxd):
         return None
 
 
+def batched_do_nms(boxes, scores, image_index, image_shapes, num_images, nms_thresh, mind, maxd):
+    """
+    `do_nms` for the concatenated rows of a whole batch of images, `image_index` gives the image of every row.
+    NMS runs once per threshold for all images (per image, through the image index as category); an image
+    with fewer than `mind` boxes is retried with the next threshold, the last threshold is kept in any case.
+
+    Returns the kept rows grouped by image, by decreasing score within an image, with their image, their rank
+    within the image (< `maxd`) and their boxes, scores and classes.
+    """
+    scores = scores[:, :-1]
+    num_bbox_reg_classes = boxes.shape[1] // 4
+    assert torch.isfinite(boxes).all(), "Box tensor contains infinite or NaN!"
+    boxes = boxes.reshape(-1, num_bbox_reg_classes, 2, 2)  # R x C x 2 corners x (x, y)
+    # clip every row to the size of its image
+    max_xy = image_shapes.to(boxes)[image_index].flip(-1).view(-1, 1, 1, 2)
+    boxes = torch.min(boxes.clamp(min=0), max_xy).view(-1, num_bbox_reg_classes, 4)
+
+    # Select max scores
+    max_scores, max_classes = scores.max(1)  # R x C --> R
+    max_boxes = boxes[torch.arange(boxes.size(0), device=boxes.device), max_classes]
+
+    selected = []
+    pending = torch.ones(num_images, dtype=torch.bool, device=boxes.device)
+    for i, nms_t in enumerate(nms_thresh):
+        rows = pending[image_index].nonzero().squeeze(1)
+        keep = rows[batched_nms(max_boxes[rows], max_scores[rows], image_index[rows], nms_t)]
+        # batched_nms sorts by score over all images, group by image and keep the score order within one
+        keep_image = image_index[keep]
+        keep = keep[torch.argsort(keep_image * keep.numel() + torch.arange(keep.numel(), device=keep.device))]
+        keep_image = image_index[keep]
+        counts = torch.bincount(keep_image, minlength=num_images)
+        rank = torch.arange(keep.numel(), device=keep.device) - (torch.cumsum(counts, 0) - counts)[keep_image]
+        within = rank < maxd
+        keep, keep_image, rank, counts = keep[within], keep_image[within], rank[within], counts.clamp(max=maxd)
+        done = pending & (counts >= mind) if i < len(nms_thresh) - 1 else pending
+        accepted = done[keep_image]
+        selected.append((keep[accepted], keep_image[accepted], rank[accepted]))
+        pending &= ~done
+        if not pending.any():
+            break
+    keep, keep_image, rank = (torch.cat(parts) for parts in zip(*selected))
+    order = torch.argsort(keep_image * maxd + rank)
+    keep, keep_image, rank = keep[order], keep_image[order], rank[order]
+    return keep, keep_image, rank, max_boxes[keep], max_scores[keep], max_classes[keep]
+
+
 # Helper Functions
 def _clip_box(tensor, box_size: Tuple[int, int]):
     assert torch.isfinite(tensor).all(), "Box tensor contains infinite or NaN!"
@@ -1148,26 +1238,87 @@ class ROIOutputs(object):
             nms_thresh = [nms_thresh]
         self.nms_thresh = nms_thresh
 
-    def _predict_boxes(self, proposals, box_deltas, preds_per_image):
+    def _predict_boxes(self, proposals, box_deltas, preds_per_image=None):
         num_pred = box_deltas.size(0)
         B = proposals[0].size(-1)
         K = box_deltas.size(-1) // B
         box_deltas = box_deltas.view(num_pred * K, B)
         proposals = torch.cat(proposals, dim=0).unsqueeze(-2).expand(num_pred, K, B)
         proposals = proposals.reshape(-1, B)
-        boxes = self.box2box_transform.apply_deltas(box_deltas, proposals)
-        return boxes.view(num_pred, K * B).split(preds_per_image, dim=0)
+        boxes = self.box2box_transform.apply_deltas(box_deltas, proposals).view(num_pred, K * B)
+        if preds_per_image is None:
+            return boxes
+        return boxes.split(preds_per_image, dim=0)
 
-    def _predict_objs(self, obj_logits, preds_per_image):
+    def _predict_objs(self, obj_logits, preds_per_image=None):
         probs = F.softmax(obj_logits, dim=-1)
+        if preds_per_image is None:
+            return probs
         probs = probs.split(preds_per_image, dim=0)
         return probs
 
-    def _predict_attrs(self, attr_logits, preds_per_image):
+    def _predict_attrs(self, attr_logits, preds_per_image=None):
         attr_logits = attr_logits[..., :-1].softmax(-1)
         attr_probs, attrs = attr_logits.max(-1)
+        if preds_per_image is None:
+            return attr_probs, attrs
         return attr_probs.split(preds_per_image, dim=0), attrs.split(preds_per_image, dim=0)
 
+    @torch.no_grad()
+    def batched_inference(
+        self,
+        obj_logits,
+        attr_logits,
+        box_deltas,
+        pred_boxes,
+        features,
+        sizes,
+        scales=None,
+        max_detections=None,
+    ):
+        """
+        Post-processing of all the images of the batch at once (see `batched_do_nms`), `max_detections` overrides
+        the detection budget of the config.
+
+        Returns the kept detections of all images concatenated, in a dict of tensors, with the image and the
+        rank within the image of every detection, as expected by `pad_detections`.
+        """
+        max_detections = max_detections or self.max_detections
+        preds_per_image = [p.size(0) for p in pred_boxes]
+        boxes = self._predict_boxes(pred_boxes, box_deltas)
+        obj_scores = self._predict_objs(obj_logits)
+        attr_probs, attrs = self._predict_attrs(attr_logits)
+        image_index = torch.repeat_interleave(
+            torch.arange(len(preds_per_image), device=boxes.device),
+            torch.tensor(preds_per_image, device=boxes.device),
+        )
+        ids, image_index, rank, max_boxes, max_scores, classes = batched_do_nms(
+            boxes,
+            obj_scores,
+            image_index,
+            sizes.to(boxes.device),
+            len(preds_per_image),
+            self.nms_thresh,
+            min(self.min_detections, max_detections),
+            max_detections,
+        )
+        if scales is not None:
+            scale_yx = scales.to(max_boxes)[image_index]
+            max_boxes[:, 0::2] *= scale_yx[:, 1:]
+            max_boxes[:, 1::2] *= scale_yx[:, :1]
+
+        detections = OrderedDict(
+            {
+                "boxes": max_boxes,
+                "classes": classes,
+                "class_probs": max_scores,
+                "attrs": attrs[ids],
+                "attr_probs": attr_probs[ids],
+                "roi_features": features[ids],
+            }
+        )
+        return detections, image_index, rank
+
     @torch.no_grad()
     def inference(
         self,
@@ -1878,8 +2029,8 @@ class GeneralizedRCNN(nn.Module):
         # pool object features from either gt_boxes, or from proposals
         obj_logits, attr_logits, box_deltas, feature_pooled = self.roi_heads(features, proposal_boxes, gt_boxes)
 
-        # prepare FRCNN Outputs and select top proposals
-        boxes, classes, class_probs, attrs, attr_probs, roi_features = self.roi_outputs(
+        # prepare FRCNN Outputs and select top proposals, for all images of the batch at once
+        detections, image_index, rank = self.roi_outputs.batched_inference(
             obj_logits=obj_logits,
             attr_logits=attr_logits,
             box_deltas=box_deltas,
@@ -1887,6 +2038,7 @@ class GeneralizedRCNN(nn.Module):
             features=feature_pooled,
             sizes=image_shapes,
             scales=scales_yx,
+            max_detections=kwargs.get("max_detections", None),
         )
 
         # will we pad???
@@ -1896,13 +2048,10 @@ class GeneralizedRCNN(nn.Module):
             "pad_value": kwargs.get("pad_value", 0),
             "padding": kwargs.get("padding", None),
         }
-        preds_per_image = torch.tensor([p.size(0) for p in boxes])
-        boxes = pad_list_tensors(boxes, preds_per_image, **subset_kwargs)
-        classes = pad_list_tensors(classes, preds_per_image, **subset_kwargs)
-        class_probs = pad_list_tensors(class_probs, preds_per_image, **subset_kwargs)
-        attrs = pad_list_tensors(attrs, preds_per_image, **subset_kwargs)
-        attr_probs = pad_list_tensors(attr_probs, preds_per_image, **subset_kwargs)
-        roi_features = pad_list_tensors(roi_features, preds_per_image, **subset_kwargs)
+        preds_per_image = torch.bincount(image_index, minlength=len(proposal_boxes)).cpu()
+        boxes, classes, class_probs, attrs, attr_probs, roi_features = pad_detections(
+            detections, image_index, rank, len(proposal_boxes), **subset_kwargs
+        ).values()
         subset_kwargs["padding"] = None
         preds_per_image = pad_list_tensors(preds_per_image, None, **subset_kwargs)
         sizes = pad_list_tensors(image_shapes, None, **subset_kwargs)
@@ -144,6 +144,13 @@ class Config:
     def to_dict(self):
         return self._pointer
 
+    def to_plain_dict(self):
+        """Current values as nested plain dicts, e.g. to serialize them (`to_dict` keeps the nested Configs)."""
+        return {
+            k: v.to_plain_dict() if isinstance(v, Config) else v
+            for k, v in ((k, getattr(self, k)) for k in self._pointer)
+        }
+
     def dump_yaml(self, data, file_name):
         with open(f"{file_name}", "w") as stream:
             dump(data, stream)
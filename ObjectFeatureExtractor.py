@@ -1,24 +1,55 @@
-from IPython.display import clear_output, Image, display
-import PIL.Image
-import io
-import json
-import torch
-import numpy as np
-from ObjectFeature.processing_image import Preprocess
-from ObjectFeature.visualizing_image import SingleImageViz
-from ObjectFeature.modeling_frcnn import GeneralizedRCNN
-from ObjectFeature.utils import Config
-from transformers import LxmertForQuestionAnswering, LxmertTokenizer
-import wget
-import pickle
+import logging
 import os
-from utils.utils_metrics import get_entities
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import torch
+
+from utils.utils_feature_store import FeatureStore, ImageTable
+from utils.utils_tokenization import convert_with_image_stage, encode_text
+
+logger = logging.getLogger(__name__)
+
+# Pretrained detector, a hub name or a local directory with config.yaml and pytorch_model.bin.
+# Nothing is loaded at import time: the config, preprocessor and weights are built on first use and cached.
+FRCNN_MODEL_PATH = os.environ.get("FRCNN_MODEL_PATH", "unc-nlp/frcnn-vg-finetuned")
+
+
+@lru_cache(maxsize=None)
+def _load_frcnn_cfg(model_path):
+    from ObjectFeature.utils import Config
+    return Config.from_pretrained(model_path)
+
 
+@lru_cache(maxsize=None)
+def _load_image_preprocessor(model_path):
+    from ObjectFeature.processing_image import Preprocess
+    return Preprocess(_load_frcnn_cfg(model_path))
 
-frcnn_cfg = Config.from_pretrained("unc-nlp/frcnn-vg-finetuned")
-frcnn = GeneralizedRCNN.from_pretrained("unc-nlp/frcnn-vg-finetuned", config=frcnn_cfg)
 
-image_preprocessor = Preprocess(frcnn_cfg)
+@lru_cache(maxsize=None)
+def _load_frcnn(model_path):
+    from ObjectFeature.modeling_frcnn import GeneralizedRCNN
+    return GeneralizedRCNN.from_pretrained(model_path, config=_load_frcnn_cfg(model_path))
+
+
+def get_frcnn_cfg():
+    return _load_frcnn_cfg(FRCNN_MODEL_PATH)
+
+
+def get_image_preprocessor():
+    return _load_image_preprocessor(FRCNN_MODEL_PATH)
+
+
+def get_frcnn():
+    """The Faster R-CNN detector, its weights are only loaded the first time it is asked for."""
+    return _load_frcnn(FRCNN_MODEL_PATH)
+
+
+FAIL_IMAGE = '17_06_4705.jpg'
+# detector outputs kept in the offline feature store, see build_object_feature_store
+OBJECT_STORE_FIELDS = ['roi_features', 'normalized_boxes', 'obj_ids', 'preds_per_image']
 
 class InputExample(object):
     """A single training/test example for simple sequence classification."""
@@ -77,7 +108,7 @@ class InputFeatures(object):
 class MMInputFeatures(object):
     """A single set of features of data."""
 
-    def __init__(self, input_ids, input_mask,valid_mask,segment_ids,label_ids,image,sizes,scales_yx):
+    def __init__(self, input_ids, input_mask,valid_mask,segment_ids,label_ids,image,sizes,scales_yx,img_index=None):
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.valid_mask = valid_mask
@@ -86,6 +117,128 @@ class MMInputFeatures(object):
         self.image = image
         self.sizes = sizes
         self.scales_yx = scales_yx
+        # row of the image in the offline feature store, replaces image/sizes/scales_yx
+        self.img_index = img_index
+
+
+def read_image(path_img, image_name, fail_image=FAIL_IMAGE):
+    """Decodes one image, falling back to `fail_image` when it is missing or broken (raises without one)."""
+    from ObjectFeature.utils import img_tensorize
+    input_format = get_frcnn_cfg().INPUT.FORMAT
+    image_path = os.path.join(path_img, image_name)
+    try:
+        assert os.path.isfile(image_path), image_path
+        image = img_tensorize(image_path, input_format=input_format)
+    except Exception:
+        if fail_image is None:
+            raise
+        image = img_tensorize(os.path.join(path_img, fail_image), input_format=input_format)
+    return torch.as_tensor(np.ascontiguousarray(image))
+
+
+def decode_image_bytes(image_bytes):
+    """Decodes an encoded image (e.g. the bytes of a jpg file) the same way `read_image` decodes a file."""
+    import cv2
+    image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert image is not None, "the image cannot be decoded"
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    if get_frcnn_cfg().INPUT.FORMAT == "RGB":
+        image = image[:, :, ::-1]
+    return torch.as_tensor(np.ascontiguousarray(image))
+
+
+def preprocess_image_batch(path_img, image_names):
+    """
+    Decodes, resizes and normalizes a batch of images with one `Preprocess` call.
+    Returns one (image, sizes, scales_yx) per name, or None when it can not be read (see `ImageTable.fail`).
+    """
+    decoded = []
+    for image_name in image_names:
+        try:
+            decoded.append(read_image(path_img, image_name, fail_image=None))
+        except Exception:
+            decoded.append(None)
+    images = [image for image in decoded if image is not None]
+    outputs = zip(*get_image_preprocessor()(images)) if images else iter(())
+    results = []
+    for image in decoded:
+        if image is None:
+            results.append(None)
+            continue
+        image, sizes, scales_yx = next(outputs)
+        # Preprocess pads the batch to its largest image, cut every image back to its own size
+        results.append((image[:, :sizes[0], :sizes[1]].clone(), sizes, scales_yx))
+    return results
+
+
+def build_object_feature_store(img_ids, path_img, store_dir, batch_size=1, precision="float32"):
+    """
+    Runs the frozen detector once for every distinct image and saves its outputs under `store_dir`,
+    so that training and evaluation never call the detector again. Duplicate images and the images replaced
+    by `FAIL_IMAGE` (missing or broken) share one row, their img_ids are stored as aliases of it.
+    The ROI features are stored in `precision` (see `utils_feature_store.PRECISIONS`), int8 per feature channel.
+    """
+    image_table = ImageTable()
+    # the row of FAIL_IMAGE must exist before the store is allocated, broken images are moved to it
+    image_table.add(path_img, FAIL_IMAGE)
+    for img_id in sorted(set(img_ids)):
+        image_table.add(path_img, img_id, FAIL_IMAGE)
+    frcnn, image_preprocessor = get_frcnn(), get_image_preprocessor()
+    max_detections = get_frcnn_cfg().max_detections
+    writer = FeatureStore.create(store_dir, image_table.keys, {
+        'roi_features': ((max_detections, 2048), 'float32'),
+        'normalized_boxes': ((max_detections, 4), 'float32'),
+        'obj_ids': ((max_detections,), 'int64'),
+        'preds_per_image': ((), 'int64'),
+    }, aliases=image_table.aliases, precisions={'roi_features': precision}, channel_axes={'roi_features': -1},
+        config={'frcnn_model_path': FRCNN_MODEL_PATH})
+    for start in range(0, len(image_table), batch_size):
+        rows, images = [], []
+        for row in range(start, min(start + batch_size, len(image_table))):
+            try:
+                images.append(read_image(path_img, image_table.names[row], fail_image=None))
+                rows.append(row)
+            except Exception:
+                if image_table.fail(row, path_img, FAIL_IMAGE) == row:
+                    logger.warning("Can not read %s, its row is left zero filled", FAIL_IMAGE)
+                else:
+                    logger.warning("Can not read %s, using the features of %s", image_table.names[row], FAIL_IMAGE)
+        if not rows:
+            continue
+        images, sizes, scales_yx = image_preprocessor(images)
+        output_dict = frcnn(
+            images,
+            sizes,
+            scales_yx=scales_yx,
+            padding="max_detections",
+            max_detections=max_detections,
+            return_tensors='pt'
+        )
+        for i, row in enumerate(rows):
+            writer.write(row, **{name: output_dict[name][i] for name in OBJECT_STORE_FIELDS})
+    writer.aliases = image_table.aliases
+    writer.close()
+    return FeatureStore(store_dir)
+
+
+def object_visual_inputs(inputs, encoder, encoder_cfg, feature_store=None):
+    """Replaces the image entries of `inputs` by region features, from the store when there is one."""
+    if feature_store is not None:
+        output_dict = feature_store.get(inputs.pop('img_index'),
+                                        names=['roi_features', 'normalized_boxes'],
+                                        device=inputs['input_ids'].device)
+    else:
+        output_dict = encoder(
+            inputs.pop('image'),
+            inputs.pop('sizes'),
+            inputs.pop('scales_yx'),
+            padding="max_detections",
+            max_detections=encoder_cfg.max_detections,
+            return_tensors='pt'
+        )
+    inputs['features'] = output_dict.get('roi_features')
+    inputs['normalized_boxes'] = output_dict.get('normalized_boxes')
+    return inputs
 
 
 def convert_mm_examples_to_features(examples,
@@ -103,7 +256,12 @@ def convert_mm_examples_to_features(examples,
         pad_token_segment_id=0,
         pad_token_label_id=-100,
         sequence_a_segment_id=0,
-        mask_padding_with_zero=True,):
+        mask_padding_with_zero=True,
+        feature_store=None,
+        image_table=None,
+        image_batch_size=16,
+        num_image_workers=4,
+        text_features=None,):
     """Loads a data file into a list of `InputBatch`s."""
 
     """ Loads a data file into a list of `InputBatch`s
@@ -111,122 +269,67 @@ def convert_mm_examples_to_features(examples,
                 - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
                 - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
             `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+            The text is encoded by `utils_tokenization.encode_text`, or taken from `text_features` (its output
+            for the same examples, e.g. read back from the text cache). The features are left unpadded, batches
+            are padded to their longest example by `utils_ner.DynamicPaddingCollator`.
         """
-    label_map = {label: i for i, label in enumerate(label_list)}
-    span_labels = []
-    for label in label_list:
-        label = label.split('-')[-1]
-        if label not in span_labels:
-            span_labels.append(label)
-    span_map = {label: i for i, label in enumerate(span_labels)}
-    features = []
-    for (ex_index, example) in enumerate(examples):
-        try:
-            image_name = example.img_id
-            image_path = os.path.join(path_img, image_name)
-            if not os.path.exists(image_path):
-                print(image_path)
-            try:
-                image, sizes, scales_yx = image_preprocessor(image_path)
-            except:
-                image_path_fail = os.path.join(path_img, '17_06_4705.jpg')
-                image, sizes, scales_yx = image_preprocessor(image_path_fail)
-        except:
-            continue
-        tokens = []
-        valid_mask = []
-        for word in example.words:
-            word_tokens = tokenizer.tokenize(word)
-            # bert-base-multilingual-cased sometimes output "nothing ([]) when calling tokenize with just a space.
-            for i, word_token in enumerate(word_tokens):
-                if i == 0:
-                    valid_mask.append(1)
-                else:
-                    valid_mask.append(0)
-                tokens.append(word_token)
-        label_ids = [label_map[label] for label in example.labels]
-        entities = get_entities(example.labels)
-        start_ids = [span_map['O']] * len(label_ids)
-        end_ids = [span_map['O']] * len(label_ids)
-        for entity in entities:
-            start_ids[entity[1]] = span_map[entity[0]]
-            end_ids[entity[-1]] = span_map[entity[0]]
-        # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
-        special_tokens_count = 3 if sep_token_extra else 2
-        if len(tokens) > max_seq_length - special_tokens_count:
-            tokens = tokens[: (max_seq_length - special_tokens_count)]
-            label_ids = label_ids[: (max_seq_length - special_tokens_count)]
-            valid_mask = valid_mask[: (max_seq_length - special_tokens_count)]
-            start_ids = start_ids[: (max_seq_length - special_tokens_count)]
-            end_ids = end_ids[: (max_seq_length - special_tokens_count)]
-
-        tokens += [sep_token]
-        label_ids += [pad_token_label_id]
-        start_ids += [pad_token_label_id]
-        end_ids += [pad_token_label_id]
-        valid_mask.append(1)
-        if sep_token_extra:
-            # roberta uses an extra separator b/w pairs of sentences
-            tokens += [sep_token]
-            label_ids += [pad_token_label_id]
-            start_ids += [pad_token_label_id]
-            end_ids += [pad_token_label_id]
-            valid_mask.append(1)
-        segment_ids = [sequence_a_segment_id] * len(tokens)
-
-        if cls_token_at_end:
-            tokens += [cls_token]
-            label_ids += [pad_token_label_id]
-            start_ids += [pad_token_label_id]
-            end_ids += [pad_token_label_id]
-            segment_ids += [cls_token_segment_id]
-            valid_mask.append(1)
-        else:
-            tokens = [cls_token] + tokens
-            label_ids = [pad_token_label_id] + label_ids
-            start_ids = [pad_token_label_id] + start_ids
-            end_ids = [pad_token_label_id] + end_ids
-            segment_ids = [cls_token_segment_id] + segment_ids
-            valid_mask.insert(0, 1)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
-        if pad_on_left:
-            input_ids = ([pad_token] * padding_length) + input_ids
-            input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
-            segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
-            label_ids = ([pad_token_label_id] * padding_length) + label_ids
-            start_ids = ([pad_token_label_id] * padding_length) + start_ids
-            end_ids = ([pad_token_label_id] * padding_length) + end_ids
-            valid_mask = ([0] * padding_length) + valid_mask
-        else:
-            input_ids += [pad_token] * padding_length
-            input_mask += [0 if mask_padding_with_zero else 1] * padding_length
-            segment_ids += [pad_token_segment_id] * padding_length
-            label_ids += [pad_token_label_id] * padding_length
-            start_ids += [pad_token_label_id] * padding_length
-            end_ids += [pad_token_label_id] * padding_length
-            valid_mask += [0] * padding_length
-        while (len(label_ids) < max_seq_length):
-            label_ids.append(pad_token_label_id)
-            start_ids.append(pad_token_label_id)
-            end_ids.append(pad_token_label_id)
-
-        features.append(
-            MMInputFeatures(input_ids=input_ids,
-                          input_mask=input_mask,
-                          valid_mask=valid_mask,
-                          segment_ids=segment_ids,
-                          label_ids=label_ids,
-                          image=image,
-                          sizes=sizes,
-                          scales_yx=scales_yx)
-        )
-    return features
+    # Every distinct image is preprocessed once into `image_table` and the features only keep its row.
+    # Without a table from the caller the images are put back on the features themselves.
+    own_table = image_table is None
+    if feature_store is None:
+        if own_table:
+            image_table = ImageTable()
+        start_row = len(image_table)
+        img_indexes = [image_table.add(path_img, example.img_id, FAIL_IMAGE) for example in examples]
+        # images are preprocessed in batches by the workers while the examples are tokenized below
+        new_names = image_table.names[start_row:]
+        get_image_preprocessor()  # build it once here rather than racing for it in the workers
+        executor = ThreadPoolExecutor(max_workers=num_image_workers)
+        image_batches = [executor.submit(preprocess_image_batch, path_img, new_names[start: start + image_batch_size])
+                         for start in range(0, len(new_names), image_batch_size)]
+        executor.shutdown(wait=False)
+        failed_rows = set()
+    if text_features is None:
+        text_features = encode_text(examples, label_list, max_seq_length, tokenizer,
+                                    cls_token_at_end=cls_token_at_end,
+                                    cls_token=cls_token,
+                                    cls_token_segment_id=cls_token_segment_id,
+                                    sep_token=sep_token,
+                                    sep_token_extra=sep_token_extra,
+                                    pad_token=pad_token,
+                                    pad_token_segment_id=pad_token_segment_id,
+                                    pad_token_label_id=pad_token_label_id,
+                                    sequence_a_segment_id=sequence_a_segment_id,
+                                    mask_padding_with_zero=mask_padding_with_zero)
+
+    def load_row(img_index):
+        if image_table.values[img_index] is None and img_index not in failed_rows:
+            offset = img_index - start_row
+            if 0 <= offset < len(new_names):
+                preprocessed = image_batches[offset // image_batch_size].result()[offset % image_batch_size]
+            else:
+                # e.g. the row of FAIL_IMAGE, added after the batches were submitted
+                preprocessed = preprocess_image_batch(path_img, [image_table.names[img_index]])[0]
+            if preprocessed is None:
+                failed_rows.add(img_index)
+            else:
+                image_table.values[img_index] = dict(zip(['image', 'sizes', 'scales_yx'], preprocessed))
+        return image_table.values[img_index]
+
+    def image_stage(ex_index, example):
+        if feature_store is not None:
+            # images were already run through the detector, only keep the row
+            return dict(image=None, sizes=None, scales_yx=None, img_index=feature_store.row(example.img_id, FAIL_IMAGE))
+        img_index = img_indexes[ex_index]
+        if load_row(img_index) is None:
+            # broken file, its examples share the row of FAIL_IMAGE
+            img_index = image_table.fail(img_index, path_img, FAIL_IMAGE)
+            if load_row(img_index) is None:
+                logger.warning("Can not read %s nor %s, skipping the example",
+                               os.path.join(path_img, example.img_id), FAIL_IMAGE)
+                return None
+        if own_table:
+            return dict(image_table.values[img_index], img_index=None)
+        return dict(image=None, sizes=None, scales_yx=None, img_index=img_index)
 
+    return convert_with_image_stage(examples, text_features, image_stage, MMInputFeatures)
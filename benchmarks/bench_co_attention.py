@@ -0,0 +1,69 @@
+"""
+Peak memory and throughput of the factorized CoAttention against the repeat implementation.
+
+USAGE (from the repo root):
+``python -m benchmarks.bench_co_attention --batch_size 8 --seq_lengths 64 128 --num_img_region 49``
+
+Peak memory is measured with torch.cuda.max_memory_allocated, so it is only reported on GPU.
+"""
+import argparse
+import copy
+import time
+from types import SimpleNamespace
+
+import torch
+
+from Attention import CoAttention
+
+
+def run(module, text_features, img_features, repeat, device):
+    with torch.no_grad():
+        module(text_features, img_features)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            outputs = module(text_features, img_features)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeat
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == "cuda" else float("nan")
+    return outputs, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--seq_lengths", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--num_img_region", type=int, default=49)
+    parser.add_argument("--hidden_dim", type=int, default=768)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("{:>5} {:>14} {:>14} {:>14} {:>14} {:>10}".format(
+        "len", "repeat(ex/s)", "factor.(ex/s)", "repeat(MiB)", "factor.(MiB)", "max_diff"))
+    for max_len in args.seq_lengths:
+        config = SimpleNamespace(hidden_dim=args.hidden_dim, num_img_region=args.num_img_region,
+                                 max_seq_length=max_len, co_attention_impl="repeat")
+        repeat_attention = CoAttention(config).to(device).eval()
+        factorized_attention = copy.deepcopy(repeat_attention)
+        factorized_attention.args = SimpleNamespace(**dict(vars(config), co_attention_impl="factorized"))
+
+        text_features = torch.randn(args.batch_size, max_len, args.hidden_dim, device=device)
+        img_features = torch.randn(args.batch_size, args.num_img_region, args.hidden_dim, device=device)
+
+        (repeat_text, repeat_img), repeat_time, repeat_peak = run(
+            repeat_attention, text_features, img_features, args.repeat, device)
+        (factorized_text, factorized_img), factorized_time, factorized_peak = run(
+            factorized_attention, text_features, img_features, args.repeat, device)
+        max_diff = max((repeat_text - factorized_text).abs().max().item(),
+                       (repeat_img - factorized_img).abs().max().item())
+        print("{:>5} {:>14.1f} {:>14.1f} {:>14.1f} {:>14.1f} {:>10.2e}".format(
+            max_len, args.batch_size / repeat_time, args.batch_size / factorized_time,
+            repeat_peak, factorized_peak, max_diff))
+
+
+if __name__ == "__main__":
+    main()
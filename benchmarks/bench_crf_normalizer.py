@@ -0,0 +1,68 @@
+"""
+CPU time of the CRF negative log likelihood (forward and backward) with the sequential forward algorithm against
+the log-semiring scan, for several tag counts and sequence lengths.
+
+USAGE (from the repo root):
+``python -m benchmarks.bench_crf_normalizer --num_tags 9 17 30 --seq_lengths 32 64 128 256 --batch_size 16``
+
+Both normalizers must agree on the partition function, this is checked before timing. A quarter of the sequences
+are padded to half of their length, the padded timesteps go through the identity matrices of the scan.
+"""
+import argparse
+import time
+
+import torch
+
+from losses.crf import CRF
+
+
+def nll_time(crf, emissions, tags, mask, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        emissions.grad = None
+        crf.zero_grad()
+        start = time.perf_counter()
+        loss = -crf(emissions, tags, mask, reduction="mean")
+        loss.backward()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_tags", type=int, nargs="+", default=[9, 17, 30])
+    parser.add_argument("--seq_lengths", type=int, nargs="+", default=[32, 64, 128, 256])
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--scan_chunk_size", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    print("{:>5} {:>7} {:>16} {:>10} {:>9} {:>12}".format(
+        "tags", "length", "sequential(ms)", "scan(ms)", "speedup", "max_abs_diff"))
+    for num_tags in args.num_tags:
+        sequential = CRF(num_tags, batch_first=True)
+        scan = CRF(num_tags, batch_first=True, normalizer="scan", scan_chunk_size=args.scan_chunk_size)
+        scan.load_state_dict(sequential.state_dict())
+        for seq_length in args.seq_lengths:
+            emissions = torch.randn(args.batch_size, seq_length, num_tags, requires_grad=True)
+            tags = torch.randint(num_tags, (args.batch_size, seq_length))
+            mask = torch.ones(args.batch_size, seq_length, dtype=torch.uint8)
+            mask[: args.batch_size // 4, seq_length // 2:] = 0
+            with torch.no_grad():
+                reference = sequential._compute_normalizer(emissions.transpose(0, 1), mask.transpose(0, 1))
+                diff = (scan._compute_normalizer_scan(emissions.transpose(0, 1), mask.transpose(0, 1))
+                        - reference).abs().max().item()
+            assert diff < 1e-3 * max(1.0, reference.abs().max().item()), \
+                "the normalizers disagree by {} for {} tags and length {}".format(diff, num_tags, seq_length)
+            sequential_time = nll_time(sequential, emissions, tags, mask, args.repeats)
+            scan_time = nll_time(scan, emissions, tags, mask, args.repeats)
+            print("{:>5} {:>7} {:>16.2f} {:>10.2f} {:>8.2f}x {:>12.2e}".format(
+                num_tags, seq_length, sequential_time * 1000, scan_time * 1000, sequential_time / scan_time, diff))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Time of the entity extraction over a whole prediction dump: the label string extractors of utils_metrics
+(get_entities_bio, get_entities, get_entities_span) against their label id versions.
+
+USAGE (from the repo root):
+``python -m benchmarks.bench_entity_extraction --num_sentences 100000``
+``python -m benchmarks.bench_entity_extraction --predictions output/predictions.jsonl``
+
+Without `--predictions` (the output of the predict mode) the sentences are random BIO sequences. Both versions
+must give the same entities, this is checked before reporting. get_entities_span copies the rest of the flattened
+dump for every start, so both span versions only run over the first `--span_sentences` sentences.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from utils.utils_ner import MMNerTask
+from utils.utils_metrics import (TagIndex, get_entities, get_entities_bio, get_entities_bio_ids, get_entities_ids,
+                                 get_entities_span, get_entities_span_ids)
+
+
+def random_tags(labels, num_sentences, max_length, seed):
+    """BIO sequences with entities of one to three words, and a few I- tags out of place."""
+    rng = np.random.RandomState(seed)
+    begins = [i for i, label in enumerate(labels) if label.startswith("B-")]
+    inside = {i: labels.index("I-" + labels[i][2:]) for i in begins if "I-" + labels[i][2:] in labels}
+    sentences = []
+    for _ in range(num_sentences):
+        tags = []
+        length = rng.randint(1, max_length + 1)
+        while len(tags) < length:
+            if rng.rand() < 0.15:
+                begin = begins[rng.randint(len(begins))]
+                tags += [begin] + [inside.get(begin, begin)] * rng.randint(0, 3)
+            elif rng.rand() < 0.02:
+                tags.append(labels.index("I-" + labels[begins[rng.randint(len(begins))]][2:]))
+            else:
+                tags.append(labels.index("O"))
+        sentences.append(tags[:length])
+    return sentences
+
+
+def read_predictions(path, labels):
+    label_ids = {label: i for i, label in enumerate(labels)}
+    with open(path, "r", encoding="utf-8") as f:
+        return [[label_ids[tag] for tag in json.loads(line)["tags"]] for line in f if line.strip()]
+
+
+def to_matrix(sentences):
+    label_ids = np.zeros((len(sentences), max(len(tags) for tags in sentences)), dtype=np.int64)
+    mask = np.zeros(label_ids.shape, dtype=bool)
+    for row, tags in enumerate(sentences):
+        label_ids[row, :len(tags)] = tags
+        mask[row, :len(tags)] = True
+    return label_ids, mask
+
+
+def as_string_entities(entities, names, lengths):
+    """(name, start, end) of the id entities, in the positions of the flattened label lists of the sentences."""
+    first = np.concatenate([[0], np.cumsum(np.asarray(lengths) + 1)])
+    return {(names[type_], int(first[row] + start), int(first[row] + end)) for row, type_, start, end in entities}
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--labels", default=None, help="label file, the labels of MMNerTask by default")
+    parser.add_argument("--predictions", default=None)
+    parser.add_argument("--num_sentences", type=int, default=100000)
+    parser.add_argument("--max_length", type=int, default=40)
+    parser.add_argument("--span_sentences", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    labels = MMNerTask().get_labels(args.labels)
+    sentences = read_predictions(args.predictions, labels) if args.predictions else \
+        random_tags(labels, args.num_sentences, args.max_length, args.seed)
+    lengths = [len(tags) for tags in sentences]
+    string_lists = [[labels[i] for i in tags] for tags in sentences]
+    label_ids, mask = to_matrix(sentences)
+    tag_index = TagIndex(labels)
+
+    # span labels are the entity types: a start on the first word of every entity, an end on its last word
+    span_labels = ["O"] + [type_ for type_ in tag_index.types if type_ != "O"]
+    span_index = TagIndex(span_labels)
+    start_ids, end_ids = np.zeros_like(label_ids), np.zeros_like(label_ids)
+    for row, type_, start, end in get_entities_bio_ids(label_ids, tag_index, mask):
+        start_ids[row, start] = end_ids[row, end] = span_labels.index(tag_index.types[type_])
+    num_span = min(args.span_sentences, len(sentences))
+    start_lists = [[span_labels[i] for i in row[:length]] for row, length in zip(start_ids, lengths[:num_span])]
+    end_lists = [[span_labels[i] for i in row[:length]] for row, length in zip(end_ids, lengths[:num_span])]
+
+    print("{} sentences, {} words".format(len(sentences), sum(lengths)))
+    print("{:>18} {:>10} {:>10} {:>10} {:>10} {:>9}".format(
+        "extractor", "sentences", "entities", "str(ms)", "ids(ms)", "speedup"))
+    for name, string_fn, string_args, id_fn, id_args, names, num_rows in [
+        ("get_entities_bio", get_entities_bio, (string_lists,), get_entities_bio_ids, (label_ids, tag_index, mask),
+         tag_index.types, len(sentences)),
+        ("get_entities", get_entities, (string_lists,), get_entities_ids, (label_ids, tag_index, mask),
+         tag_index.types, len(sentences)),
+        ("get_entities_span", get_entities_span, (start_lists, end_lists), get_entities_span_ids,
+         (start_ids[:num_span], end_ids[:num_span], span_index, mask[:num_span]), span_labels, num_span),
+    ]:
+        expected, string_time = timed(string_fn, *string_args)
+        entities, id_time = timed(id_fn, *id_args)
+        assert as_string_entities(entities, names, lengths[:num_rows]) == set(map(tuple, expected)), \
+            "{} and its label id version disagree".format(name)
+        print("{:>18} {:>10} {:>10} {:>10.1f} {:>10.1f} {:>8.1f}x".format(
+            name, num_rows, len(entities), string_time * 1000, id_time * 1000, string_time / id_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Images/sec of the Faster R-CNN feature extraction on CPU against the batch size and the detection budget, and time
+of the post-processing alone: per-image NMS and padding against the batched path.
+
+USAGE (from the repo root):
+``python -m benchmarks.bench_frcnn_inference --image_dir data/twitter2017_images --batch_sizes 1 4 8 --max_detections 10 36 100``
+
+Both post-processing paths must keep the same number of boxes per image, this is checked before timing.
+"""
+import argparse
+import os
+import time
+
+import torch
+
+from ObjectFeature.modeling_frcnn import GeneralizedRCNN, pad_detections, pad_list_tensors
+from ObjectFeature.processing_image import Preprocess
+from ObjectFeature.utils import Config
+
+
+def roi_outputs_inputs(model, images, sizes, scales_yx):
+    """Inputs of `ROIOutputs`, i.e. everything `GeneralizedRCNN.inference` computes before the post-processing."""
+    features = model.backbone(images)
+    proposal_boxes, _ = model.proposal_generator(images, sizes, features, None)
+    obj_logits, attr_logits, box_deltas, feature_pooled = model.roi_heads(features, proposal_boxes, None)
+    return dict(obj_logits=obj_logits, attr_logits=attr_logits, box_deltas=box_deltas, pred_boxes=proposal_boxes,
+                features=feature_pooled, sizes=sizes, scales=scales_yx)
+
+
+def post_process_loop(model, inputs, max_detections):
+    outputs = model.roi_outputs.inference(**inputs)
+    preds_per_image = torch.tensor([p.size(0) for p in outputs[0]])
+    padded = [pad_list_tensors(list(output), preds_per_image, max_detections=max_detections, return_tensors="pt",
+                               padding="max_detections") for output in outputs]
+    return padded, preds_per_image
+
+
+def post_process_batched(model, inputs, max_detections):
+    detections, image_index, rank = model.roi_outputs.batched_inference(**inputs, max_detections=max_detections)
+    num_images = len(inputs["pred_boxes"])
+    padded = pad_detections(detections, image_index, rank, num_images, max_detections=max_detections,
+                            return_tensors="pt", padding="max_detections")
+    return list(padded.values()), torch.bincount(image_index, minlength=num_images)
+
+
+def timeit(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dir", default="data/twitter2017_images")
+    parser.add_argument("--model_path", default="unc-nlp/frcnn-vg-finetuned")
+    parser.add_argument("--num_images", type=int, default=32)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--max_detections", type=int, nargs="+", default=[10, 36, 100])
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    cfg = Config.from_pretrained(args.model_path)
+    cfg.model.device = "cpu"
+    preprocess = Preprocess(cfg)
+    model = GeneralizedRCNN.from_pretrained(args.model_path, config=cfg).eval()
+    paths = [os.path.join(args.image_dir, name) for name in sorted(os.listdir(args.image_dir))[:args.num_images]]
+
+    # the loop keeps the budget of the config, compare both paths with it
+    with torch.no_grad():
+        inputs = roi_outputs_inputs(model, *preprocess(paths[:max(args.batch_sizes)]))
+    _, loop_counts = post_process_loop(model, inputs, cfg.MAX_DETECTIONS)
+    _, batched_counts = post_process_batched(model, inputs, cfg.MAX_DETECTIONS)
+    print("{} images, boxes per image {} between the per-image and the batched post-processing".format(
+        len(loop_counts), "match" if torch.equal(loop_counts, batched_counts) else "DIFFER"))
+
+    print("{:>10} {:>8} {:>10} {:>16} {:>16}".format(
+        "batch_size", "max_det", "img/s", "loop post (ms)", "batched post (ms)"))
+    for batch_size in args.batch_sizes:
+        batches = [preprocess(paths[start:start + batch_size]) for start in range(0, len(paths), batch_size)]
+        with torch.no_grad():
+            inputs = roi_outputs_inputs(model, *batches[0])
+        for max_detections in args.max_detections:
+            def extract():
+                for images, sizes, scales_yx in batches:
+                    model(images, sizes, scales_yx=scales_yx, padding="max_detections",
+                          max_detections=max_detections, return_tensors="pt")
+
+            elapsed = timeit(extract, args.repeat)
+            loop_time = timeit(lambda: post_process_loop(model, inputs, cfg.MAX_DETECTIONS), args.repeat)
+            batched_time = timeit(lambda: post_process_batched(model, inputs, max_detections), args.repeat)
+            print("{:>10} {:>8} {:>10.2f} {:>16.2f} {:>16.2f}".format(
+                batch_size, max_detections, len(paths) / elapsed, loop_time * 1000, batched_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Throughput of the word-by-word tokenization against the batched fast-tokenizer path, on a CoNLL split.
+
+USAGE (from the repo root):
+``python -m benchmarks.bench_tokenization --data_dir data/twitter2017 --mode train --tokenizer_name bert-base-uncased``
+
+Both paths must give the same sub-token ids and valid_mask, this is checked before timing.
+"""
+import argparse
+import time
+
+from transformers import AutoTokenizer
+
+from utils.utils_ner import MMNerTask
+from utils.utils_tokenization import tokenize_words
+
+
+def timeit(tokenizer, sentences, batch_size, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _ in tokenize_words(tokenizer, sentences, batch_size=batch_size):
+            pass
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="data/twitter2017")
+    parser.add_argument("--mode", default="train")
+    parser.add_argument("--tokenizer_name", default="bert-base-uncased")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[64, 256, 1024])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    sentences = [example.words for example in MMNerTask().iter_examples_from_file(args.data_dir, args.mode)]
+    num_words = sum(len(words) for words in sentences)
+    slow_tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, use_fast=False)
+    fast_tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, use_fast=True)
+
+    slow = list(tokenize_words(slow_tokenizer, sentences))
+    fast = list(tokenize_words(fast_tokenizer, sentences))
+    mismatches = sum(1 for a, b in zip(slow, fast) if tuple(map(list, a)) != tuple(map(list, b)))
+    print("{} sentences, {} words, {} mismatching sentences".format(len(sentences), num_words, mismatches))
+
+    slow_time = timeit(slow_tokenizer, sentences, 1, args.repeat)
+    print("{:>10} {:>12} {:>12} {:>8}".format("path", "batch_size", "sent/s", "speedup"))
+    print("{:>10} {:>12} {:>12.0f} {:>8}".format("per-word", "-", len(sentences) / slow_time, "1.0x"))
+    for batch_size in args.batch_sizes:
+        fast_time = timeit(fast_tokenizer, sentences, batch_size, args.repeat)
+        print("{:>10} {:>12} {:>12.0f} {:>7.1f}x".format(
+            "fast", batch_size, len(sentences) / fast_time, slow_time / fast_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Compares the batched valid_sequence_output against the per-token loop it replaced.
+
+USAGE (from the repo root):
+``python -m benchmarks.bench_valid_sequence_output --batch_sizes 8 32 --seq_lengths 64 128``
+"""
+import argparse
+import time
+
+import torch
+
+from utils.utils_ner import valid_sequence_output, valid_sequence_output_loop
+
+
+def random_inputs(batch_size, max_len, feat_dim, device):
+    sequence_output = torch.randn(batch_size, max_len, feat_dim, device=device)
+    lengths = torch.randint(2, max_len + 1, (batch_size,), device=device)
+    attention_mask = (torch.arange(max_len, device=device).unsqueeze(0) < lengths.unsqueeze(1)).long()
+    # roughly one word every 1.4 sub-tokens, as in the twitter data; [CLS] is always valid
+    valid_mask = (torch.rand(batch_size, max_len, device=device) < 0.7).long() * attention_mask
+    valid_mask[:, 0] = 1
+    return sequence_output, valid_mask, attention_mask
+
+
+def timeit(fn, inputs, repeat, device):
+    fn(*inputs)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*inputs)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--seq_lengths", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--feat_dim", type=int, default=768)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("{:>6} {:>6} {:>12} {:>12} {:>8} {:>6}".format("batch", "len", "loop(ms)", "batched(ms)", "speedup", "equal"))
+    for batch_size in args.batch_sizes:
+        for max_len in args.seq_lengths:
+            inputs = random_inputs(batch_size, max_len, args.feat_dim, device)
+            loop_output, loop_mask = valid_sequence_output_loop(*inputs)
+            output, mask = valid_sequence_output(*inputs)
+            equal = torch.equal(loop_output.to(device), output) and torch.equal(loop_mask.to(device), mask)
+
+            loop_ms = timeit(valid_sequence_output_loop, inputs, args.repeat, device)
+            batched_ms = timeit(valid_sequence_output, inputs, args.repeat, device)
+            print("{:>6} {:>6} {:>12.3f} {:>12.3f} {:>7.1f}x {:>6}".format(
+                batch_size, max_len, loop_ms, batched_ms, loop_ms / batched_ms, str(equal)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Load generator for a local serve_ner.py instance: client-side throughput and p50/p99 latency at several
+concurrency levels, next to the micro-batch size the server reports.
+
+USAGE (from the repo root, with the server running):
+``python -m benchmarks.load_ner_server --url http://127.0.0.1:8080 --data_dir data/twitter2017 --mode dev
+--path_image data/twitter2017_images --concurrency 1 4 16 --requests 400``
+
+``--unix_socket <path>`` targets a server listening on a Unix socket instead. Requests are built from the
+sentences and images of a CoNLL split, and reused round robin.
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+from utils.utils_ner import MMNerTask
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def connect(args):
+    if args.unix_socket:
+        return UnixHTTPConnection(args.unix_socket)
+    host, _, port = args.url.split("://")[-1].rstrip("/").partition(":")
+    return http.client.HTTPConnection(host, int(port or 80), timeout=60)
+
+
+def request(connection, method, path, payload=None):
+    body = json.dumps(payload).encode("utf-8") if payload is not None else None
+    connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    data = json.loads(response.read())
+    if response.status != 200:
+        raise RuntimeError("{} {}: {}".format(response.status, path, data.get("error")))
+    return data
+
+
+def build_payloads(args):
+    payloads = []
+    for example in MMNerTask().iter_examples_from_file(args.data_dir, args.mode):
+        image_path = os.path.join(args.path_image, example.img_id)
+        image = None
+        if os.path.isfile(image_path):
+            with open(image_path, "rb") as f:
+                image = base64.b64encode(f.read()).decode("ascii")
+        payloads.append({"tokens": example.words, "image": image})
+        if len(payloads) == args.max_payloads:
+            break
+    return payloads
+
+
+def run(args, payloads, concurrency, num_requests):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(num_requests))
+
+    def client():
+        connection = connect(args)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            start = time.perf_counter()
+            try:
+                request(connection, "POST", "/predict", payloads[i % len(payloads)])
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                connection.close()
+                connection = connect(args)
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return np.array(latencies) * 1000, len(errors), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--unix_socket", default=None)
+    parser.add_argument("--data_dir", default="data/twitter2017")
+    parser.add_argument("--mode", default="dev")
+    parser.add_argument("--path_image", default="data/twitter2017_images")
+    parser.add_argument("--max_payloads", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=400)
+    args = parser.parse_args()
+
+    payloads = build_payloads(args)
+    assert payloads, "no sentence in {}/{}.txt".format(args.data_dir, args.mode)
+    connection = connect(args)
+    request(connection, "GET", "/health")
+    # warm up, the first batches pay for lazy initialisation on the server
+    run(args, payloads, 1, 4)
+    print("{:>11} {:>9} {:>9} {:>9} {:>7} {:>15}".format(
+        "concurrency", "req/s", "p50(ms)", "p99(ms)", "errors", "server batch"))
+    for concurrency in args.concurrency:
+        before = request(connection, "GET", "/stats")
+        latencies, num_errors, elapsed = run(args, payloads, concurrency, args.requests)
+        after = request(connection, "GET", "/stats")
+        batches = after["batches"] - before["batches"]
+        mean_batch = (after["requests"] - before["requests"]) / batches if batches else float("nan")
+        print("{:>11} {:>9.1f} {:>9.1f} {:>9.1f} {:>7} {:>15.2f}".format(
+            concurrency, len(latencies) / elapsed,
+            np.percentile(latencies, 50) if len(latencies) else float("nan"),
+            np.percentile(latencies, 99) if len(latencies) else float("nan"),
+            num_errors, mean_batch))
+    print("server:", json.dumps(request(connection, "GET", "/stats")))
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Space, load time, reconstruction error and F1 of the visual feature stores in reduced precision, against float32.
+
+USAGE (from the repo root), once per dataset:
+``python -m benchmarks.report_feature_precision --store data/twitter2017/cached_grid_features --eval_command
+"python run_crf_ner.py --do_eval ... --feature_type Grid --grid_feature_store {store} --output_dir {output_dir}"``
+
+The float32 store is converted to every precision next to it (``<store>_<precision>``, reused when it exists).
+`--eval_command` is run once per store, with `{store}` and `{output_dir}` filled in, and the last ``f1 = ...`` of
+``{output_dir}/eval_results.txt`` is reported. Without it only space, load time and error are reported.
+Load times are measured with a warm page cache.
+"""
+import argparse
+import os
+import re
+import subprocess
+import time
+
+import numpy as np
+import torch
+
+from utils.utils_feature_store import FeatureStore, convert_store
+
+# channel axis of the visual fields within a row, int8 has one scale per channel
+CHANNEL_AXES = {"roi_features": -1, "att": 0}
+
+
+def store_size(store_dir):
+    return sum(entry.stat().st_size for entry in os.scandir(store_dir) if entry.is_file())
+
+
+def load_time(store, names, batches, device):
+    start = time.perf_counter()
+    for rows in batches:
+        store.get(rows, names=names, device=device)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / len(batches)
+
+
+def eval_f1(eval_command, store_dir, output_dir):
+    subprocess.run(eval_command.format(store=store_dir, output_dir=output_dir), shell=True, check=True)
+    with open(os.path.join(output_dir, "eval_results.txt"), "r") as f:
+        scores = re.findall(r"^f1 = ([0-9.eE+-]+)$", f.read(), flags=re.MULTILINE)
+    return float(scores[-1]) if scores else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", required=True, help="float32 feature store")
+    parser.add_argument("--precisions", nargs="+", default=["float16", "bfloat16", "int8"])
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_batches", type=int, default=50)
+    parser.add_argument("--eval_command", default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    reference = FeatureStore(args.store)
+    names = [name for name in CHANNEL_AXES if name in reference.arrays]
+    assert names, "no visual field ({}) in {}".format(", ".join(CHANNEL_AXES), args.store)
+    assert all(reference.precisions[name] == "float32" for name in names), "the reference store must be float32"
+    rng = np.random.RandomState(args.seed)
+    batches = [rng.randint(0, len(reference), args.batch_size) for _ in range(args.num_batches)]
+    stores = {"float32": reference}
+    for precision in args.precisions:
+        store_dir = "{}_{}".format(args.store.rstrip(os.sep), precision)
+        if FeatureStore.exists(store_dir):
+            stores[precision] = FeatureStore(store_dir)
+        else:
+            stores[precision] = convert_store(args.store, store_dir, {name: precision for name in names},
+                                              {name: CHANNEL_AXES[name] for name in names})
+
+    reference_size = store_size(args.store)
+    reference_time = load_time(reference, names, batches, device)
+    sample = reference.get(batches[0], names=names)
+    reference_f1 = eval_f1(args.eval_command, args.store, args.store + "_eval") if args.eval_command else None
+    print("{:>10} {:>10} {:>7} {:>14} {:>8} {:>12} {:>8} {:>8}".format(
+        "precision", "size(MiB)", "saving", "load(ms/batch)", "speedup", "max_rel_err", "f1", "f1_delta"))
+    for precision, store in stores.items():
+        size = store_size(store.store_dir)
+        elapsed = load_time(store, names, batches, device)
+        values = store.get(batches[0], names=names)
+        error = max(((values[name] - sample[name]).abs().max() / sample[name].abs().max().clamp(min=1e-12)).item()
+                    for name in names)
+        if args.eval_command:
+            f1 = reference_f1 if store is reference else eval_f1(args.eval_command, store.store_dir,
+                                                                  store.store_dir + "_eval")
+            f1_columns = "{:>8.4f} {:>+8.4f}".format(f1, f1 - reference_f1)
+        else:
+            f1_columns = "{:>8} {:>8}".format("-", "-")
+        print("{:>10} {:>10.1f} {:>6.1f}x {:>14.2f} {:>7.2f}x {:>12.2e} {}".format(
+            precision, size / 2 ** 20, reference_size / size, elapsed * 1000, reference_time / elapsed, error,
+            f1_columns))
+
+
+if __name__ == "__main__":
+    main()
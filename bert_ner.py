@@ -96,7 +96,8 @@ class BertCrfNer(BertPreTrainedModel):
         self.bert = BertModel(config, add_pooling_layer=False)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         self.classifier = nn.Linear(config.hidden_size, config.num_labels)
-        self.crf = CRF(num_tags=config.num_labels, batch_first=True)
+        self.crf = CRF(num_tags=config.num_labels, batch_first=True,
+                       normalizer=getattr(config, "crf_normalizer", "sequential"))
         self.mmEncoder = AdaptiveCoFusion(args,config)
 
     def forward(
@@ -244,7 +245,8 @@ class LxmertCrfNer(LxmertPreTrainedModel):
         super().__init__(config)
         self.config = config
         self.num_labels = config.num_labels
-        self.crf = CRF(num_tags=config.num_labels, batch_first=True)
+        self.crf = CRF(num_tags=config.num_labels, batch_first=True,
+                       normalizer=getattr(config, "crf_normalizer", "sequential"))
         self.lxmert = LxmertModel(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         self.classifier = nn.Linear(config.hidden_size, config.num_labels)
@@ -1,17 +1,33 @@
-from typing import List, Optional
+from typing import Optional
 
-import numpy as np
 import torch
 import torch.nn as nn
 
 
+NORMALIZERS = ('sequential', 'scan')
+# log of zero in the scan, finite: logsumexp has no gradient over entries that are all -inf
+LOG_ZERO = -10000.0
+
+
 class CRF(nn.Module):
-    def __init__(self, num_tags: int, batch_first: bool = False) -> None:
+    """
+    Linear-chain CRF. `normalizer` picks how the partition function is computed: ``sequential`` runs the forward
+    algorithm one timestep at a time, ``scan`` multiplies the per-timestep transition matrices in the log semiring
+    as a balanced tree, in log2(seq_length) steps. `scan_chunk_size` bounds how many matrix products of
+    (batch_size, num_tags, num_tags, num_tags) scores the scan holds at once.
+    """
+
+    def __init__(self, num_tags: int, batch_first: bool = False, normalizer: str = 'sequential',
+                 scan_chunk_size: int = 64) -> None:
         if num_tags <= 0:
             raise ValueError(f'invalid number of tags: {num_tags}')
+        if normalizer not in NORMALIZERS:
+            raise ValueError(f'invalid normalizer: {normalizer}')
         super().__init__()
         self.num_tags = num_tags
         self.batch_first = batch_first
+        self.normalizer = normalizer
+        self.scan_chunk_size = scan_chunk_size
         self.start_transitions = nn.Parameter(torch.empty(num_tags))
         self.end_transitions = nn.Parameter(torch.empty(num_tags))
         self.transitions = nn.Parameter(torch.empty(num_tags, num_tags))
@@ -28,7 +44,7 @@ class CRF(nn.Module):
         nn.init.uniform_(self.transitions, -0.1, 0.1)
 
     def __repr__(self) -> str:
-        return f'{self.__class__.__name__}(num_tags={self.num_tags})'
+        return f'{self.__class__.__name__}(num_tags={self.num_tags}, normalizer={self.normalizer})'
 
     def forward(
             self,
@@ -76,7 +92,10 @@ class CRF(nn.Module):
         # shape: (batch_size,)
         numerator = self._compute_score(emissions, tags, mask)
         # shape: (batch_size,)
-        denominator = self._compute_normalizer(emissions, mask)
+        if self.normalizer == 'scan':
+            denominator = self._compute_normalizer_scan(emissions, mask)
+        else:
+            denominator = self._compute_normalizer(emissions, mask)
         # shape: (batch_size,)
         llh = numerator - denominator
 
@@ -90,7 +109,7 @@ class CRF(nn.Module):
         return llh.sum() / mask.float().sum()
 
     def decode(self, emissions: torch.Tensor,
-               mask: Optional[torch.ByteTensor] = None) -> List[List[int]]:
+               mask: Optional[torch.ByteTensor] = None) -> torch.LongTensor:
         """Find the most likely tag sequence using Viterbi algorithm.
         Args:
             emissions (`~torch.Tensor`): Emission score tensor of size
@@ -99,7 +118,8 @@ class CRF(nn.Module):
             mask (`~torch.ByteTensor`): Mask tensor of size ``(seq_length, batch_size)``
                 if ``batch_first`` is ``False``, ``(batch_size, seq_length)`` otherwise.
         Returns:
-            List of list containing the best tag sequence for each batch.
+            `~torch.LongTensor` of size ``(batch_size, seq_length)`` on the device of ``emissions``,
+            containing the best tag sequence for each batch, padded with -1.
         """
         self._validate(emissions, mask=mask)
         if mask is None:
@@ -152,21 +172,20 @@ class CRF(nn.Module):
         assert mask[0].bool().all()
 
         seq_length, batch_size = tags.shape
-        mask = mask.float()
+        mask = mask.to(emissions.dtype)
 
         # Start transition score and first emission
         # shape: (batch_size,)
         score = self.start_transitions[tags[0]]
-        score += emissions[0, torch.arange(batch_size), tags[0]]
-
-        for i in range(1, seq_length):
-            # Transition score to next tag, only added if next timestep is valid (mask == 1)
-            # shape: (batch_size,)
-            score += self.transitions[tags[i - 1], tags[i]] * mask[i]
+        score = score + emissions[0, torch.arange(batch_size), tags[0]]
 
-            # Emission score for next tag, only added if next timestep is valid (mask == 1)
-            # shape: (batch_size,)
-            score += emissions[i, torch.arange(batch_size), tags[i]] * mask[i]
+        # Transition and emission scores of all the next timesteps at once, only added where the timestep is
+        # valid (mask == 1)
+        # shape: (seq_length - 1, batch_size)
+        transition_scores = self.transitions[tags[:-1], tags[1:]]
+        # shape: (seq_length - 1, batch_size)
+        emission_scores = emissions[1:].gather(2, tags[1:].unsqueeze(2)).squeeze(2)
+        score = score + ((transition_scores + emission_scores) * mask[1:]).sum(dim=0)
 
         # End transition score
         # shape: (batch_size,)
@@ -174,7 +193,7 @@ class CRF(nn.Module):
         # shape: (batch_size,)
         last_tags = tags[seq_ends, torch.arange(batch_size)]
         # shape: (batch_size,)
-        score += self.end_transitions[last_tags]
+        score = score + self.end_transitions[last_tags]
 
         return score
 
@@ -230,8 +249,49 @@ class CRF(nn.Module):
         # shape: (batch_size,)
         return torch.logsumexp(score, dim=1)
 
+    def _compute_normalizer_scan(
+            self, emissions: torch.Tensor, mask: torch.ByteTensor) -> torch.Tensor:
+        # emissions: (seq_length, batch_size, num_tags)
+        # mask: (seq_length, batch_size)
+        assert emissions.dim() == 3 and mask.dim() == 2
+        assert emissions.shape[:2] == mask.shape
+        assert emissions.size(2) == self.num_tags
+        assert mask[0].bool().all()
+        mask = mask.bool()
+
+        # Score of moving from tag i to tag j and emitting j at every next timestep, the matrices of the masked
+        # timesteps are the identity of the log semiring (0 on the diagonal, LOG_ZERO elsewhere)
+        # shape: (seq_length - 1, batch_size, num_tags, num_tags)
+        steps = self.transitions + emissions[1:].unsqueeze(2)
+        identity = torch.full((self.num_tags, self.num_tags), LOG_ZERO, dtype=emissions.dtype,
+                              device=emissions.device).fill_diagonal_(0)
+        steps = torch.where(mask[1:].unsqueeze(2).unsqueeze(3), steps, identity)
+
+        # Multiply neighbouring matrices pairwise until one is left: entry (i, j) of the product stores the sum of
+        # scores of all the tag sequences between the first and the last timestep that start in i and end in j
+        while steps.size(0) > 1:
+            if steps.size(0) % 2:
+                steps = torch.cat([steps, identity.expand(1, *steps.shape[1:])])
+            steps = torch.cat([log_matmul(left, right) for left, right in
+                               zip(steps[0::2].split(self.scan_chunk_size), steps[1::2].split(self.scan_chunk_size))])
+
+        # Start transition score and first emission
+        # shape: (batch_size, num_tags)
+        score = self.start_transitions + emissions[0]
+        if steps.size(0):
+            # shape: (batch_size, num_tags)
+            score = torch.logsumexp(score.unsqueeze(2) + steps[0], dim=1)
+
+        # End transition score
+        # shape: (batch_size, num_tags)
+        score = score + self.end_transitions
+
+        # Sum (log-sum-exp) over all possible tags
+        # shape: (batch_size,)
+        return torch.logsumexp(score, dim=1)
+
     def _viterbi_decode(self, emissions: torch.FloatTensor,
-                        mask: torch.ByteTensor) -> List[List[int]]:
+                        mask: torch.ByteTensor) -> torch.LongTensor:
         # emissions: (seq_length, batch_size, num_tags)
         # mask: (seq_length, batch_size)
         assert emissions.dim() == 3 and mask.dim() == 2
@@ -284,27 +344,34 @@ class CRF(nn.Module):
         # shape: (batch_size, num_tags)
         score += self.end_transitions
 
-        # Now, compute the best path for each sample
+        # Now, trace back the best path of every sample at once, keeping everything on device
 
         # shape: (batch_size,)
         seq_ends = mask.long().sum(dim=0) - 1
-        best_tags_list = []
-
-        for idx in range(batch_size):
-            # Find the tag which maximizes the score at the last timestep; this is our best tag
-            # for the last timestep
-            _, best_last_tag = score[idx].max(dim=0)
-            best_tags = [best_last_tag.item()]
-
-            # We trace back where the best last tag comes from, append that to our best tag
-            # sequence, and trace it back again, and so on
-            for hist in reversed(history[:seq_ends[idx]]):
-                best_last_tag = hist[idx][best_tags[-1]]
-                best_tags.append(best_last_tag.item())
-
-            # Reverse the order because we start from the last timestep
-            best_tags.reverse()
-            best_tags_list.append(best_tags)
-        best_tags_list = [item + [-1] * (seq_length - len(item)) for item in best_tags_list]
-        best_tags_list = torch.from_numpy(np.array(best_tags_list))
-        return torch.LongTensor(best_tags_list).cuda()
+        # Find the tag which maximizes the score at the last timestep; this is our best tag
+        # for the last timestep
+        # shape: (batch_size,)
+        _, best_last_tags = score.max(dim=1)
+        # shape: (seq_length, batch_size)
+        best_tags = torch.full_like(mask, -1, dtype=torch.long)
+        best_tags_cur = best_last_tags
+
+        for i in range(seq_length - 1, -1, -1):
+            # A sample joins the trace back at its own last timestep
+            best_tags_cur = torch.where(seq_ends == i, best_last_tags, best_tags_cur)
+            active = seq_ends >= i
+            best_tags[i] = torch.where(active, best_tags_cur, best_tags[i])
+            if i > 0:
+                # history[i - 1] stores, for every tag at timestep i, the best tag at timestep i - 1
+                # shape: (batch_size,)
+                best_tags_prev = history[i - 1].gather(1, best_tags_cur.unsqueeze(1)).squeeze(1)
+                best_tags_cur = torch.where(active, best_tags_prev, best_tags_cur)
+
+        # shape: (batch_size, seq_length), -1 after the end of each sequence
+        return best_tags.transpose(0, 1)
+
+
+def log_matmul(left: torch.Tensor, right: torch.Tensor) -> torch.Tensor:
+    """Matrix product in the log semiring over the last two dimensions: log(exp(left) @ exp(right))."""
+    # the sum is taken over k of (..., n, k, m) scores
+    return torch.logsumexp(left.unsqueeze(-1) + right.unsqueeze(-3), dim=-2)
@@ -34,6 +34,7 @@ from seqeval.metrics import f1_score
 import torch
 from torch.utils.data.distributed import DistributedSampler
 from utils.utils_ner import MMNerTask_Grid,MMNerTask_Object,MMNerDataset, MMNerTask_Pixel
+from utils.utils_ner import MMNerIterableDataset, build_dataloader, log_padding_ratio, main_process_first
 from transformers import (
     AutoConfig,
     AutoModelForTokenClassification,
@@ -52,20 +53,20 @@ except ImportError:
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 
 logger = logging.getLogger(__name__)
-from ObjectFeatureExtractor import frcnn,frcnn_cfg
+import ObjectFeatureExtractor
+from ObjectFeatureExtractor import build_object_feature_store, object_visual_inputs
+from GridFeatureExtractor import build_grid_feature_store, grid_visual_inputs, load_grid_encoder
+from utils.utils_feature_store import FeatureStore, check_feature_store, store_lock
 
-from utils.utils_metrics import get_entities_bio, f1_score, classification_report
+from utils.utils_metrics import EntityMetrics
+from NerPredictor import NerPredictor, load_trained_weights
 
 #在这里编写evaluate代码.
 #
-def evaluate_Object(args, eval_dataset, model,encoder,encoder_cfg,labels, pad_token_label_id,prefix=""):
+def evaluate_Object(args, eval_dataset, model,encoder,encoder_cfg,labels, pad_token_label_id,prefix="",feature_store=None):
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-    # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset,
-                                 sampler=eval_sampler,
-                                 batch_size=args.eval_batch_size)
+    eval_dataloader = build_dataloader(eval_dataset, args.eval_batch_size, local_rank=args.local_rank)
 
     # multi-gpu evaluate
     if args.n_gpu > 1 and not isinstance(model, torch.nn.DataParallel):
@@ -75,10 +76,10 @@ def evaluate_Object(args, eval_dataset, model,encoder,encoder_cfg,labels, pad_to
     logger.info("***** Running evaluation %s *****")
     logger.info("  Num examples = %d", len(eval_dataset))
     logger.info("  Batch size = %d", args.eval_batch_size)
+    log_padding_ratio(eval_dataloader, args.max_seq_length)
     eval_loss = 0.0
     nb_eval_steps = 0
-    preds = None
-    trues = None
+    metrics = EntityMetrics(labels, pad_token_label_id)
     model.eval()
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
         batch = tuple(t.to(args.device) for t in batch)
@@ -91,56 +92,29 @@ def evaluate_Object(args, eval_dataset, model,encoder,encoder_cfg,labels, pad_to
                 "valid_mask": batch[2],
                 "segment_ids": batch[3],
                 "label_ids": batch[4],
-                "image": batch[5],
-                "sizes": batch[6],
-                "scales_yx": batch[7]
             }
-            # todo 将图片变成输入的特征
-            output_dict = encoder(
-                inputs['images'],
-                inputs['sizes'],
-                inputs['scales_yx'],
-                padding="max_detections",
-                max_detections=encoder_cfg.max_detections,
-                return_tensors='pt'
-            )
-            inputs.pop('image')
-            inputs.pop('sizes')
-            inputs.pop('scales_yx')
-            inputs['features'] = output_dict.get('roi_features')
-            inputs['normalized_boxes'] = output_dict.get('normalized_boxes')
+            if feature_store is not None:
+                inputs["img_index"] = batch[5]
+            else:
+                inputs.update({"image": batch[5], "sizes": batch[6], "scales_yx": batch[7]})
+            # 将图片变成输入的特征
+            inputs = object_visual_inputs(inputs, encoder, encoder_cfg, feature_store)
 
-            outputs = model(**inputs)
+            # Viterbi paths rather than the emissions, as NerPredictor.tag_ids
+            outputs = model(**inputs, decode=True)
             tmp_eval_loss, tags = outputs[:2]
             if args.n_gpu > 1:
                 tmp_eval_loss = tmp_eval_loss.mean()  # mean() to average on multi-gpu parallel evaluating
             eval_loss += tmp_eval_loss.item()
         nb_eval_steps += 1
-        if preds is None:
-            preds = np.array(tags)
-            trues = inputs["labels"].detach().cpu().numpy()
-        else:
-            preds = np.append(preds, np.array(tags), axis=0)
-            trues = np.append(trues, inputs["labels"].detach().cpu().numpy(), axis=0)
+        # only the entity counts of the batch are kept
+        metrics.update(batch[4].detach().cpu().numpy(), tags.detach().cpu().numpy())
 
     eval_loss = eval_loss / nb_eval_steps
-    label_map = {i: label for i, label in enumerate(labels)}
-
-    trues_list = [[] for _ in range(trues.shape[0])]
-    preds_list = [[] for _ in range(preds.shape[0])]
-
-    for i in range(trues.shape[0]):
-        for j in range(trues.shape[1]):
-            if trues[i, j] != pad_token_label_id:
-                trues_list[i].append(label_map[trues[i][j]])
-                preds_list[i].append(label_map[preds[i][j]])
-
-    true_entities = get_entities_bio(trues_list)
-    pred_entities = get_entities_bio(preds_list)
     results = {
         "loss": eval_loss,
-        "f1": f1_score(true_entities, pred_entities),
-        'report': classification_report(true_entities, pred_entities)
+        "f1": metrics.f1(),
+        'report': metrics.report()
     }
 
     output_eval_file = os.path.join(args.output_dir, "eval_results.txt")
@@ -155,16 +129,12 @@ def evaluate_Object(args, eval_dataset, model,encoder,encoder_cfg,labels, pad_to
                 continue
             logger.info("{} = {}".format(key, str(results[key])))
             writer.write("{} = {}\n".format(key, str(results[key])))
-    return results, preds_list
+    return results, metrics
 
-def evaluate_Grid(args, eval_dataset,model,encoder,labels, pad_token_label_id,  prefix=""):
+def evaluate_Grid(args, eval_dataset,model,encoder,labels, pad_token_label_id,  prefix="",feature_store=None):
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-    # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset,
-                                 sampler=eval_sampler,
-                                 batch_size=args.eval_batch_size)
+    eval_dataloader = build_dataloader(eval_dataset, args.eval_batch_size, local_rank=args.local_rank)
 
     # multi-gpu evaluate
     if args.n_gpu > 1 and not isinstance(model, torch.nn.DataParallel):
@@ -174,10 +144,10 @@ def evaluate_Grid(args, eval_dataset,model,encoder,labels, pad_token_label_id,
     logger.info("***** Running evaluation %s *****", prefix)
     logger.info("  Num examples = %d", len(eval_dataset))
     logger.info("  Batch size = %d", args.eval_batch_size)
+    log_padding_ratio(eval_dataloader, args.max_seq_length)
     eval_loss = 0.0
     nb_eval_steps = 0
-    preds = None
-    trues = None
+    metrics = EntityMetrics(labels, pad_token_label_id)
     model.eval()
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
         batch = tuple(t.to(args.device) for t in batch)
@@ -189,43 +159,24 @@ def evaluate_Grid(args, eval_dataset,model,encoder,labels, pad_token_label_id,
                 "valid_mask": batch[2],
                 "segment_ids": batch[3],
                 "label_ids": batch[4],
-                "image": batch[5],
+                "img_index" if feature_store is not None else "image": batch[5],
             }
-            image_features, image_means, image_attention = encoder(inputs['image'])
-            inputs.pop('image')
-            image_attention = image_attention.view(-1, 2048, 49).permute(0, 2, 1)  # self.batch_size, 49, 2048
-            inputs['visual_embeds_att'] = image_attention
-            outputs = model(**inputs)
+            inputs = grid_visual_inputs(inputs, encoder, feature_store)
+            # Viterbi paths rather than the emissions, as NerPredictor.tag_ids
+            outputs = model(**inputs, decode=True)
             tmp_eval_loss, tags = outputs[:2]
             if args.n_gpu > 1:
                 tmp_eval_loss = tmp_eval_loss.mean()  # mean() to average on multi-gpu parallel evaluating
             eval_loss += tmp_eval_loss.item()
         nb_eval_steps += 1
-        if preds is None:
-            preds = np.array(tags)
-            trues = inputs["labels"].detach().cpu().numpy()
-        else:
-            preds = np.append(preds, np.array(tags), axis=0)
-            trues = np.append(trues, inputs["labels"].detach().cpu().numpy(), axis=0)
+        # only the entity counts of the batch are kept
+        metrics.update(batch[4].detach().cpu().numpy(), tags.detach().cpu().numpy())
 
     eval_loss = eval_loss / nb_eval_steps
-    label_map = {i: label for i, label in enumerate(labels)}
-
-    trues_list = [[] for _ in range(trues.shape[0])]
-    preds_list = [[] for _ in range(preds.shape[0])]
-
-    for i in range(trues.shape[0]):
-        for j in range(trues.shape[1]):
-            if trues[i, j] != pad_token_label_id:
-                trues_list[i].append(label_map[trues[i][j]])
-                preds_list[i].append(label_map[preds[i][j]])
-
-    true_entities = get_entities_bio(trues_list)
-    pred_entities = get_entities_bio(preds_list)
     results = {
         "loss": eval_loss,
-        "f1": f1_score(true_entities, pred_entities),
-        'report': classification_report(true_entities, pred_entities)
+        "f1": metrics.f1(),
+        'report': metrics.report()
     }
 
     output_eval_file = os.path.join(args.output_dir, "eval_results.txt")
@@ -240,18 +191,15 @@ def evaluate_Grid(args, eval_dataset,model,encoder,labels, pad_token_label_id,
                 continue
             logger.info("{} = {}".format(key, str(results[key])))
             writer.write("{} = {}\n".format(key, str(results[key])))
-    return results, preds_list
+    return results, metrics
 
-def train_Object(args, train_dataset, model,encoder,encoder_cfg,tokenizer, labels, pad_token_label_id):
+def train_Object(args, train_dataset, model,encoder,encoder_cfg,tokenizer, labels, pad_token_label_id,feature_store=None):
     if args.local_rank in [-1, 0]:
         tb_writer = SummaryWriter(args.output_dir)
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset,
-                                  sampler=train_sampler,
-                                  batch_size=args.train_batch_size,
-                                  )
+    train_dataloader = build_dataloader(train_dataset, args.train_batch_size, train=True,
+                                        local_rank=args.local_rank, bucketing=args.dynamic_padding, seed=args.seed)
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -308,6 +256,7 @@ def train_Object(args, train_dataset, model,encoder,encoder_cfg,tokenizer, label
     )
     logger.info("  Gradient Accumulation steps = %d", args.gradient_accumulation_steps)
     logger.info("  Total optimization steps = %d", t_total)
+    log_padding_ratio(train_dataloader, args.max_seq_length)
     #whether to frozen the visual encoder
     if args.frozen_encoder is True:
         for param in encoder.base_model.parameters():
@@ -355,24 +304,13 @@ def train_Object(args, train_dataset, model,encoder,encoder_cfg,tokenizer, label
                 "valid_mask":batch[2],
                 "segment_ids":batch[3],
                 "label_ids":batch[4],
-                "image":batch[5],
-                "sizes":batch[6],
-                "scales_yx":batch[7]
             }
-            #todo 将图片变成输入的特征
-            output_dict = encoder(
-                inputs['images'],
-                inputs['sizes'],
-                inputs['scales_yx'],
-                padding="max_detections",
-                max_detections=encoder_cfg.max_detections,
-                return_tensors='pt'
-            )
-            inputs.pop('image')
-            inputs.pop('sizes')
-            inputs.pop('scales_yx')
-            inputs['features'] = output_dict.get('roi_features')
-            inputs['normalized_boxes'] = output_dict.get('normalized_boxes')
+            if feature_store is not None:
+                inputs["img_index"] = batch[5]
+            else:
+                inputs.update({"image": batch[5], "sizes": batch[6], "scales_yx": batch[7]})
+            #将图片变成输入的特征
+            inputs = object_visual_inputs(inputs, encoder, encoder_cfg, feature_store)
 
             #todo:将inputs组织成模型可以接受的输入
             outputs = model(**inputs)
@@ -447,16 +385,13 @@ def train_Object(args, train_dataset, model,encoder,encoder_cfg,tokenizer, label
 
     return global_step, tr_loss / global_step
 
-def train_Grid(args, train_dataset, model,encoder,tokenizer, labels, pad_token_label_id):
+def train_Grid(args, train_dataset, model,encoder,tokenizer, labels, pad_token_label_id,feature_store=None):
     if args.local_rank in [-1, 0]:
         tb_writer = SummaryWriter(args.output_dir)
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset,
-                                  sampler=train_sampler,
-                                  batch_size=args.train_batch_size,
-                                  )
+    train_dataloader = build_dataloader(train_dataset, args.train_batch_size, train=True,
+                                        local_rank=args.local_rank, bucketing=args.dynamic_padding, seed=args.seed)
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -513,6 +448,7 @@ def train_Grid(args, train_dataset, model,encoder,tokenizer, labels, pad_token_l
     )
     logger.info("  Gradient Accumulation steps = %d", args.gradient_accumulation_steps)
     logger.info("  Total optimization steps = %d", t_total)
+    log_padding_ratio(train_dataloader, args.max_seq_length)
     #whether to frozen the visual encoder
     if args.frozen_encoder is True:
         for param in encoder.base_model.parameters():
@@ -560,12 +496,9 @@ def train_Grid(args, train_dataset, model,encoder,tokenizer, labels, pad_token_l
                 "valid_mask": batch[2],
                 "segment_ids": batch[3],
                 "label_ids": batch[4],
-                "image": batch[5],
+                "img_index" if feature_store is not None else "image": batch[5],
             }
-            image_features,image_means,image_attention =encoder(inputs['image'])
-            inputs.pop('image')
-            image_attention = image_attention.view(-1, 2048, 49).permute(0, 2, 1)  # self.batch_size, 49, 2048
-            inputs['visual_embeds_att'] = image_attention
+            inputs = grid_visual_inputs(inputs, encoder, feature_store)
             outputs = model(**inputs)
             loss = outputs[0]  # model outputs are always tuple in pytorch-transformers (see doc)
 
@@ -663,15 +596,13 @@ def main():
     args = MMArgument(model_args,data_args,training_args)
     # 定义数据读取类
     if args.feature_type is 'Object':
-        token_classification_task = MMNerTask_Object()
-        encoder = frcnn
-        encoder_cfg = frcnn_cfg
+        token_classification_task = MMNerTask_Object(args.image_batch_size, args.num_image_workers)
+        if args.frcnn_model_path:
+            ObjectFeatureExtractor.FRCNN_MODEL_PATH = args.frcnn_model_path
     elif args.feature_type is 'Grid':
-        net = getattr(resnet, 'resnet152')()
-        resnet_root = "GridFeature/resnet/"
-        net.load_state_dict(torch.load(os.path.join(resnet_root, 'resnet152.pth')))
-        encoder = myResnet(net, args.fine_tune_cnn, args.device)
-        token_classification_task = MMNerTask_Grid()
+        token_classification_task = MMNerTask_Grid(args.crop_size)
+        # without fine-tuning the frozen ResNet only runs once, to build the grid feature store
+        encoder = load_grid_encoder(args.fine_tune_cnn, args.device) if args.fine_tune_cnn else None
     else:
         token_classification_task = MMNerTask_Pixel()
     # Setup logging
@@ -696,6 +627,47 @@ def main():
         args.path_image = "data/twitter2017_images/"
     elif args.task_name == "twitter2015":
         args.path_image = "data/twitter2015_images/"
+    # Precompute the detector outputs once, training and evaluation then read them from disk
+    feature_store = None
+    # the local main process builds the stores, the other ranks wait and then open them
+    with main_process_first(args.local_rank):
+        if args.feature_type == 'Object' and args.object_feature_store:
+            # a store in another precision is built next to the float32 one, as for the grid features
+            object_feature_store = args.object_feature_store if args.feature_precision == "float32" else \
+                "{}_{}".format(args.object_feature_store.rstrip(os.sep), args.feature_precision)
+            img_ids = token_classification_task.get_img_ids(args.data_dir)
+            with store_lock(object_feature_store):
+                if not FeatureStore.exists(object_feature_store):
+                    logger.info("Building the region feature store for %d images in %s", len(img_ids),
+                                object_feature_store)
+                    build_object_feature_store(img_ids, args.path_image, object_feature_store,
+                                               batch_size=args.per_gpu_eval_batch_size,
+                                               precision=args.feature_precision)
+            feature_store = FeatureStore(object_feature_store)
+            check_feature_store(feature_store, img_ids, precisions={'roi_features': args.feature_precision},
+                                config={'frcnn_model_path': ObjectFeatureExtractor.FRCNN_MODEL_PATH})
+        elif args.feature_type == 'Grid' and not args.fine_tune_cnn:
+            grid_precision = "float16" if args.grid_feature_fp16 and args.feature_precision == "float32" \
+                else args.feature_precision
+            grid_feature_store = args.grid_feature_store or os.path.join(
+                args.data_dir, "cached_grid_features" + ("" if grid_precision == "float32" else "_" + grid_precision))
+            img_ids = token_classification_task.get_img_ids(args.data_dir)
+            with store_lock(grid_feature_store):
+                if not FeatureStore.exists(grid_feature_store):
+                    logger.info("Building the grid feature store for %d images in %s", len(img_ids), grid_feature_store)
+                    build_grid_feature_store(img_ids, args.path_image, grid_feature_store,
+                                             load_grid_encoder(False, args.device), crop_size=args.crop_size,
+                                             batch_size=args.per_gpu_eval_batch_size, precision=grid_precision)
+            feature_store = FeatureStore(grid_feature_store)
+            check_feature_store(feature_store, img_ids, precisions={'att': grid_precision},
+                                config={'crop_size': args.crop_size, 'crop': 'center'})
+    if feature_store is not None:
+        logger.info("Reading the visual features from %s, stored as %s", feature_store.store_dir,
+                    feature_store.precisions)
+    if args.feature_type == 'Object':
+        encoder_cfg = ObjectFeatureExtractor.get_frcnn_cfg()
+        # the detector weights are only needed when the region features are not precomputed
+        encoder = ObjectFeatureExtractor.get_frcnn() if feature_store is None else None
     # Prepare CONLL-2003 task
     labels = token_classification_task.get_labels(args.labels)
     label_map: Dict[int, str] = {i: label for i, label in enumerate(labels)}
@@ -713,6 +685,7 @@ def main():
         id2label=label_map,
         label2id={label: i for i, label in enumerate(labels)},
         cache_dir=args.cache_dir,
+        crf_normalizer=args.crf_normalizer,
     )
     tokenizer = AutoTokenizer.from_pretrained(
         args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
@@ -725,41 +698,57 @@ def main():
         config=config,
     )
     model.to(args.device)
-    # Get datasets
-    eval_dataset = (
-        MMNerDataset(
-            token_classification_task=token_classification_task,
-            data_dir=args.data_dir,
-            tokenizer=tokenizer,
-            labels=labels,
-            model_type=config.model_type,
-            max_seq_length=args.max_seq_length,
-            overwrite_cache=args.overwrite_cache,
-            mode=Split.dev,
+    # Get datasets, the streaming variant converts the splits chunk by chunk instead of all at once
+    dataset_class = MMNerDataset
+    dataset_kwargs = dict(num_workers=args.conversion_workers, shard_size=args.conversion_shard_size)
+    if args.streaming:
+        dataset_class = MMNerIterableDataset
+        dataset_kwargs = dict(chunk_size=args.stream_chunk_size, write_through=args.stream_write_through,
+                              seed=args.seed)
+    # only the local main process converts, the other ranks wait and then memory-map its caches
+    overwrite_cache = args.overwrite_cache and args.local_rank in [-1, 0]
+    with main_process_first(args.local_rank):
+        eval_dataset = (
+            dataset_class(
+                token_classification_task=token_classification_task,
+                data_dir=args.data_dir,
+                tokenizer=tokenizer,
+                labels=labels,
+                model_type=config.model_type,
+                max_seq_length=args.max_seq_length,
+                overwrite_cache=overwrite_cache,
+                mode=Split.dev,
+                feature_store=feature_store,
+                dynamic_padding=args.dynamic_padding,
+                **dataset_kwargs,
+            )
+            if args.do_eval
+            else None
         )
-        if args.do_eval
-        else None
-    )
-    if args.do_train:
         train_dataset = (
-            MMNerDataset(
+            dataset_class(
                 token_classification_task=token_classification_task,
                 data_dir=args.data_dir,
                 tokenizer=tokenizer,
                 labels=labels,
                 model_type=config.model_type,
                 max_seq_length=args.max_seq_length,
-                overwrite_cache=args.overwrite_cache,
+                overwrite_cache=overwrite_cache,
                 mode=Split.train,
+                feature_store=feature_store,
+                dynamic_padding=args.dynamic_padding,
+                **dataset_kwargs,
             )
             if args.do_train
             else None
         )
+    if args.do_train:
         if args.feature_type is 'Object':
-            global_step, tr_loss = train_Object(args, train_dataset, model, frcnn, frcnn_cfg, tokenizer, labels)
+            global_step, tr_loss = train_Object(args, train_dataset, model, encoder, encoder_cfg, tokenizer, labels,
+                                                pad_token_label_id, feature_store=feature_store)
         elif args.feature_type is 'Grid':
             global_step, tr_loss = train_Grid(args, train_dataset, model, encoder, tokenizer, labels,
-                                              pad_token_label_id)
+                                              pad_token_label_id, feature_store=feature_store)
         logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
 
     ##
@@ -783,19 +772,31 @@ def main():
 
     if args.do_eval and args.local_rank in [-1, 0]:
         if args.feature_type is 'Object':
-            results, _ = evaluate_Object(args, model, frcnn, frcnn_cfg, labels, pad_token_label_id, prefix='dev')
+            results, _ = evaluate_Object(args, eval_dataset, model, encoder, encoder_cfg, labels, pad_token_label_id,
+                                          prefix='dev', feature_store=feature_store)
             output_eval_file = os.path.join(args.output_dir, "eval_results.txt")
             with open(output_eval_file, "a") as writer:
                 writer.write('***** Predict in dev dataset *****')
                 writer.write("{} = {}\n".format('report', str(results['report'])))
         elif args.feature_type is 'Grid':
-            results, _ = evaluate_Grid(args, model, encoder, labels, pad_token_label_id,
-                                       prefix='dev')
+            results, _ = evaluate_Grid(args, eval_dataset, model, encoder, labels, pad_token_label_id,
+                                       prefix='dev', feature_store=feature_store)
             output_eval_file = os.path.join(args.output_dir, "eval_results.txt")
             with open(output_eval_file, "a") as writer:
                 writer.write('***** Predict in dev dataset *****')
                 writer.write("{} = {}\n".format('report', str(results['report'])))
 
+    if args.do_predict and args.local_rank in [-1, 0]:
+        if not args.do_train:
+            load_trained_weights(model, args.output_dir)
+        predictor = NerPredictor(args, model, tokenizer, labels, path_image=getattr(args, "path_image", None))
+        predict_file = args.predict_file or os.path.join(args.data_dir, "test.txt")
+        predict_output = args.predict_output or os.path.join(args.output_dir, "predictions.jsonl")
+        num_tagged = predictor.predict_file(predict_file, predict_output, chunk_size=args.predict_chunk_size,
+                                            batch_size=args.per_gpu_eval_batch_size, offset=args.predict_offset,
+                                            num_image_workers=args.num_image_workers)
+        logger.info("Wrote the predictions of %d sentences of %s to %s", num_tagged, predict_file, predict_output)
+
 
 def _mp_fn(index):
     # For xla_spawn (TPUs)
@@ -0,0 +1,149 @@
+""" Long-running inference server for multimodal NER, with dynamic micro-batching of concurrent requests. """
+import base64
+import json
+import logging
+import os
+import socketserver
+import sys
+from concurrent.futures import TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from transformers import HfArgumentParser, TrainingArguments
+
+from MMArgument import DataTrainingArguments, MMArgument, ModelArguments, ServingArguments
+from NerPredictor import NerPredictor
+from utils.utils_serving import LatencyStats, MicroBatcher, Overloaded
+
+logger = logging.getLogger(__name__)
+
+"""
+USAGE:
+``python serve_ner.py --model_name_or_path bertcrf --config_name bert-base-uncased --tokenizer_name bert-base-uncased
+--output_dir <trained model dir> --task_name twitter2017 --feature_type Object --port 8080``
+
+POST /predict   {"tokens": ["RT", "@user", ...], "image": "<base64 of the jpg>"}
+                -> {"tags": ["O", "B-PER", ...], "entities": [{"type": "PER", "start": 1, "end": 1, "text": ...}]}
+                503 when max_queue_size requests are already waiting, 504 after max_wait_ms + model_timeout_s
+GET  /stats     request, batch, error, rejected and expired counts, throughput, p50/p99 latency (ms) and mean
+                micro-batch size
+GET  /health
+"""
+
+
+class NerRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, clients reuse their connection
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send(200, self.server.batcher.stats.snapshot())
+        elif self.path == "/health":
+            self._send(200, {"status": "ok"})
+        else:
+            self._send(404, {"error": "unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send(404, {"error": "unknown path {}".format(self.path)})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            tokens = request["tokens"]
+            assert isinstance(tokens, list) and all(isinstance(token, str) for token in tokens), \
+                "tokens must be a list of strings"
+            image_bytes = base64.b64decode(request["image"]) if request.get("image") else None
+        except Exception as e:
+            self._send(400, {"error": str(e)})
+            return
+        try:
+            # images are decoded on the request threads, only the model runs in the micro-batches
+            result = self.server.batcher((tokens, self.server.predictor.decode_image(image_bytes)),
+                                         timeout=self.server.request_timeout)
+        except Overloaded as e:
+            logger.warning("Rejected a request: %s", e)
+            self._send(503, {"error": "the server is overloaded, {}".format(e)})
+            return
+        except TimeoutError:
+            logger.warning("Prediction timed out after %.1f s", self.server.request_timeout)
+            self._send(504, {"error": "prediction timed out after {:.1f} s".format(self.server.request_timeout)})
+            return
+        except Exception as e:
+            logger.exception("Prediction failed")
+            self._send(500, {"error": str(e)})
+            return
+        self._send(200, result)
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # clients of a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(serving_args, predictor, batcher):
+    if serving_args.unix_socket:
+        if os.path.exists(serving_args.unix_socket):
+            os.remove(serving_args.unix_socket)
+        server = ThreadingUnixHTTPServer(serving_args.unix_socket, NerRequestHandler)
+    else:
+        server = ThreadingHTTPServer((serving_args.host, serving_args.port), NerRequestHandler)
+        server.daemon_threads = True
+    server.predictor = predictor
+    server.batcher = batcher
+    # a request waits for its micro-batch to fill, then for the model
+    server.request_timeout = serving_args.max_wait_ms / 1000 + serving_args.model_timeout_s
+    return server
+
+
+def main():
+    parser = HfArgumentParser((ModelArguments, DataTrainingArguments, TrainingArguments, ServingArguments))
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        model_args, data_args, training_args, serving_args = parser.parse_json_file(
+            json_file=os.path.abspath(sys.argv[1]))
+    else:
+        model_args, data_args, training_args, serving_args = parser.parse_args_into_dataclasses()
+    args = MMArgument(model_args, data_args, training_args)
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    if args.task_name == "twitter2017":
+        args.path_image = "data/twitter2017_images/"
+    elif args.task_name == "twitter2015":
+        args.path_image = "data/twitter2015_images/"
+
+    predictor = NerPredictor.from_args(args, serving_args.checkpoint_dir, path_image=getattr(args, "path_image", None))
+    batcher = MicroBatcher(predictor.predict_decoded, max_batch_size=serving_args.max_batch_size,
+                           max_wait_ms=serving_args.max_wait_ms, stats=LatencyStats(),
+                           max_queue_size=serving_args.max_queue_size)
+    server = make_server(serving_args, predictor, batcher)
+    logger.info("Serving on %s, micro-batches of up to %d requests, waiting at most %.1f ms",
+                serving_args.unix_socket or "http://{}:{}".format(serving_args.host, serving_args.port),
+                serving_args.max_batch_size, serving_args.max_wait_ms)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if serving_args.unix_socket and os.path.exists(serving_args.unix_socket):
+            os.remove(serving_args.unix_socket)
+        logger.info("Stats: %s", batcher.stats.snapshot())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import ObjectFeatureExtractor
+from ObjectFeature.utils import Config
+from utils.utils_feature_store import config_fingerprint
+from utils.utils_ner import MMNerTask_Object
+
+FRCNN_CFG = {
+    "INPUT": {"MIN_SIZE_TEST": 800, "MAX_SIZE_TEST": 1333, "FORMAT": "BGR"},
+    "ROI_HEADS": {"NMS_THRESH_TEST": 0.5, "SCORE_THRESH_TEST": 0.2},
+    "max_detections": 36,
+}
+
+
+def features_fingerprint(monkeypatch, cfg):
+    monkeypatch.setattr(ObjectFeatureExtractor, "get_frcnn_cfg", lambda: cfg)
+    return config_fingerprint(MMNerTask_Object().cache_config())
+
+
+def test_nested_frcnn_values_change_the_fingerprint(monkeypatch):
+    reference = features_fingerprint(monkeypatch, Config(FRCNN_CFG))
+    assert features_fingerprint(monkeypatch, Config(FRCNN_CFG)) == reference
+
+    cfg = Config(FRCNN_CFG)
+    cfg.INPUT.MIN_SIZE_TEST = 600
+    assert features_fingerprint(monkeypatch, cfg) != reference
+
+    cfg = Config(FRCNN_CFG)
+    cfg.ROI_HEADS.NMS_THRESH_TEST = 0.3
+    assert features_fingerprint(monkeypatch, cfg) != reference
+
+
+def test_plain_dict_of_the_frcnn_config():
+    cfg = Config(FRCNN_CFG)
+    cfg.INPUT.MIN_SIZE_TEST = 600
+    assert cfg.to_plain_dict() == dict(FRCNN_CFG, INPUT=dict(FRCNN_CFG["INPUT"], MIN_SIZE_TEST=600))
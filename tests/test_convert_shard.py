@@ -0,0 +1,40 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from utils.utils_ner import MMNerTask_Object, ShardedFeatures, convert_features_sharded
+
+LOCAL_FRCNN_MODEL_PATH = "/models/frcnn-local"
+
+
+class PathRecordingTask(MMNerTask_Object):
+    """Writes the detector path seen by the worker next to the data instead of running the detector."""
+
+    def convert_examples_to_features(self, examples, label_list, max_seq_length, tokenizer, data_dir,
+                                     feature_store=None, image_table=None, text_features=None):
+        import ObjectFeatureExtractor
+        with open(os.path.join(data_dir, "frcnn_model_path_{}".format(os.getpid())), "w") as f:
+            f.write(ObjectFeatureExtractor.FRCNN_MODEL_PATH)
+        return [SimpleNamespace(input_ids=np.arange(3), input_mask=np.ones(3, dtype=np.int64),
+                                valid_mask=np.ones(3, dtype=np.int64), segment_ids=np.zeros(3, dtype=np.int64),
+                                label_ids=np.zeros(1, dtype=np.int64), img_index=0)
+                for _ in examples]
+
+
+def test_shards_use_the_frcnn_model_path_of_the_parent(tmp_path, monkeypatch):
+    import ObjectFeatureExtractor
+    monkeypatch.setattr(ObjectFeatureExtractor, "FRCNN_MODEL_PATH", LOCAL_FRCNN_MODEL_PATH)
+    examples = [SimpleNamespace(img_id="{}.jpg".format(i)) for i in range(4)]
+    text_features = {"input_ids": np.zeros((4, 3), dtype=np.int64)}
+
+    features = convert_features_sharded(PathRecordingTask(), examples, ["O"], 3, None, str(tmp_path),
+                                        str(tmp_path / "cached"), text_features, num_workers=2, shard_size=2)
+
+    assert isinstance(features, ShardedFeatures) and len(features) == 4
+    seen = [(tmp_path / name).read_text() for name in os.listdir(tmp_path) if name.startswith("frcnn_model_path")]
+    assert seen and all(path == LOCAL_FRCNN_MODEL_PATH for path in seen)
@@ -0,0 +1,122 @@
+import itertools
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from losses.crf import CRF
+
+NUM_TAGS = 4
+LENGTHS = [7, 3, 1, 5, 7, 2]
+
+
+def padded_batch(lengths, num_tags=NUM_TAGS, seed=0):
+    """Random batch_first emissions and the mask of `lengths`, in float64 so that both normalizers agree tightly."""
+    generator = torch.Generator().manual_seed(seed)
+    emissions = torch.randn(len(lengths), max(lengths), num_tags, generator=generator, dtype=torch.float64)
+    mask = torch.zeros(len(lengths), max(lengths), dtype=torch.uint8)
+    for row, length in enumerate(lengths):
+        mask[row, :length] = 1
+    return emissions, mask
+
+
+def make_crf(normalizer="sequential", scan_chunk_size=64, seed=0):
+    torch.manual_seed(seed)
+    crf = CRF(NUM_TAGS, batch_first=True, normalizer=normalizer, scan_chunk_size=scan_chunk_size).double()
+    # larger than the default init, so that the transitions matter for the best paths
+    for parameter in crf.parameters():
+        parameter.data.uniform_(-1, 1)
+    return crf
+
+
+def brute_force(crf, emissions, length):
+    """Partition function and best path of one sequence, over all the tag sequences of `length`."""
+    paths = torch.tensor(list(itertools.product(range(NUM_TAGS), repeat=length)))
+    scores = crf.start_transitions[paths[:, 0]] + crf.end_transitions[paths[:, -1]]
+    scores = scores + emissions[torch.arange(length), paths].sum(dim=1)
+    scores = scores + crf.transitions[paths[:, :-1], paths[:, 1:]].sum(dim=1)
+    return torch.logsumexp(scores, dim=0), paths[scores.argmax()].tolist()
+
+
+def reference_decode(crf, emissions, mask):
+    """The Viterbi decoding with one backtrace per sample, as CRF.decode did before the batched backtrace."""
+    emissions, mask = emissions.transpose(0, 1), mask.transpose(0, 1).bool()
+    score = crf.start_transitions + emissions[0]
+    history = []
+    for i in range(1, emissions.size(0)):
+        next_score, indices = (score.unsqueeze(2) + crf.transitions + emissions[i].unsqueeze(1)).max(dim=1)
+        score = torch.where(mask[i].unsqueeze(1), next_score, score)
+        history.append(indices)
+    score = score + crf.end_transitions
+    seq_ends = mask.long().sum(dim=0) - 1
+    paths = []
+    for idx in range(emissions.size(1)):
+        best_tags = [int(score[idx].argmax())]
+        for hist in reversed(history[:seq_ends[idx]]):
+            best_tags.append(int(hist[idx][best_tags[-1]]))
+        best_tags.reverse()
+        paths.append(best_tags + [-1] * (emissions.size(0) - len(best_tags)))
+    return torch.tensor(paths)
+
+
+def normalizer(crf, emissions, mask):
+    emissions, mask = emissions.transpose(0, 1), mask.transpose(0, 1)
+    if crf.normalizer == "scan":
+        return crf._compute_normalizer_scan(emissions, mask)
+    return crf._compute_normalizer(emissions, mask)
+
+
+@pytest.mark.parametrize("normalizer_name", ["sequential", "scan"])
+def test_normalizer_matches_brute_force(normalizer_name):
+    crf = make_crf(normalizer_name, scan_chunk_size=2)
+    emissions, mask = padded_batch(LENGTHS)
+    with torch.no_grad():
+        log_z = normalizer(crf, emissions, mask)
+        expected = torch.stack([brute_force(crf, emissions[row], length)[0] for row, length in enumerate(LENGTHS)])
+    assert torch.allclose(log_z, expected, atol=1e-8)
+
+
+@pytest.mark.parametrize("scan_chunk_size", [1, 2, 3, 64])
+@pytest.mark.parametrize("lengths", [LENGTHS, [33, 17, 1, 32, 9], [1, 1]])
+def test_scan_matches_sequential_on_padded_batches(scan_chunk_size, lengths):
+    sequential, scan = make_crf("sequential"), make_crf("scan", scan_chunk_size=scan_chunk_size)
+    emissions, mask = padded_batch(lengths, seed=len(lengths))
+    with torch.no_grad():
+        assert torch.allclose(normalizer(scan, emissions, mask), normalizer(sequential, emissions, mask), atol=1e-8)
+
+
+@pytest.mark.parametrize("scan_chunk_size", [1, 3])
+def test_scan_gradient_matches_sequential(scan_chunk_size):
+    sequential, scan = make_crf("sequential"), make_crf("scan", scan_chunk_size=scan_chunk_size)
+    emissions, mask = padded_batch([9, 4, 1, 8, 6])
+    tags = torch.randint(NUM_TAGS, mask.shape, generator=torch.Generator().manual_seed(1))
+    gradients = []
+    for crf in (sequential, scan):
+        emissions_ = emissions.clone().requires_grad_()
+        crf(emissions_, tags, mask, reduction="mean").backward()
+        gradients.append([emissions_.grad] + [parameter.grad for parameter in crf.parameters()])
+    for expected, actual in zip(*gradients):
+        assert torch.allclose(actual, expected, atol=1e-8)
+    # padded timesteps get no gradient
+    assert torch.all(gradients[1][0][mask == 0] == 0)
+
+
+def test_decode_matches_brute_force_and_the_per_sample_backtrace():
+    crf = make_crf()
+    emissions, mask = padded_batch(LENGTHS, seed=3)
+    with torch.no_grad():
+        tags = crf.decode(emissions, mask)
+        expected = reference_decode(crf, emissions, mask)
+    assert tags.shape == mask.shape
+    assert torch.equal(tags.cpu(), expected)
+    for row, length in enumerate(LENGTHS):
+        assert tags[row, :length].tolist() == brute_force(crf, emissions[row], length)[1]
+        assert torch.all(tags[row, length:] == -1)
+
+
+def test_decode_matches_the_per_sample_backtrace_on_long_batches():
+    crf = make_crf()
+    lengths = [40, 13, 1, 27, 40, 2, 39]
+    emissions, mask = padded_batch(lengths, seed=4)
+    with torch.no_grad():
+        assert torch.equal(crf.decode(emissions, mask).cpu(), reference_decode(crf, emissions, mask))
@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from utils.utils_feature_store import (FeatureStore, check_feature_store, convert_store, quantize_int8,
+                                       to_bfloat16_bits)
+
+IMG_IDS = ["17_06_4705.jpg", "17_05_4705.jpg", "16_05_01_12.jpg"]
+# a row of region features (detections, feature channels) and a grid (feature channels, height, width), as
+# roi_features and att, with small shapes
+FIELDS = {
+    "roi_features": ((6, 16), "float32"),
+    "att": ((8, 3, 3), "float32"),
+    "obj_ids": ((6,), "int64"),
+}
+CHANNEL_AXES = {"roi_features": -1, "att": 0}
+
+
+def random_rows(seed=0):
+    """Features whose channels differ in magnitude by up to 1e4, so that a scale shared across channels fails."""
+    rng = np.random.RandomState(seed)
+    roi = rng.randn(len(IMG_IDS), 6, 16).astype(np.float32) * np.logspace(-2, 2, 16, dtype=np.float32)
+    att = rng.randn(len(IMG_IDS), 8, 3, 3).astype(np.float32) * np.logspace(-2, 2, 8, dtype=np.float32)[:, None, None]
+    obj_ids = rng.randint(0, 1600, (len(IMG_IDS), 6))
+    return {"roi_features": roi, "att": att, "obj_ids": obj_ids}
+
+
+def build_store(store_dir, values, precisions=None, config=None):
+    writer = FeatureStore.create(str(store_dir), IMG_IDS, FIELDS, {"duplicate.jpg": 1}, precisions, CHANNEL_AXES,
+                                 config)
+    for row in range(len(IMG_IDS)):
+        writer.write(row, **{name: value[row] for name, value in values.items()})
+    writer.close()
+    return FeatureStore(str(store_dir))
+
+
+def channel_max(value, channel_axis):
+    """Max absolute value of every channel of every row of `value` (rows first), broadcastable against it."""
+    axes = tuple(axis for axis in range(1, value.ndim) if axis != channel_axis % (value.ndim - 1) + 1)
+    return np.abs(value).max(axis=axes, keepdims=True)
+
+
+def test_bfloat16_bits_round_to_nearest_even_as_torch():
+    values = np.concatenate([np.random.RandomState(0).randn(1000).astype(np.float32) * 100,
+                             np.array([0.0, -0.0, 1.0, 1.00390625, 1.01171875, 3.0e38, 1e-40], dtype=np.float32)])
+    expected = torch.from_numpy(values).to(torch.bfloat16).view(torch.int16).numpy()
+    assert np.array_equal(to_bfloat16_bits(values), expected)
+
+
+@pytest.mark.parametrize("name", ["roi_features", "att"])
+def test_int8_scales_follow_the_channel_axis(name):
+    value = random_rows()[name][0]
+    quantized, scale = quantize_int8(value, CHANNEL_AXES[name])
+    expected_shape = [1] * value.ndim
+    expected_shape[CHANNEL_AXES[name]] = value.shape[CHANNEL_AXES[name]]
+    assert quantized.dtype == np.int8 and scale.shape == tuple(expected_shape)
+    assert np.all(np.abs(quantized.astype(np.float32) * scale - value) <= scale / 2 * 1.001 + 1e-6)
+
+
+def test_int8_of_zero_channels():
+    quantized, scale = quantize_int8(np.zeros((2, 4), dtype=np.float32), -1)
+    assert np.all(quantized == 0) and np.all(scale == 1)
+
+
+@pytest.mark.parametrize("precision", ["float32", "float16", "bfloat16", "int8"])
+def test_store_round_trip(tmp_path, precision):
+    values = random_rows()
+    store = build_store(tmp_path / "store", values, {"roi_features": precision, "att": precision})
+    assert store.precisions["roi_features"] == store.precisions["att"] == precision
+    assert store.precisions["obj_ids"] == "float32"
+    outputs = store.get(store.rows(["16_05_01_12.jpg", "duplicate.jpg", "17_06_4705.jpg"]))
+    rows = [2, 1, 0]
+    assert np.array_equal(outputs["obj_ids"].numpy(), values["obj_ids"][rows])
+    for name in CHANNEL_AXES:
+        expected, actual = values[name][rows], outputs[name].numpy()
+        assert outputs[name].dtype == torch.float32 and actual.shape == expected.shape
+        if precision == "float32":
+            assert np.array_equal(actual, expected)
+        elif precision == "float16":
+            assert np.allclose(actual, expected, rtol=1e-3, atol=1e-4)
+        elif precision == "bfloat16":
+            assert np.array_equal(actual, torch.from_numpy(expected).to(torch.bfloat16).float().numpy())
+        else:
+            # per channel, the error stays within half a step of the channel's own scale
+            bound = channel_max(expected, CHANNEL_AXES[name]) / 254
+            assert np.all(np.abs(actual - expected) <= bound * 1.001 + 1e-6)
+
+
+def test_convert_store_matches_a_store_built_in_the_precision(tmp_path):
+    values = random_rows()
+    build_store(tmp_path / "float32", values, config={"crop_size": 224})
+    converted = convert_store(str(tmp_path / "float32"), str(tmp_path / "int8"),
+                              {"roi_features": "int8", "att": "int8"}, CHANNEL_AXES, batch_size=2)
+    built = build_store(tmp_path / "built", values, {"roi_features": "int8", "att": "int8"})
+    assert converted.config == {"crop_size": 224} and converted.row_map == built.row_map
+    rows = np.arange(len(IMG_IDS))
+    for name, value in converted.get(rows).items():
+        assert torch.equal(value, built.get(rows)[name])
+
+
+def test_check_feature_store_accepts_a_matching_store(tmp_path):
+    store = build_store(tmp_path / "store", random_rows(), {"roi_features": "int8"},
+                        {"frcnn_model_path": "unc-nlp/frcnn-vg-finetuned"})
+    check_feature_store(store, IMG_IDS + ["duplicate.jpg"], {"roi_features": "int8"},
+                        {"frcnn_model_path": "unc-nlp/frcnn-vg-finetuned"})
+    # stores written before the config was recorded are only checked for precision and data
+    check_feature_store(build_store(tmp_path / "old", random_rows()), IMG_IDS, {"att": "float32"},
+                        {"crop_size": 224})
+
+
+@pytest.mark.parametrize("img_ids, precisions, config, message", [
+    (IMG_IDS, {"roi_features": "float16"}, {}, "roi_features is stored as int8, not float16"),
+    (IMG_IDS, {}, {"frcnn_model_path": "/models/frcnn-local"}, "built with frcnn_model_path"),
+    (IMG_IDS, {}, {"frcnn_model_path": "unc-nlp/frcnn-vg-finetuned", "crop": "center"},
+     "it has no crop recorded, expected center"),
+    (IMG_IDS + ["17_07_1.jpg"], {}, {}, "1 img_ids of the data have no row (e.g. 17_07_1.jpg)"),
+])
+def test_check_feature_store_refuses_a_mismatch(tmp_path, img_ids, precisions, config, message):
+    store = build_store(tmp_path / "store", random_rows(), {"roi_features": "int8"},
+                        {"frcnn_model_path": "unc-nlp/frcnn-vg-finetuned"})
+    with pytest.raises(ValueError) as error:
+        check_feature_store(store, img_ids, precisions, config)
+    assert message in str(error.value) and str(tmp_path / "store") in str(error.value)
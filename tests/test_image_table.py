@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import utils.utils_feature_store as utils_feature_store
+from utils.utils_feature_store import ImageTable
+
+FAIL_IMAGE = "17_06_4705.jpg"
+
+
+@pytest.fixture
+def path_img(tmp_path):
+    for name, content in [
+        ("a.jpg", b"first image"),
+        ("a_copy.jpg", b"first image"),
+        ("b.jpg", b"other image"),  # same size as a.jpg, other content
+        ("c.jpg", b"a longer third image"),
+        (FAIL_IMAGE, b"the fail image"),
+    ]:
+        (tmp_path / name).write_bytes(content)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    """Paths hashed by the table, in order."""
+    paths = []
+    fingerprint = utils_feature_store.file_fingerprint
+
+    def recording_fingerprint(path, *args, **kwargs):
+        paths.append(path)
+        return fingerprint(path, *args, **kwargs)
+
+    monkeypatch.setattr(utils_feature_store, "file_fingerprint", recording_fingerprint)
+    return paths
+
+
+def test_duplicate_content_shares_a_row(path_img):
+    table = ImageTable()
+    row = table.add(path_img, "a.jpg", FAIL_IMAGE)
+    assert table.add(path_img, "a_copy.jpg", FAIL_IMAGE) == row
+    assert table.add(path_img, "a.jpg", FAIL_IMAGE) == row
+    assert len(table) == 1 and table.names == ["a.jpg"] and table.keys == ["a.jpg"]
+    assert table.aliases == {"a.jpg": row, "a_copy.jpg": row}
+
+
+def test_files_are_only_hashed_on_a_size_collision(path_img, hashed):
+    table = ImageTable()
+    rows = [table.add(path_img, name, FAIL_IMAGE) for name in ["a.jpg", "c.jpg", FAIL_IMAGE]]
+    assert len(set(rows)) == 3 and hashed == []
+    # b.jpg has the size of a.jpg: both are hashed once, and they differ
+    b_row = table.add(path_img, "b.jpg", FAIL_IMAGE)
+    assert b_row not in rows and len(table) == 4
+    assert sorted(os.path.basename(path) for path in hashed) == ["a.jpg", "b.jpg"]
+    # a.jpg is not hashed again for the next file of its size
+    assert table.add(path_img, "a_copy.jpg", FAIL_IMAGE) == rows[0]
+    assert [os.path.basename(path) for path in hashed[2:]] == ["a_copy.jpg"]
+
+
+def test_missing_file_maps_to_the_fail_image_row(path_img):
+    table = ImageTable()
+    fail_row = table.add(path_img, FAIL_IMAGE)
+    assert table.add(path_img, "missing.jpg", FAIL_IMAGE) == fail_row
+    assert table.aliases["missing.jpg"] == fail_row and len(table) == 1
+    # without a fail image the missing file gets a row of its own, which fails when processed
+    row = table.add(path_img, "gone.jpg")
+    assert row != fail_row and table.keys[row] == "missing:gone.jpg"
+    assert table.add(path_img, "gone_too.jpg") != row
+
+
+def test_fail_moves_every_alias_of_the_row(path_img):
+    table = ImageTable()
+    row = table.add(path_img, "a.jpg", FAIL_IMAGE)
+    table.add(path_img, "a_copy.jpg", FAIL_IMAGE)
+    other = table.add(path_img, "c.jpg", FAIL_IMAGE)
+    table.values[row] = {"image": torch.ones(2)}
+
+    fail_row = table.fail(row, path_img, FAIL_IMAGE)
+    assert fail_row not in (row, other) and table.names[fail_row] == FAIL_IMAGE
+    assert table.aliases == {"a.jpg": fail_row, "a_copy.jpg": fail_row, "c.jpg": other, FAIL_IMAGE: fail_row}
+    assert table.values[row] is None
+    # later names of the broken file go to the fail row too
+    assert table.add(path_img, "a.jpg", FAIL_IMAGE) == fail_row
+    # the fail image itself has nowhere to go
+    assert table.fail(fail_row, path_img, FAIL_IMAGE) == fail_row
+
+
+def test_columns_zero_fill_the_failed_rows():
+    table = ImageTable()
+    assert table.columns() == {}
+    table.keys, table.names, table.values = ["a", "b"], ["a.jpg", "b.jpg"], [None, None]
+    assert table.columns() == {}
+    table.values[1] = {"image": torch.ones(2, 3)}
+    columns = table.columns()
+    assert list(columns) == ["image"] and torch.equal(columns["image"][0], torch.zeros(2, 3))
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import utils.utils_ner as utils_ner
+from utils.utils_ner import MMNerIterableDataset, Split
+
+
+class FakeSplitDataset(MMNerIterableDataset):
+    """The split is range(num_examples) and the conversion drops the examples of `unreadable`."""
+
+    def __init__(self, num_examples, world_size=1, rank=0, unreadable=(), chunk_size=3):
+        examples = list(range(num_examples))
+        self.task = SimpleNamespace(iter_examples_from_file=lambda data_dir, mode: iter(examples),
+                                    count_examples_in_file=lambda data_dir, mode: len(examples))
+        self.data_dir, self.mode = None, Split.train
+        self.chunk_size, self.shuffle, self.seed, self.epoch, self._len = chunk_size, True, 0, 0, None
+        self.world_size, self.rank = world_size, rank
+        self.unreadable = set(unreadable)
+
+    def _chunk_items(self, chunk_index, examples, shard=0, num_shards=1):
+        return [example for example in examples if example not in self.unreadable]
+
+
+def shard_items(monkeypatch, num_examples, world_size, num_workers, unreadable=()):
+    """Items of every (rank, DataLoader worker)."""
+    items = {}
+    for rank in range(world_size):
+        for worker in range(num_workers):
+            monkeypatch.setattr(utils_ner, "get_worker_info",
+                                lambda: SimpleNamespace(num_workers=num_workers, id=worker))
+            items[rank, worker] = list(FakeSplitDataset(num_examples, world_size, rank, unreadable))
+    return items
+
+
+@pytest.mark.parametrize("num_examples, unreadable", [(23, ()), (24, ()), (23, (0, 4, 8, 12, 16, 5))])
+def test_every_rank_and_worker_yields_the_same_number_of_items(monkeypatch, num_examples, unreadable):
+    items = shard_items(monkeypatch, num_examples, world_size=2, num_workers=2, unreadable=unreadable)
+    assert {len(shard) for shard in items.values()} == {-(-num_examples // 4)}
+    # every readable example is there, the padding repeats some of them
+    assert set().union(*items.values()) == set(range(num_examples)) - set(unreadable)
+
+
+def test_no_padding_without_ddp(monkeypatch):
+    items = shard_items(monkeypatch, 23, world_size=1, num_workers=2, unreadable=(3, 6))
+    assert sorted(items[0, 0] + items[0, 1]) == sorted(set(range(23)) - {3, 6})
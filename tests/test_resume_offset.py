@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from NerPredictor import resume_offset
+
+
+def prediction_lines(indices):
+    return "".join(json.dumps({"index": index, "tags": ["O"]}) + "\n" for index in indices)
+
+
+@pytest.fixture
+def output(tmp_path):
+    path = tmp_path / "predictions.jsonl"
+    path.write_text(prediction_lines(range(5)))
+    return path
+
+
+def test_missing_output_starts_at_the_offset(tmp_path):
+    path = tmp_path / "predictions.jsonl"
+    assert resume_offset(str(path)) == 0
+    assert resume_offset(str(path), 7) == 7
+    assert not path.exists()
+
+
+def test_complete_output_resumes_after_its_last_line(output):
+    before = output.read_text()
+    assert resume_offset(str(output)) == 5
+    assert output.read_text() == before
+
+
+def test_torn_last_line_is_cut(output):
+    with open(output, "a") as f:
+        f.write('{"index": 5, "ta')
+    assert resume_offset(str(output)) == 5
+    assert output.read_text() == prediction_lines(range(5))
+
+
+def test_offset_below_the_last_index_cuts_the_restarted_sentences(output):
+    with open(output, "a") as f:
+        f.write('{"index": 5, "ta')
+    assert resume_offset(str(output), 2) == 2
+    assert output.read_text() == prediction_lines(range(2))
+    assert resume_offset(str(output), 0) == 0
+    assert output.read_text() == ""
+
+
+def test_offset_at_the_next_index_keeps_the_output(output):
+    assert resume_offset(str(output), 5) == 5
+    assert output.read_text() == prediction_lines(range(5))
+
+
+def test_offset_above_the_last_index_is_refused(output):
+    before = output.read_text()
+    with pytest.raises(ValueError, match="ends at sentence 5, restarting it at 8"):
+        resume_offset(str(output), 8)
+    assert output.read_text() == before
+
+
+def test_empty_output_starts_at_the_offset(tmp_path):
+    path = tmp_path / "predictions.jsonl"
+    path.write_text("")
+    assert resume_offset(str(path), 3) == 3
@@ -0,0 +1,90 @@
+import threading
+import time
+from concurrent.futures import TimeoutError
+
+import pytest
+
+from utils.utils_serving import MicroBatcher, Overloaded
+
+
+class BlockingModel:
+    """predict_batch that records its batches and waits for `release` before answering each of them."""
+
+    def __init__(self, results=lambda batch: [request * 2 for request in batch]):
+        self.results = results
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, batch):
+        self.batches.append(list(batch))
+        self.started.set()
+        assert self.release.wait(5)
+        return self.results(batch)
+
+
+def test_concurrent_requests_share_batches():
+    model = BlockingModel()
+    model.release.set()
+    batcher = MicroBatcher(model, max_batch_size=4, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(10)]
+    assert [future.result(5) for future in futures] == [i * 2 for i in range(10)]
+    assert [len(batch) for batch in model.batches] == [4, 4, 2]
+    snapshot = batcher.stats.snapshot()
+    assert snapshot["requests"] == 10 and snapshot["batches"] == 3 and snapshot["errors"] == 0
+
+
+@pytest.mark.parametrize("results", [lambda batch: batch[:-1], lambda batch: batch + batch])
+def test_result_count_mismatch_fails_every_request_of_the_batch(results):
+    model = BlockingModel(results)
+    model.release.set()
+    batcher = MicroBatcher(model, max_batch_size=3, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(3)]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="returned .* results for a batch of 3 requests"):
+            future.result(5)
+    assert batcher.stats.snapshot()["errors"] == 3
+    # the worker keeps serving
+    model.results = lambda batch: batch
+    assert batcher(7, timeout=5) == 7
+
+
+def test_expired_requests_never_reach_the_model():
+    model = BlockingModel()
+    batcher = MicroBatcher(model, max_batch_size=1, max_wait_ms=0)
+    running = batcher.submit(1)
+    assert model.started.wait(5)
+    # queued behind the running batch past its timeout
+    with pytest.raises(TimeoutError):
+        batcher(2, timeout=0.05)
+    expired = batcher.submit(3, timeout=0.05)
+    time.sleep(0.1)
+    model.release.set()
+    assert running.result(5) == 2
+    assert batcher(4, timeout=5) == 8
+    assert model.batches == [[1], [4]]
+    assert expired.cancelled()
+    assert batcher.stats.snapshot()["expired"] == 2
+
+
+def test_timeout_of_a_running_request_keeps_the_worker_alive():
+    model = BlockingModel()
+    batcher = MicroBatcher(model, max_batch_size=1, max_wait_ms=0)
+    with pytest.raises(TimeoutError):
+        batcher(1, timeout=0.05)
+    model.release.set()
+    assert batcher(2, timeout=5) == 4
+    assert model.batches == [[1], [2]]
+
+
+def test_full_queue_rejects_requests():
+    model = BlockingModel()
+    batcher = MicroBatcher(model, max_batch_size=1, max_wait_ms=0, max_queue_size=2)
+    running = batcher.submit(1)
+    assert model.started.wait(5)
+    queued = [batcher.submit(2), batcher.submit(3)]
+    with pytest.raises(Overloaded):
+        batcher.submit(4)
+    model.release.set()
+    assert [future.result(5) for future in [running] + queued] == [2, 4, 6]
+    assert batcher.stats.snapshot()["rejected"] == 1
@@ -0,0 +1,441 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+'''
+precomputed visual features, written once per image and read back by img_id
+'''
+INDEX_NAME = "index.json"
+# storage precisions of float fields. numpy has no bfloat16, bf16 values are kept as the upper half of their fp32
+# bits (int16); int8 fields are quantized per channel with one float32 scale per channel and row
+PRECISIONS = ["float32", "float16", "bfloat16", "int8"]
+STORAGE_DTYPES = {"float16": "float16", "bfloat16": "int16", "int8": "int8"}
+
+
+class FeatureStoreWriter:
+    """Preallocates one ``.npy`` file per field and fills it row by row.
+
+    The index file is written last by :meth:`close`, so a store without an index
+    is an interrupted build and is never opened by :class:`FeatureStore`.
+    Float fields listed in `precisions` are stored in reduced precision, see `PRECISIONS`; int8 fields are scaled
+    per index of their `channel_axes` entry (default: last axis of a row).
+    `config` (json-serializable) records how the features were computed, e.g. the model, see `check_feature_store`.
+    """
+
+    def __init__(self, store_dir: str, img_ids: List[str], fields: Dict[str, Tuple[tuple, str]],
+                 aliases: Optional[Dict[str, int]] = None, precisions: Optional[Dict[str, str]] = None,
+                 channel_axes: Optional[Dict[str, int]] = None, config: Optional[dict] = None):
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.img_ids = list(img_ids)
+        self.fields = fields
+        self.aliases = aliases or {}
+        self.config = config or {}
+        self.precisions = {name: precision for name, precision in (precisions or {}).items()
+                           if name in fields and precision != "float32"}
+        for name, precision in self.precisions.items():
+            assert precision in PRECISIONS, "unknown precision {} of {}".format(precision, name)
+        self.channel_axes = {name: (channel_axes or {}).get(name, -1) % len(fields[name][0])
+                             for name, precision in self.precisions.items() if precision == "int8"}
+        self.arrays = {}
+        for name, (shape, dtype) in fields.items():
+            self.arrays[name] = np.lib.format.open_memmap(
+                os.path.join(store_dir, "{}.npy".format(name)),
+                mode="w+",
+                dtype=np.dtype(STORAGE_DTYPES.get(self.precisions.get(name), dtype)),
+                shape=(len(self.img_ids),) + tuple(shape),
+            )
+        for name, axis in self.channel_axes.items():
+            scale_shape = [1] * len(fields[name][0])
+            scale_shape[axis] = fields[name][0][axis]
+            self.arrays[scale_name(name)] = np.lib.format.open_memmap(
+                os.path.join(store_dir, "{}.npy".format(scale_name(name))),
+                mode="w+",
+                dtype=np.float32,
+                shape=(len(self.img_ids),) + tuple(scale_shape),
+            )
+
+    def write(self, row: int, **values):
+        for name, value in values.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach().cpu()
+                value = (value.float() if value.is_floating_point() else value).numpy()
+            precision = self.precisions.get(name)
+            if precision == "int8":
+                value, self.arrays[scale_name(name)][row] = quantize_int8(value, self.channel_axes[name])
+            elif precision == "bfloat16":
+                value = to_bfloat16_bits(value)
+            self.arrays[name][row] = value
+
+    def close(self):
+        for array in self.arrays.values():
+            array.flush()
+        fields = {}
+        for name, (shape, dtype) in self.fields.items():
+            fields[name] = {"shape": list(shape), "dtype": dtype}
+            if name in self.precisions:
+                fields[name]["precision"] = self.precisions[name]
+            if name in self.channel_axes:
+                fields[name]["channel_axis"] = self.channel_axes[name]
+        index = {
+            "img_ids": self.img_ids,
+            "aliases": self.aliases,
+            "fields": fields,
+            "config": self.config,
+        }
+        # renamed into place, a reader never sees a partial index
+        index_path = os.path.join(self.store_dir, INDEX_NAME)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+
+def scale_name(name: str) -> str:
+    return "{}.scale".format(name)
+
+
+def to_bfloat16_bits(value: np.ndarray) -> np.ndarray:
+    """Upper 16 bits of the fp32 values, rounded to nearest even, i.e. the bf16 values as int16."""
+    bits = np.ascontiguousarray(value, dtype=np.float32).view(np.uint32)
+    bits = bits + (np.uint32(0x7FFF) + ((bits >> np.uint32(16)) & np.uint32(1)))
+    return (bits >> np.uint32(16)).astype(np.uint16).view(np.int16)
+
+
+def quantize_int8(value: np.ndarray, channel_axis: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric int8 quantization with one scale per index of `channel_axis`, returns the values and the scales."""
+    value = np.asarray(value, dtype=np.float32)
+    channel_axis %= value.ndim
+    axes = tuple(axis for axis in range(value.ndim) if axis != channel_axis)
+    scale = np.abs(value).max(axis=axes, keepdims=True) / 127
+    scale[scale == 0] = 1
+    return np.clip(np.rint(value / scale), -127, 127).astype(np.int8), scale
+
+
+def write_columns(store_dir: str, ids: List[str], columns: Dict[str, list],
+                  aliases: Optional[Dict[str, int]] = None,
+                  pad_values: Optional[Dict[str, int]] = None) -> "FeatureStore":
+    """Saves per-example values as fixed-width columns.
+
+    Values of a column may differ in shape (e.g. preprocessed images or unpadded token ids); they are padded
+    to the largest shape of the column, with zeros unless the column has an entry in `pad_values`.
+    """
+    fields = {}
+    for name, values in columns.items():
+        values = [value.detach().cpu().numpy() if isinstance(value, torch.Tensor) else np.asarray(value)
+                  for value in values]
+        columns[name] = values
+        shape = tuple(max(dims) for dims in zip(*[value.shape for value in values]))
+        dtype = np.int64 if np.issubdtype(values[0].dtype, np.integer) else np.float32
+        fields[name] = (shape, np.dtype(dtype).name)
+    writer = FeatureStore.create(store_dir, ids, fields, aliases)
+    for name, values in columns.items():
+        array = writer.arrays[name]
+        if pad_values and pad_values.get(name, 0) != 0:
+            array[...] = pad_values[name]
+        for row, value in enumerate(values):
+            array[row][tuple(slice(0, dim) for dim in value.shape)] = value
+    writer.close()
+    return FeatureStore(store_dir)
+
+
+def write_arrays(store_dir: str, ids: List[str], arrays: Dict[str, np.ndarray]) -> "FeatureStore":
+    """Saves arrays that already have one row per id as they are."""
+    writer = FeatureStore.create(store_dir, ids, {name: (array.shape[1:], array.dtype.name)
+                                                  for name, array in arrays.items()})
+    for name, array in arrays.items():
+        writer.arrays[name][...] = array
+    writer.close()
+    return FeatureStore(store_dir)
+
+
+class FeatureStore:
+    """Read side of a feature store, every field is memory-mapped."""
+
+    def __init__(self, store_dir: str):
+        with open(os.path.join(store_dir, INDEX_NAME), "r") as f:
+            index = json.load(f)
+        self.store_dir = store_dir
+        self.img_ids = index["img_ids"]
+        self.aliases = index.get("aliases", {})
+        self.fields = index["fields"]
+        self.precisions = {name: field.get("precision", "float32") for name, field in self.fields.items()}
+        # build config, empty for the stores written before it was recorded
+        self.config = index.get("config", {})
+        self.row_map = {img_id: i for i, img_id in enumerate(self.img_ids)}
+        # other names of a row, e.g. the img_ids of duplicate images
+        self.row_map.update(self.aliases)
+        self.arrays = {
+            name: np.load(os.path.join(store_dir, "{}.npy".format(name)), mmap_mode="r")
+            for name in index["fields"]
+        }
+        self.scales = {
+            name: np.load(os.path.join(store_dir, "{}.npy".format(scale_name(name))), mmap_mode="r")
+            for name, precision in self.precisions.items() if precision == "int8"
+        }
+
+    @property
+    def fingerprint(self) -> str:
+        """Digest of the index, i.e. of the img_ids, aliases and fields of the store."""
+        return file_fingerprint(os.path.join(self.store_dir, INDEX_NAME))
+
+    @staticmethod
+    def exists(store_dir: str) -> bool:
+        return store_dir is not None and os.path.isfile(os.path.join(store_dir, INDEX_NAME))
+
+    @staticmethod
+    def create(store_dir: str, img_ids: List[str], fields: Dict[str, Tuple[tuple, str]],
+               aliases: Optional[Dict[str, int]] = None, precisions: Optional[Dict[str, str]] = None,
+               channel_axes: Optional[Dict[str, int]] = None, config: Optional[dict] = None) -> FeatureStoreWriter:
+        return FeatureStoreWriter(store_dir, img_ids, fields, aliases, precisions, channel_axes, config)
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def __contains__(self, img_id):
+        return img_id in self.row_map
+
+    def row(self, img_id: str, fail_image: Optional[str] = None) -> int:
+        """
+        Row of `img_id`. An img_id the store was not built with falls back to the row of `fail_image`, as missing
+        images do when the store is built; without that row the store belongs to other data and a KeyError is raised.
+        """
+        if img_id in self:
+            return self.row_map[img_id]
+        if fail_image is not None and fail_image in self:
+            logger.warning("%s is not in the feature store %s, using the features of %s",
+                           img_id, self.store_dir, fail_image)
+            return self.row_map[fail_image]
+        raise KeyError("{} is not in the feature store {}, it was built for other data. Delete it or pass another "
+                       "directory to rebuild it.".format(img_id, self.store_dir))
+
+    def rows(self, img_ids: Sequence[str]) -> np.ndarray:
+        return np.array([self.row_map[img_id] for img_id in img_ids], dtype=np.int64)
+
+    def get(self, rows, names=None, device=None) -> Dict[str, torch.Tensor]:
+        """
+        :param rows: row indices, as returned by :meth:`rows`
+        :param names: fields to fetch, all of them by default
+        :return: dict of tensors, one row per index. Reduced precision fields are moved to `device` as they are
+            stored and only upcast to float32 there.
+        """
+        if isinstance(rows, torch.Tensor):
+            rows = rows.cpu().numpy()
+        rows = np.asarray(rows, dtype=np.int64)
+        names = names if names is not None else list(self.arrays)
+        outputs = {}
+        for name in names:
+            value = torch.from_numpy(np.ascontiguousarray(self.arrays[name][rows]))
+            value = value.to(device) if device is not None else value
+            precision = self.precisions[name]
+            if precision == "float16":
+                value = value.float()
+            elif precision == "bfloat16":
+                value = value.view(torch.bfloat16).float()
+            elif precision == "int8":
+                scale = torch.from_numpy(np.ascontiguousarray(self.scales[name][rows])).to(value.device)
+                value = value.float() * scale
+            outputs[name] = value
+        return outputs
+
+
+def convert_store(store_dir: str, new_store_dir: str, precisions: Dict[str, str],
+                  channel_axes: Optional[Dict[str, int]] = None, batch_size: int = 256) -> FeatureStore:
+    """Copy of a store with the fields of `precisions` stored in another precision, the other fields as they are."""
+    store = FeatureStore(store_dir)
+    fields = {name: (tuple(field["shape"]), "float32" if store.precisions[name] != "float32" else field["dtype"])
+              for name, field in store.fields.items()}
+    writer = FeatureStore.create(new_store_dir, store.img_ids, fields, store.aliases, precisions, channel_axes,
+                                 store.config)
+    for start in range(0, len(store), batch_size):
+        values = store.get(np.arange(start, min(start + batch_size, len(store))))
+        for i in range(len(next(iter(values.values())))):
+            writer.write(start + i, **{name: value[i] for name, value in values.items()})
+    writer.close()
+    return FeatureStore(new_store_dir)
+
+
+def check_feature_store(store: FeatureStore, img_ids=(), precisions: Optional[Dict[str, str]] = None,
+                        config: Optional[dict] = None):
+    """
+    Raises a ValueError naming `store` when it was not built for this run: a field of `precisions` stored in
+    another precision, an entry of `config` recorded with another value (or not recorded, unless the store predates
+    the config altogether), or img_ids without a row.
+    """
+    problems = []
+    for name, precision in (precisions or {}).items():
+        if store.precisions.get(name, "float32") != precision:
+            problems.append("{} is stored as {}, not {}".format(name, store.precisions.get(name, "float32"), precision))
+    for key, value in (config or {}).items():
+        if store.config and key not in store.config:
+            problems.append("it has no {} recorded, expected {}".format(key, value))
+        elif key in store.config and store.config[key] != value:
+            problems.append("it was built with {} {}, not {}".format(key, store.config[key], value))
+    missing = [img_id for img_id in img_ids if img_id not in store]
+    if missing:
+        problems.append("{} img_ids of the data have no row (e.g. {})".format(len(missing), missing[0]))
+    if problems:
+        raise ValueError("The feature store {} does not match this run: {}. Delete it or pass another directory "
+                         "to rebuild it.".format(store.store_dir, "; ".join(problems)))
+
+
+def file_fingerprint(path: str, chunk_size: int = 1 << 20) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def config_fingerprint(*parts) -> str:
+    """Short digest of json-serializable parts (anything else goes through str), used in cache dir names."""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+@contextmanager
+def atomic_store_dir(store_dir: str, replace: bool = False):
+    """
+    Yields a temporary sibling of `store_dir` to write into, and renames it to `store_dir` once the block
+    succeeds, so other processes either see the complete directory or nothing.
+    If a complete store appeared in the meantime (another process built the same thing) it is kept and the
+    temporary one is dropped, unless `replace`.
+    """
+    tmp_dir = "{}.tmp-{}-{}".format(store_dir.rstrip(os.sep), socket.gethostname(), os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    try:
+        yield tmp_dir
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    if os.path.exists(store_dir) and (replace or not FeatureStore.exists(store_dir)):
+        # stale or unfinished leftover
+        shutil.rmtree(store_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, store_dir)
+    except OSError:
+        if not FeatureStore.exists(store_dir):
+            raise
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+@contextmanager
+def store_lock(store_dir: str):
+    """
+    Exclusive lock on `store_dir` (a ``<dir>.lock`` file next to it) held for the block, so that only one process
+    builds a store while the others wait for it. flock works across processes of one machine and, on most shared
+    filesystems, across nodes.
+    """
+    lock_path = "{}.lock".format(store_dir.rstrip(os.sep))
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ImageTable:
+    """
+    Content-addressed table of the images of a split. Every distinct image file gets one row and is processed and
+    stored once; examples only keep the row as `img_index`. Files are told apart by their size and only hashed (sha1)
+    when another file has the same size, so building the table reads next to no image bytes. A file that can not be
+    decoded is moved to the row of the fail image with :meth:`fail`.
+    """
+
+    def __init__(self):
+        self.keys = []  # id of the row: the image file it was created for, "missing:<name>" if it can not be read
+        self.names = []  # image file actually read for the row
+        self.values = []  # processed image of the row, dict of tensors, None until processed or if it failed
+        self.aliases = {}  # image name used by the examples -> row
+        self._rows = {}  # (path, size, mtime) of every added file -> row
+        self._same_size = {}  # file size -> rows of that size
+        self._digests = {}  # row -> sha1 of its file, only computed when another file has the same size
+        self._paths = []  # path of the file of every row
+        self._key_set = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, path_img: str, image_name: str, fail_image: Optional[str] = None) -> int:
+        if image_name in self.aliases:
+            return self.aliases[image_name]
+        name = image_name
+        if not os.path.isfile(os.path.join(path_img, name)) and fail_image is not None:
+            name = fail_image
+        self.aliases[image_name] = self._file_row(path_img, name)
+        return self.aliases[image_name]
+
+    def fail(self, row: int, path_img: str, fail_image: str) -> int:
+        """
+        Points every image name of `row`, whose file could not be decoded, at the row of `fail_image` and returns
+        that row. The returned row is `row` itself when it is the fail image.
+        """
+        fail_row = self.add(path_img, fail_image)
+        if fail_row != row:
+            for mapping in (self.aliases, self._rows):
+                for key, alias_row in mapping.items():
+                    if alias_row == row:
+                        mapping[key] = fail_row
+            self.values[row] = None
+        return fail_row
+
+    def _file_row(self, path_img: str, name: str) -> int:
+        path = os.path.join(path_img, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # unreadable, processing it will fail too
+            file_key = ("missing", name)
+            if file_key not in self._rows:
+                self._rows[file_key] = self._new_row("missing:{}".format(name), name, path)
+            return self._rows[file_key]
+        file_key = (path, stat.st_size, stat.st_mtime_ns)
+        if file_key not in self._rows:
+            same_size = self._same_size.setdefault(stat.st_size, [])
+            digest = file_fingerprint(path) if same_size else None
+            row = next((other for other in same_size if self._digest(other) == digest), None)
+            if row is None:
+                row = self._new_row(name, name, path)
+                same_size.append(row)
+                if digest is not None:
+                    self._digests[row] = digest
+            self._rows[file_key] = row
+        return self._rows[file_key]
+
+    def _new_row(self, key: str, name: str, path: str) -> int:
+        if key in self._key_set:
+            # same file name in another image directory
+            key = path
+        self._key_set.add(key)
+        self.keys.append(key)
+        self.names.append(name)
+        self.values.append(None)
+        self._paths.append(path)
+        return len(self.keys) - 1
+
+    def _digest(self, row: int) -> str:
+        if row not in self._digests:
+            self._digests[row] = file_fingerprint(self._paths[row])
+        return self._digests[row]
+
+    def columns(self) -> Dict[str, list]:
+        """Per-field lists of the processed images, the rows that failed are zero filled."""
+        template = next((value for value in self.values if value is not None), None)
+        if template is None:
+            # nothing processed, or every image failed
+            return {}
+        return {
+            name: [value[name] if value is not None else torch.zeros_like(template[name]) for value in self.values]
+            for name in template
+        }
@@ -234,15 +234,23 @@ def recall_score(true_entities, pred_entities):
 
 def classification_report(true_entities, pred_entities, digits=5):
     """Build a text report showing the main classification metrics."""
-    name_width = 0
     d1 = defaultdict(set)
     d2 = defaultdict(set)
     for e in true_entities:
         d1[e[0]].add((e[1], e[2]))
-        name_width = max(name_width, len(e[0]))
     for e in pred_entities:
         d2[e[0]].add((e[1], e[2]))
+    # types only predicted count in the micro average, without a line of their own
+    type_names = list(d1) + [type_name for type_name in d2 if type_name not in d1]
+    nb_correct = [len(d1[type_name] & d2[type_name]) for type_name in type_names]
+    nb_pred = [len(d2[type_name]) for type_name in type_names]
+    nb_true = [len(d1[type_name]) for type_name in type_names]
+    return classification_report_from_counts(type_names, nb_correct, nb_pred, nb_true, digits=digits)
 
+
+def classification_report_from_counts(type_names, nb_correct, nb_pred, nb_true, digits=5):
+    """`classification_report` from the per type counts of correct, predicted and true entities."""
+    name_width = max([len(type_name) for type_name, support in zip(type_names, nb_true) if support > 0] + [0])
     last_line_heading = 'macro avg'
     width = max(name_width, len(last_line_heading), digits)
 
@@ -254,32 +262,23 @@ def classification_report(true_entities, pred_entities, digits=5):
     row_fmt = u'{:>{width}s} ' + u' {:>9.{digits}f}' * 3 + u' {:>9}\n'
 
     ps, rs, f1s, s = [], [], [], []
-    for type_name, type_true_entities in d1.items():
-        type_pred_entities = d2[type_name]
-        nb_correct = len(type_true_entities & type_pred_entities)
-        nb_pred = len(type_pred_entities)
-        nb_true = len(type_true_entities)
-
-        p = nb_correct / nb_pred if nb_pred > 0 else 0
-        r = nb_correct / nb_true if nb_true > 0 else 0
-        f1 = 2 * p * r / (p + r) if p + r > 0 else 0
+    for type_name, type_correct, type_pred, type_true in zip(type_names, nb_correct, nb_pred, nb_true):
+        if type_true == 0:
+            continue
+        p, r, f1 = precision_recall_f1(type_correct, type_pred, type_true)
 
-        report += row_fmt.format(*[type_name, p, r, f1, nb_true], width=width, digits=digits)
+        report += row_fmt.format(*[type_name, p, r, f1, type_true], width=width, digits=digits)
 
         ps.append(p)
         rs.append(r)
         f1s.append(f1)
-        s.append(nb_true)
+        s.append(type_true)
 
     report += u'\n'
 
     # compute averages
-    report += row_fmt.format('micro avg',
-                             precision_score(true_entities, pred_entities),
-                             recall_score(true_entities, pred_entities),
-                             f1_score(true_entities, pred_entities),
-                             np.sum(s),
-                             width=width, digits=digits)
+    p, r, f1 = precision_recall_f1(int(np.sum(nb_correct)), int(np.sum(nb_pred)), int(np.sum(nb_true)))
+    report += row_fmt.format('micro avg', p, r, f1, np.sum(s), width=width, digits=digits)
     report += row_fmt.format(last_line_heading,
                              np.average(ps, weights=s),
                              np.average(rs, weights=s),
@@ -290,6 +289,206 @@ def classification_report(true_entities, pred_entities, digits=5):
     return report
 
 
+def precision_recall_f1(nb_correct, nb_pred, nb_true):
+    p = nb_correct / nb_pred if nb_pred > 0 else 0
+    r = nb_correct / nb_true if nb_true > 0 else 0
+    f1 = 2 * p * r / (p + r) if p + r > 0 else 0
+    return p, r, f1
+
+
+class TagIndex:
+    """
+    Integer view of a label list, to read label id matrices without going through the label strings. Per label id:
+    whether it is a B- or an I- tag and its BIO type (`get_entities_bio`, -1 for the other labels), its first
+    character and its type after the last '-' (`get_entities`). Type ids index `types`.
+    """
+
+    def __init__(self, labels):
+        self.labels = list(labels)
+        self.types = []
+        self._type_ids = {}
+        self.is_b = np.array([label.startswith("B-") for label in self.labels], dtype=bool)
+        self.is_i = np.array([label.startswith("I-") for label in self.labels], dtype=bool)
+        self.bio_type_ids = np.array([self.type_id(label.split('-')[1]) if self.is_b[i] or self.is_i[i] else -1
+                                      for i, label in enumerate(self.labels)], dtype=np.int64)
+        self.tags = np.array([ord(label[0]) for label in self.labels], dtype=np.int64)
+        self.type_ids = np.array([self.type_id(label.split('-')[-1]) for label in self.labels], dtype=np.int64)
+        # padding and the separators between sentences read as O
+        self.outside_type_id = self.type_id('O')
+
+    def type_id(self, type_):
+        if type_ not in self._type_ids:
+            self._type_ids[type_] = len(self.types)
+            self.types.append(type_)
+        return self._type_ids[type_]
+
+    def _known(self, label_ids):
+        label_ids = np.asarray(label_ids)
+        known = (label_ids >= 0) & (label_ids < len(self.labels))
+        return known, np.where(known, label_ids, 0)
+
+    def lookup(self, label_ids):
+        """(is B-, is I-, BIO type id) of every label id; ids outside of the label list (padding) are neither."""
+        known, label_ids = self._known(label_ids)
+        return (self.is_b[label_ids] & known, self.is_i[label_ids] & known,
+                np.where(known, self.bio_type_ids[label_ids], -1))
+
+    def chunk_lookup(self, label_ids):
+        """(first character code, type id) of every label id; ids outside of the label list read as O."""
+        known, label_ids = self._known(label_ids)
+        return (np.where(known, self.tags[label_ids], ord('O')),
+                np.where(known, self.type_ids[label_ids], self.outside_type_id))
+
+
+def _compact(label_ids, mask=None):
+    """
+    Positions of `mask` in a (sentences, length) label id matrix, in row order: their row, label id, whether they
+    open their row and their offset within the row once compacted.
+    """
+    label_ids = np.asarray(label_ids)
+    if label_ids.ndim == 1:
+        label_ids = label_ids[None]
+    if mask is None:
+        mask = np.ones(label_ids.shape, dtype=bool)
+    rows, columns = np.nonzero(mask)
+    positions = np.arange(len(rows))
+    row_start = np.ones(len(rows), dtype=bool)
+    row_start[1:] = rows[1:] != rows[:-1]
+    offsets = positions - np.maximum.accumulate(np.where(row_start, positions, 0)) if len(rows) else positions
+    return rows, label_ids[rows, columns], row_start, offsets
+
+
+def _entity_array(rows, types, starts, ends):
+    return np.stack([rows, types, starts, ends], axis=1).astype(np.int64).reshape(-1, 4)
+
+
+def get_entities_bio_ids(label_ids, tag_index, mask=None):
+    """
+    `get_entities_bio` over a matrix of label ids, one sentence per row.
+    Only the positions of `mask` are read, compacted per row like the label lists built for the evaluation.
+    Returns an int64 array with one (row, type id, start, end) line per entity, type ids index `tag_index.types`.
+    """
+    rows, label_ids, row_start, offsets = _compact(label_ids, mask)
+    if len(rows) == 0:
+        return _entity_array(*[np.zeros(0, dtype=np.int64)] * 4)
+    is_b, is_i, types = tag_index.lookup(label_ids)
+    positions = np.arange(len(rows))
+    # every tag but an I- within a row opens a segment, an entity is a segment opened by a B- tag ...
+    opens = ~is_i | row_start
+    segment_starts = positions[opens]
+    segment_types = types[segment_starts][np.cumsum(opens) - 1]
+    # ... and it ends at the last I- tag of its own type within the segment
+    ends = np.maximum.reduceat(np.where(opens | (types == segment_types), positions, -1), segment_starts)
+    is_entity = is_b[segment_starts]
+    starts, ends = segment_starts[is_entity], ends[is_entity]
+    return _entity_array(rows[starts], types[starts], offsets[starts], offsets[ends])
+
+
+def get_entities_ids(label_ids, tag_index, mask=None):
+    """
+    `get_entities` (the BIOES chunk rules of `end_of_chunk` and `start_of_chunk`) over a matrix of label ids, one
+    sentence per row. Same `mask` and (row, type id, start, end) entities as `get_entities_bio_ids`.
+    """
+    rows, label_ids, row_start, offsets = _compact(label_ids, mask)
+    if len(rows) == 0:
+        return _entity_array(*[np.zeros(0, dtype=np.int64)] * 4)
+    # the sentences are laid out one after the other with an O after each, like the flattened label lists
+    slots = np.arange(len(rows)) + np.cumsum(row_start) - 1
+    tags = np.full(len(rows) + int(row_start.sum()), ord('O'), dtype=np.int64)
+    types = np.full(len(tags), tag_index.outside_type_id, dtype=np.int64)
+    tags[slots], types[slots] = tag_index.chunk_lookup(label_ids)
+    token = np.full(len(tags), -1, dtype=np.int64)
+    token[slots] = np.arange(len(rows))
+    prev_tags = np.concatenate([[ord('O')], tags[:-1]])
+    prev_types = np.concatenate([[-1], types[:-1]])
+
+    B, I, E, S, O, dot = (ord(tag) for tag in 'BIESO.')
+    type_change = prev_types != types
+    chunk_end = (np.isin(prev_tags, [E, S])
+                 | (np.isin(prev_tags, [B, I]) & np.isin(tags, [B, S, O]))
+                 | ((prev_tags != O) & (prev_tags != dot) & type_change))
+    chunk_start = (np.isin(tags, [B, S])
+                   | (np.isin(prev_tags, [E, S, O]) & np.isin(tags, [E, I]))
+                   | ((tags != O) & (tags != dot) & type_change))
+    # a chunk ending before slot i began at the last start before i
+    begins = np.maximum.accumulate(np.where(chunk_start, np.arange(len(tags)), 0))
+    boundaries = np.nonzero(chunk_end)[0]
+    starts, ends = token[begins[boundaries - 1]], token[boundaries - 1]
+    return _entity_array(rows[ends], prev_types[boundaries], offsets[starts], offsets[ends])
+
+
+def get_entities_span_ids(start_ids, end_ids, tag_index, mask=None):
+    """
+    `get_entities_span` over matrices of start and end label ids, one sentence per row: every start label that is
+    not O is matched with the first equal end label at or after it in its sentence. The span labels being the entity
+    types, the type column of the (row, type, start, end) entities holds label ids. Same `mask` as
+    `get_entities_bio_ids`.
+    """
+    rows, start_ids, _, offsets = _compact(start_ids, mask)
+    end_ids = _compact(end_ids, mask)[1]
+    outside = [i for i, label in enumerate(tag_index.labels) if label in ('O', '<SEP>')]
+    is_start = ~np.isin(start_ids, outside) & (start_ids >= 0) & (start_ids < len(tag_index.labels))
+    # one sorted key per end, (row, label, offset), searched for the key of every start
+    length = int(offsets.max()) + 1 if len(offsets) else 1
+    num_labels = len(tag_index.labels) + 1
+    end_keys = (rows * num_labels + np.where(end_ids >= 0, end_ids, num_labels - 1)) * length + offsets
+    end_keys = np.sort(end_keys)
+    starts = np.nonzero(is_start)[0]
+    if len(starts) == 0:
+        return _entity_array(*[np.zeros(0, dtype=np.int64)] * 4)
+    start_keys = (rows[starts] * num_labels + start_ids[starts]) * length + offsets[starts]
+    found = np.searchsorted(end_keys, start_keys)
+    matched = found < len(end_keys)
+    matched[matched] = end_keys[found[matched]] // length == start_keys[matched] // length
+    starts, found = starts[matched], found[matched]
+    return _entity_array(rows[starts], start_ids[starts], offsets[starts], end_keys[found] % length)
+
+
+class EntityMetrics:
+    """
+    Entity level precision, recall and F1 accumulated batch by batch: only the per type counts of correct,
+    predicted and true entities are kept, so memory does not grow with the evaluated split.
+    The numbers are those of `f1_score` and `classification_report` over `get_entities_bio` of the whole split.
+    """
+
+    def __init__(self, labels, pad_token_label_id=-100):
+        self.tag_index = TagIndex(labels)
+        self.pad_token_label_id = pad_token_label_id
+        self.nb_correct = np.zeros(len(self.tag_index.types), dtype=np.int64)
+        self.nb_pred = np.zeros(len(self.tag_index.types), dtype=np.int64)
+        self.nb_true = np.zeros(len(self.tag_index.types), dtype=np.int64)
+
+    def update(self, true_ids, pred_ids):
+        """
+        Adds a batch of gold and predicted label ids, (batch, length) each. Positions whose gold label is
+        `pad_token_label_id` are skipped, predictions are cut or padded to the length of the gold labels.
+        """
+        true_ids = np.asarray(true_ids)
+        pred_ids = np.asarray(pred_ids)[:, :true_ids.shape[1]]
+        if pred_ids.shape[1] < true_ids.shape[1]:
+            pred_ids = np.pad(pred_ids, [(0, 0), (0, true_ids.shape[1] - pred_ids.shape[1])], constant_values=-1)
+        mask = true_ids != self.pad_token_label_id
+        true = get_entities_bio_ids(true_ids, self.tag_index, mask)
+        pred = get_entities_bio_ids(pred_ids, self.tag_index, mask)
+        true_keys, pred_keys = self._keys(true, true_ids.shape[1]), self._keys(pred, true_ids.shape[1])
+        correct = pred[np.isin(pred_keys, true_keys)]
+        num_types = len(self.tag_index.types)
+        self.nb_correct += np.bincount(correct[:, 1], minlength=num_types)
+        self.nb_pred += np.bincount(pred[:, 1], minlength=num_types)
+        self.nb_true += np.bincount(true[:, 1], minlength=num_types)
+
+    def _keys(self, entities, length):
+        row, type_, start, end = entities.T
+        return ((row * len(self.tag_index.types) + type_) * length + start) * length + end
+
+    def f1(self):
+        return precision_recall_f1(int(self.nb_correct.sum()), int(self.nb_pred.sum()), int(self.nb_true.sum()))[2]
+
+    def report(self, digits=5):
+        return classification_report_from_counts(self.tag_index.types, self.nb_correct, self.nb_pred,
+                                                 self.nb_true, digits=digits)
+
+
 def convert_span_to_bio(starts, ends):
     labels = []
     for start, end in zip(starts, ends):
@@ -16,15 +16,24 @@
 """ Named entity recognition fine-tuning: utilities to work with CoNLL-2003 task. """
 
 import torch
+import numpy as np
 import logging
 import os
 from dataclasses import dataclass
 from enum import Enum
-from typing import List, Optional, Union
+from functools import lru_cache
+from typing import Iterator, List, Optional, Union
 import re
-import ObjectFeatureExtractor
-import GridFeatureExtractor
-from torch.utils.data import Dataset
+import itertools
+import json
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils.utils_feature_store import FeatureStore, ImageTable, atomic_store_dir, config_fingerprint, \
+    file_fingerprint, store_lock, write_arrays, write_columns
+from utils.utils_tokenization import encode_text
+from torch.utils.data import BatchSampler, DataLoader, Dataset, DistributedSampler, IterableDataset, RandomSampler, \
+    Sampler, SequentialSampler, get_worker_info
 from transformers import PreTrainedTokenizer
 import torch.nn as nn
 logger = logging.getLogger(__name__)
@@ -66,42 +75,84 @@ class Split(Enum):
     dev = "dev"
     test = "test"
 
+# https://nlp.stanford.edu/projects/glove/preprocess-twitter.rb, compiled once
+NUMBER_RE = re.compile(r"[-+]?[.\d]*[\d]+[:,.\d]*")
+URL_RE = re.compile(r"https?:\/\/\S+\b|www\.(\w+\.)+\S*")
+HASHTAG_RE = re.compile(r"#\S+")
+USER_RE = re.compile(r"@\w+")
+
+
+@lru_cache(maxsize=2 ** 17)
 def preprocess_word(word):
     """
     - Do lowercase
     - Regular expression (number, url, hashtag, user)
         - https://nlp.stanford.edu/projects/glove/preprocess-twitter.rb
 
+    Memoized, the vocabulary of tweets is small and heavily skewed (see `preprocess_word_stats`).
+
     :param word: str
     :return: word: str
     """
-    number_re = r"[-+]?[.\d]*[\d]+[:,.\d]*"
-    url_re = r"https?:\/\/\S+\b|www\.(\w+\.)+\S*"
-    hashtag_re = r"#\S+"
-    user_re = r"@\w+"
-
-    if re.compile(number_re).match(word):
+    if NUMBER_RE.match(word):
         word = '<NUMBER>'
-    elif re.compile(url_re).match(word):
+    elif URL_RE.match(word):
         word = '<URL>'
-    elif re.compile(hashtag_re).match(word):
+    elif HASHTAG_RE.match(word):
         word = word[1:]  # only erase `#` at the front
-    elif re.compile(user_re).match(word):
+    elif USER_RE.match(word):
         word = word[1:]  # only erase `@` at the front
 
     word = word.lower()
 
     return word
 
+
+def preprocess_words(words: List[str]) -> List[str]:
+    """`preprocess_word` over a whole sentence."""
+    return list(map(preprocess_word, words))
+
+
+def preprocess_word_stats():
+    info = preprocess_word.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "hit_rate": info.hits / lookups if lookups else 0.0,
+    }
+
 '''
 read dataset and convert datasets to features for Multimodal NER
 '''
 class MMNerTask:
     def read_examples_from_file(self, data_dir, mode: Union[Split, str]) -> List[InputExample]:
-        data_dir = os.path.join(data_dir, "{}.txt".format(mode))
-        with open(data_dir, "r", encoding="utf-8") as f:
-            sentences = []
+        return list(self.iter_examples_from_file(data_dir, mode))
 
+    def iter_examples_from_file(self, data_dir, mode: Union[Split, str]) -> Iterator[InputExample]:
+        """Yields the examples of a split one sentence at a time, the file is never held in memory."""
+        data_dir = os.path.join(data_dir, "{}.txt".format(mode))
+        for i, sentence in enumerate(self.iter_sentences_from_path(data_dir)):
+            yield self._sentence_to_example(sentence, mode, i)
+        logger.info("preprocess_word cache for %s: %s", data_dir, preprocess_word_stats())
+
+    def get_img_ids(self, data_dir) -> set:
+        """img_ids of the sentences of every split found in `data_dir`, i.e. the images a feature store needs."""
+        img_ids = set()
+        for split in Split:
+            path = os.path.join(data_dir, "{}.txt".format(split.value))
+            if os.path.exists(path):
+                img_ids.update(sentence[2] for sentence in self.iter_sentences_from_path(path) if len(sentence) > 2)
+        return img_ids
+
+    @staticmethod
+    def iter_sentences_from_path(path, unlabeled=False) -> Iterator[list]:
+        """
+        Yields [words, tags, img_id] for every sentence of a CoNLL file, words as they are in the file.
+        With `unlabeled`, lines holding only a word are read with the tag O (input to tag, without gold labels).
+        """
+        with open(path, "r", encoding="utf-8") as f:
             sentence = [[], []]  # [[words], [tags], img_id]
             for line in f:
                 if line.strip() == "":
@@ -109,7 +160,7 @@ class MMNerTask:
 
                 if line.startswith("IMGID:"):
                     if sentence[0]:
-                        sentences.append(sentence)
+                        yield sentence
                         sentence = [[], []]  # Flush
 
                     # Add img_id at last
@@ -117,27 +168,36 @@ class MMNerTask:
                     sentence.append(img_id)
                 else:
                     try:
-                        word, tag = line.strip().split("\t")
-                        word = preprocess_word(word)
+                        if unlabeled and "\t" not in line.strip():
+                            word, tag = line.strip(), "O"
+                        else:
+                            word, tag = line.strip().split("\t")
                         sentence[0].append(word)
                         sentence[1].append(tag)
                     except:
                         logger.info("\"{}\" cannot be splitted".format(line.rstrip()))
             # Flush the last one
             if sentence[0]:
-                sentences.append(sentence)
-        examples = []
+                yield sentence
+
+    @staticmethod
+    def _sentence_to_example(sentence, mode, i) -> InputExample:
+        words, labels, img_id = preprocess_words(sentence[0]), sentence[1], sentence[2]
+        assert len(words) == len(labels)
 
-        for (i, sentence) in enumerate(sentences):
-            words, labels, img_id = sentence[0], sentence[1], sentence[2]
-            assert len(words) == len(labels)
+        guid = "%s-%s" % (mode, i)
+        if i % 10000 == 0:
+            logger.info(sentence)
+        return InputExample(guid=guid, img_id=img_id, words=words, labels=labels)
 
-            guid = "%s-%s" % (mode, i)
-            if i % 10000 == 0:
-                logger.info(sentence)
-            examples.append(InputExample(guid=guid, img_id=img_id, words=words, labels=labels))
+    def count_examples_in_file(self, data_dir, mode: Union[Split, str]) -> int:
+        """Number of sentences of a split, by scanning the IMGID lines only."""
+        with open(os.path.join(data_dir, "{}.txt".format(mode)), "r", encoding="utf-8") as f:
+            return sum(1 for line in f if line.startswith("IMGID:"))
 
-        return examples
+    def cache_config(self, feature_store=None) -> dict:
+        """Everything besides the text that changes the converted features, part of the cache fingerprint."""
+        return {"feature_type": self.__class__.__name__}
 
     def get_labels(self, path: str) -> List[str]:
         if path:
@@ -155,8 +215,15 @@ class MMNerTask:
         label_list,
         max_seq_length,
         tokenizer,
-        data_dir
+        data_dir,
+        feature_store=None,
+        image_table=None,
+        text_features=None,
     ) -> List[InputFeatures]:
+        """
+        `text_features` is the output of `utils_tokenization.encode_text` for the same examples when it is
+        already known, every visual feature type encodes the text the same way.
+        """
         raise NotImplementedError
 
 class MMNerTask_Pixel(MMNerTask):
@@ -167,11 +234,26 @@ class MMNerTask_Pixel(MMNerTask):
         label_list,
         max_seq_length,
         tokenizer,
-        data_dir
+        data_dir,
+        feature_store=None,
+        image_table=None,
+        text_features=None,
     ) -> List[InputFeatures]:
         return None
 
 class MMNerTask_Object(MMNerTask):
+    def __init__(self, image_batch_size=16, num_image_workers=4):
+        self.image_batch_size = image_batch_size
+        self.num_image_workers = num_image_workers
+
+    def cache_config(self, feature_store=None) -> dict:
+        config = super().cache_config(feature_store)
+        if feature_store is None:
+            # the images are preprocessed with the detector config, with a feature store only its rows are cached
+            import ObjectFeatureExtractor
+            config["frcnn_model_path"] = ObjectFeatureExtractor.FRCNN_MODEL_PATH
+            config["frcnn_cfg"] = ObjectFeatureExtractor.get_frcnn_cfg().to_plain_dict()
+        return config
 
     def convert_examples_to_features(
         self,
@@ -179,13 +261,31 @@ class MMNerTask_Object(MMNerTask):
         label_list,
         max_seq_length,
         tokenizer,
-        data_dir
+        data_dir,
+        feature_store=None,
+        image_table=None,
+        text_features=None,
     ) -> List[InputFeatures]:
+        # imported here so that text-only and Grid runs never touch the detector code
+        import ObjectFeatureExtractor
         return ObjectFeatureExtractor.convert_mm_examples_to_features(examples, label_list, max_seq_length,
                                                                       tokenizer,
-                                                                      data_dir)
+                                                                      data_dir,
+                                                                      feature_store=feature_store,
+                                                                      image_table=image_table,
+                                                                      text_features=text_features,
+                                                                      image_batch_size=self.image_batch_size,
+                                                                      num_image_workers=self.num_image_workers)
 
 class MMNerTask_Grid(MMNerTask):
+    def __init__(self, crop_size=224):
+        self.crop_size = crop_size
+
+    def cache_config(self, feature_store=None) -> dict:
+        config = super().cache_config(feature_store)
+        config["crop_size"] = self.crop_size
+        return config
+
     def convert_examples_to_features(
         self,
         examples,
@@ -193,14 +293,54 @@ class MMNerTask_Grid(MMNerTask):
         max_seq_length,
         tokenizer,
         data_dir,
-        crop_size=224,
+        feature_store=None,
+        image_table=None,
+        text_features=None,
+        crop_size=None,
     ) -> List[InputFeatures]:
-        return GridFeatureExtractor.convert_mm_examples_to_features(examples, label_list, max_seq_length, tokenizer, crop_size,
-                                                                    data_dir)
+        import GridFeatureExtractor
+        return GridFeatureExtractor.convert_mm_examples_to_features(examples, label_list, max_seq_length, tokenizer,
+                                                                    data_dir,
+                                                                    crop_size=crop_size or self.crop_size,
+                                                                    feature_store=feature_store,
+                                                                    image_table=image_table,
+                                                                    text_features=text_features)
+
+def cache_fingerprints(token_classification_task, data_dir, tokenizer, labels, model_type, max_seq_length,
+                       mode, feature_store=None):
+    """
+    Fingerprints of the encoded text and of the converted features of a split. The text one covers the data
+    file contents, the labels, the tokenizer and max_seq_length; the features one adds the visual config of the
+    task (feature type, crop size, detector config) and the offline feature store.
+    """
+    text_fingerprint = config_fingerprint(
+        file_fingerprint(os.path.join(data_dir, "{}.txt".format(mode.value))),
+        list(labels),
+        tokenizer.__class__.__name__,
+        getattr(tokenizer, "name_or_path", None),
+        len(tokenizer),
+        model_type,
+        max_seq_length,
+    )
+    features_fingerprint = config_fingerprint(
+        text_fingerprint,
+        token_classification_task.cache_config(feature_store),
+        feature_store.fingerprint if feature_store is not None else None,
+    )
+    return text_fingerprint, features_fingerprint
+
 
 class MMNerDataset(Dataset):
+    """
+    Features are cached as fixed-width columns (see `utils_feature_store.write_columns`) and memory-mapped,
+    so loading is O(1) and DataLoader workers share the pages through the OS page cache.
+    The visual columns are stored once per distinct image (see `ImageTable`), examples only keep `img_index`.
+    The text columns are stored unpadded (`seq_length` per example), batch them with `collate_fn`.
+    With `num_workers` > 1 the cache is built by a process pool, in shards of `shard_size` examples
+    (see `convert_features_sharded`).
+    """
 
-    features: List[InputFeatures]
+    cached: "CachedFeatures"
     pad_token_label_id: int = nn.CrossEntropyLoss().ignore_index
 
     def __init__(
@@ -213,33 +353,519 @@ class MMNerDataset(Dataset):
             max_seq_length: Optional[int] = None,
             overwrite_cache=False,
             mode: Split = Split.train,
+            feature_store=None,
+            dynamic_padding=True,
+            num_workers=1,
+            shard_size=1000,
                  ):
-        cached_features_file = os.path.join(
+        # caches are keyed by a fingerprint of everything they depend on, different configs live side by side
+        text_fingerprint, features_fingerprint = cache_fingerprints(token_classification_task, data_dir, tokenizer,
+                                                                    labels, model_type, max_seq_length, mode,
+                                                                    feature_store)
+        cached_features_dir = os.path.join(
             data_dir,
-            "cached_{}_{}_{}_{}".format(mode.value, tokenizer.__class__.__name__, model_type,str(max_seq_length)),
+            "cached_unpadded_{}_{}_{}_{}".format(mode.value, model_type, str(max_seq_length), features_fingerprint),
         )
-        if os.path.exists(cached_features_file) and not overwrite_cache:
-            self.features = torch.load(cached_features_file)
-        else:
-            examples = token_classification_task.read_examples_from_file(data_dir, mode)
-            # TODO clean up all this to leverage built-in features of tokenizers
-            self.features = token_classification_task.convert_examples_to_features(
-                examples,
-                labels,
-                max_seq_length,
-                tokenizer,
-                data_dir,
-            )
-            torch.save(self.features,cached_features_file)
+        # one builder per cache dir, also across processes of other runs and ranks; whoever gets the lock second
+        # finds the finished cache
+        with store_lock(cached_features_dir):
+            if (FeatureStore.exists(cached_features_dir) or ShardedFeatures.exists(cached_features_dir)) \
+                    and not overwrite_cache:
+                logger.info("Loading features from cached dir %s", cached_features_dir)
+            else:
+                examples = token_classification_task.read_examples_from_file(data_dir, mode.value)
+                # the encoded text does not depend on the visual feature type, it is cached on its own and shared
+                text_features_dir = os.path.join(
+                    data_dir,
+                    "cached_text_{}_{}_{}_{}".format(mode.value, model_type, str(max_seq_length), text_fingerprint),
+                )
+                text_features = None
+                if FeatureStore.exists(text_features_dir) and not overwrite_cache:
+                    text_store = FeatureStore(text_features_dir)
+                    if len(text_store) == len(examples):
+                        logger.info("Loading encoded text from cached dir %s", text_features_dir)
+                        text_features = text_store.arrays
+                if text_features is None:
+                    text_features = encode_text(examples, labels, max_seq_length, tokenizer)
+                    with atomic_store_dir(text_features_dir, replace=overwrite_cache) as tmp_dir:
+                        write_arrays(tmp_dir, [example.guid for example in examples], text_features)
+                if num_workers > 1:
+                    convert_features_sharded(token_classification_task, examples, labels, max_seq_length, tokenizer,
+                                             data_dir, cached_features_dir, text_features,
+                                             feature_store=feature_store, num_workers=num_workers,
+                                             shard_size=shard_size, overwrite_cache=overwrite_cache)
+                else:
+                    image_table = ImageTable() if feature_store is None else None
+                    features = token_classification_task.convert_examples_to_features(
+                        examples,
+                        labels,
+                        max_seq_length,
+                        tokenizer,
+                        data_dir,
+                        feature_store=feature_store,
+                        image_table=image_table,
+                        text_features=text_features,
+                    )
+                    logger.info("Saving features into cached dir %s", cached_features_dir)
+                    with atomic_store_dir(cached_features_dir, replace=overwrite_cache) as tmp_dir:
+                        save_features(features, tmp_dir, image_table)
+        self.cached = open_cached_features(cached_features_dir)
+        self.lengths = self.cached.lengths
+        self.collate_fn = DynamicPaddingCollator(pad_token_id=tokenizer.pad_token_id or 0,
+                                                 pad_token_label_id=self.pad_token_label_id,
+                                                 max_length=None if dynamic_padding else max_seq_length)
+
+    def __len__(self):
+        return len(self.cached)
+
+    def __getitem__(self, i):
+        return self.cached[i]
+
+
+class CachedFeatures:
+    """Features written by `save_features`, memory-mapped and indexed like a list of batch items."""
+
+    def __init__(self, cached_features_dir):
+        self.features = FeatureStore(cached_features_dir)
+        self.text_columns = [self.features.arrays[name] for name in TEXT_COLUMNS]
+        self.lengths = np.asarray(self.features.arrays["seq_length"])
+        self.img_index = self.features.arrays["img_index"]
+        images_dir = os.path.join(cached_features_dir, IMAGES_DIR)
+        self.images = FeatureStore(images_dir) if FeatureStore.exists(images_dir) else None
+        self.image_columns = list(self.images.arrays.values()) if self.images is not None else []
 
     def __len__(self):
         return len(self.features)
 
-    def __getitem__(self, i) -> InputFeatures:
-        return self.features[i]
+    def __getitem__(self, i):
+        length = int(self.lengths[i])
+        item = tuple(torch.from_numpy(np.array(column[i][:length])) for column in self.text_columns)
+        img_index = int(self.img_index[i])
+        if self.images is None:
+            # row of the offline feature store, looked up by the training loop
+            return item + (torch.tensor(img_index),)
+        return item + tuple(torch.from_numpy(np.array(column[img_index])) for column in self.image_columns)
+
+
+class ShardedFeatures:
+    """
+    Shards written by `convert_features_sharded`, read as one `CachedFeatures` in the order of the manifest.
+    The manifest is written once every shard is complete, so its presence marks a finished cache.
+    """
+
+    def __init__(self, cached_features_dir):
+        with open(os.path.join(cached_features_dir, MANIFEST_NAME), "r") as f:
+            manifest = json.load(f)
+        self.shards = [CachedFeatures(os.path.join(cached_features_dir, name)) for name in manifest["shards"]]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.lengths = np.concatenate([shard.lengths for shard in self.shards] + [np.zeros(0, dtype=np.int64)])
+
+    @staticmethod
+    def exists(cached_features_dir):
+        return os.path.isfile(os.path.join(cached_features_dir, MANIFEST_NAME))
+
+    @staticmethod
+    def remove_manifest(cached_features_dir):
+        if ShardedFeatures.exists(cached_features_dir):
+            os.remove(os.path.join(cached_features_dir, MANIFEST_NAME))
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i):
+        shard = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        return self.shards[shard][i - int(self.offsets[shard])]
+
+
+def open_cached_features(cached_features_dir):
+    if ShardedFeatures.exists(cached_features_dir):
+        return ShardedFeatures(cached_features_dir)
+    return CachedFeatures(cached_features_dir)
+
+
+def _convert_shard(token_classification_task, examples, labels, max_seq_length, tokenizer, data_dir,
+                   text_features, feature_store_dir, shard_dir, frcnn_model_path=None):
+    # runs in a spawned worker process, the offline feature store is opened again there rather than pickled and
+    # the detector path set by the parent (--frcnn_model_path) is set again, the module default would be used
+    if frcnn_model_path is not None:
+        import ObjectFeatureExtractor
+        ObjectFeatureExtractor.FRCNN_MODEL_PATH = frcnn_model_path
+    feature_store = FeatureStore(feature_store_dir) if feature_store_dir is not None else None
+    image_table = ImageTable() if feature_store is None else None
+    features = token_classification_task.convert_examples_to_features(
+        examples,
+        labels,
+        max_seq_length,
+        tokenizer,
+        data_dir,
+        feature_store=feature_store,
+        image_table=image_table,
+        text_features=text_features,
+    )
+    save_features(features, shard_dir, image_table)
+    return shard_dir, len(features)
+
+
+def convert_features_sharded(token_classification_task, examples, labels, max_seq_length, tokenizer, data_dir,
+                             cached_features_dir, text_features, feature_store=None, num_workers=4,
+                             shard_size=1000, overwrite_cache=False):
+    """
+    Converts the examples in shards of `shard_size` on a pool of `num_workers` processes. Every shard is saved
+    with `save_features` in its own directory and the manifest listing them is written last. The shard layout
+    only depends on `shard_size`, so after a crash the shards that were completed are kept and only the
+    others are converted again. Images are deduplicated within a shard.
+    """
+    os.makedirs(cached_features_dir, exist_ok=True)
+    ShardedFeatures.remove_manifest(cached_features_dir)
+    feature_store_dir = feature_store.store_dir if feature_store is not None else None
+    frcnn_model_path = None
+    if isinstance(token_classification_task, MMNerTask_Object):
+        import ObjectFeatureExtractor
+        frcnn_model_path = ObjectFeatureExtractor.FRCNN_MODEL_PATH
+    shards = []
+    pending = []
+    for start in range(0, len(examples), shard_size):
+        end = min(start + shard_size, len(examples))
+        name = "shard_{:07d}_{:07d}".format(start, end)
+        shards.append(name)
+        if overwrite_cache or not FeatureStore.exists(os.path.join(cached_features_dir, name)):
+            pending.append((start, end, name))
+    logger.info("Converting %d of %d shards into %s with %d processes", len(pending), len(shards),
+                cached_features_dir, num_workers)
+    # spawn, the parent may already hold CUDA or OpenMP state that does not survive a fork
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [
+            executor.submit(_convert_shard, token_classification_task, examples[start:end], labels, max_seq_length,
+                            tokenizer, data_dir, {name: np.asarray(array[start:end])
+                                                  for name, array in text_features.items()},
+                            feature_store_dir, os.path.join(cached_features_dir, name), frcnn_model_path)
+            for start, end, name in pending
+        ]
+        for done, future in enumerate(as_completed(futures)):
+            shard_dir, num_features = future.result()
+            logger.info("Saved %d features into %s (%d/%d)", num_features, shard_dir, done + 1, len(futures))
+    manifest_path = os.path.join(cached_features_dir, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump({"shards": shards, "shard_size": shard_size}, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return ShardedFeatures(cached_features_dir)
+
+
+class MMNerIterableDataset(IterableDataset):
+    """
+    Streaming variant of `MMNerDataset` for corpora that do not fit in memory.
+    The split is read lazily and converted `chunk_size` examples at a time, so only one chunk of features and
+    images is alive per worker. The examples are spread over the DataLoader workers (and distributed ranks) one
+    by one, and with `write_through` every converted chunk of a worker is saved under the cache dir; chunks
+    already there are read back instead of being converted again, so an interrupted pass resumes where it stopped.
+    Under DDP every worker of every rank yields the same number of items, see `__iter__`.
+    """
+
+    pad_token_label_id: int = nn.CrossEntropyLoss().ignore_index
+
+    def __init__(
+            self,
+            token_classification_task: MMNerTask,
+            data_dir: str,
+            tokenizer: PreTrainedTokenizer,
+            labels: List[str],
+            model_type: str,
+            max_seq_length: Optional[int] = None,
+            overwrite_cache=False,
+            mode: Split = Split.train,
+            feature_store=None,
+            dynamic_padding=True,
+            chunk_size=1024,
+            write_through=False,
+            shuffle=None,
+            seed=42,
+    ):
+        self.task = token_classification_task
+        self.data_dir = data_dir
+        self.tokenizer = tokenizer
+        self.labels = labels
+        self.max_seq_length = max_seq_length
+        self.overwrite_cache = overwrite_cache
+        self.mode = mode
+        self.feature_store = feature_store
+        self.chunk_size = chunk_size
+        self.write_through = write_through
+        # examples are shuffled inside a chunk only, memory stays bounded. Training data is shuffled by default
+        self.shuffle = mode == Split.train if shuffle is None else shuffle
+        self.seed = seed
+        self.epoch = 0
+        # read here, in the main process: spawned DataLoader workers do not see the process group
+        self.world_size, self.rank = 1, 0
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            self.world_size, self.rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+        _, features_fingerprint = cache_fingerprints(token_classification_task, data_dir, tokenizer, labels,
+                                                     model_type, max_seq_length, mode, feature_store)
+        self.cached_features_dir = os.path.join(
+            data_dir,
+            "cached_stream_{}_{}_{}_{}_{}".format(mode.value, model_type, str(max_seq_length), chunk_size,
+                                                  features_fingerprint),
+        )
+        self.collate_fn = DynamicPaddingCollator(pad_token_id=tokenizer.pad_token_id or 0,
+                                                 pad_token_label_id=self.pad_token_label_id,
+                                                 max_length=None if dynamic_padding else max_seq_length)
+        self._len = None
+
+    def __len__(self):
+        # only used for the number of steps, examples whose image fails are dropped later on
+        if self._len is None:
+            self._len = self.task.count_examples_in_file(self.data_dir, self.mode.value)
+        return self._len
+
+    def _shard(self):
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        return self.rank * num_workers + worker_id, self.world_size * num_workers
+
+    def _chunks(self, shard=0, num_shards=1):
+        """Every `num_shards`-th example of the split from `shard` on, `chunk_size` at a time."""
+        chunk = []
+        examples = self.task.iter_examples_from_file(self.data_dir, self.mode.value)
+        for example in itertools.islice(examples, shard, None, num_shards):
+            chunk.append(example)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _convert(self, examples):
+        image_table = ImageTable() if self.feature_store is None else None
+        features = self.task.convert_examples_to_features(
+            examples,
+            self.labels,
+            self.max_seq_length,
+            self.tokenizer,
+            self.data_dir,
+            feature_store=self.feature_store,
+            image_table=image_table,
+        )
+        return features, image_table
+
+    def _chunk_items(self, chunk_index, examples, shard=0, num_shards=1):
+        chunk_dir = os.path.join(self.cached_features_dir,
+                                 "chunk_{}_of_{}_{:06d}".format(shard, num_shards, chunk_index))
+        if self.write_through and FeatureStore.exists(chunk_dir) and not self.overwrite_cache:
+            cached = CachedFeatures(chunk_dir)
+            return [cached[i] for i in range(len(cached))]
+        features, image_table = self._convert(examples)
+        if self.write_through:
+            with atomic_store_dir(chunk_dir, replace=self.overwrite_cache) as tmp_dir:
+                save_features(features, tmp_dir, image_table)
+        items = []
+        for feature in features:
+            item = tuple(torch.tensor(getattr(feature, name)) for name in TEXT_COLUMNS)
+            if image_table is None:
+                items.append(item + (torch.tensor(feature.img_index),))
+            else:
+                items.append(item + tuple(torch.as_tensor(value)
+                                          for value in image_table.values[feature.img_index].values()))
+        return items
+
+    def __iter__(self):
+        shard, num_shards = self._shard()
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        # Under DDP a rank with fewer batches would leave the others waiting in an all-reduce forever: every shard
+        # yields ceil(examples / shards) items, the shorter shards and the examples dropped by the conversion
+        # (unreadable images) are made up with items of the first non-empty chunk of the shard, as
+        # DistributedSampler pads
+        num_items = -(-len(self) // num_shards) if self.world_size > 1 else None
+        num_yielded, first_items = 0, []
+        for chunk_index, examples in enumerate(self._chunks(shard, num_shards)):
+            items = self._chunk_items(chunk_index, examples, shard, num_shards)
+            if not first_items:
+                first_items = items
+            for i in (rng.permutation(len(items)) if self.shuffle else range(len(items))):
+                if num_items is not None and num_yielded == num_items:
+                    return
+                yield items[i]
+                num_yielded += 1
+        if num_items is not None and first_items:
+            for i in range(num_items - num_yielded):
+                yield first_items[i % len(first_items)]
+
+
+# order of the text columns, which is also the order of the tensors in a batch; the visual ones follow
+TEXT_COLUMNS = ["input_ids", "input_mask", "valid_mask", "segment_ids", "label_ids"]
+IMAGES_DIR = "images"
+MANIFEST_NAME = "manifest.json"
+
+
+def save_features(features, cached_features_dir, image_table=None) -> FeatureStore:
+    if image_table is not None and any(value is not None for value in image_table.values):
+        write_columns(os.path.join(cached_features_dir, IMAGES_DIR), image_table.keys, image_table.columns(),
+                      aliases=image_table.aliases)
+    columns = {name: [getattr(feature, name) for feature in features] for name in TEXT_COLUMNS + ["img_index"]}
+    columns["seq_length"] = [len(feature.input_ids) for feature in features]
+    # label_ids are shorter than input_ids (one label per word), the rest of the row is ignored by the loss
+    return write_columns(cached_features_dir, [str(i) for i in range(len(features))], columns,
+                         pad_values={"label_ids": MMNerDataset.pad_token_label_id})
+
+
+class DynamicPaddingCollator:
+    """
+    Pads the text columns of a batch to the longest example of the batch instead of `max_seq_length`.
+    The visual tensors are zero padded to their largest shape in the batch, as `write_columns` does.
+    """
+
+    def __init__(self, pad_token_id=0, pad_token_segment_id=0, pad_token_label_id=-100, pad_on_left=False,
+                 max_length=None):
+        # in the order of TEXT_COLUMNS
+        self.pad_values = [pad_token_id, 0, 0, pad_token_segment_id, pad_token_label_id]
+        self.pad_on_left = pad_on_left
+        # pad every batch to this length instead, i.e. the fixed padding of the original implementation
+        self.max_length = max_length
+
+    def __call__(self, items):
+        max_len = self.max_length or max(item[0].size(0) for item in items)
+        batch = []
+        for column, pad_value in enumerate(self.pad_values):
+            padded = torch.full((len(items), max_len), pad_value, dtype=items[0][column].dtype)
+            for row, item in enumerate(items):
+                value = item[column][:max_len]
+                if self.pad_on_left:
+                    padded[row, max_len - value.size(0):] = value
+                else:
+                    padded[row, :value.size(0)] = value
+            batch.append(padded)
+        for values in list(zip(*items))[len(self.pad_values):]:
+            shape = [max(dims) for dims in zip(*[value.shape for value in values])]
+            padded = values[0].new_zeros([len(values)] + shape)
+            for row, value in enumerate(values):
+                padded[row][tuple(slice(0, dim) for dim in value.shape)] = value
+            batch.append(padded)
+        return tuple(batch)
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches examples of similar length, so that dynamic padding adds little.
+    The shuffled indices are cut into pools of `batch_size * bucket_size_multiplier` examples, every pool is
+    sorted by length and split into batches, and the batches are shuffled again.
+    Every epoch draws from its own generator (seed + epoch), so the batches of an epoch can be listed up front.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=100, drop_last=False, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.pool_size = batch_size * bucket_size_multiplier
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, epoch=None):
+        rng = np.random.RandomState(self.seed + (self.epoch if epoch is None else epoch))
+        indices = rng.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(indices), self.pool_size):
+            pool = indices[start: start + self.pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            batches += [pool[i: i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size)]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def __iter__(self):
+        batches = self.batches()
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(min(self.pool_size, len(self.lengths) - start) // self.batch_size
+                       for start in range(0, len(self.lengths), self.pool_size))
+        return sum((min(self.pool_size, len(self.lengths) - start) + self.batch_size - 1) // self.batch_size
+                   for start in range(0, len(self.lengths), self.pool_size))
+
+
+@contextmanager
+def main_process_first(local_rank=-1):
+    """
+    Runs the block on the local main process first and on the other ranks only once it is done, e.g. to build the
+    caches once and let the other ranks memory-map them. No-op without distributed training.
+    """
+    if local_rank not in [-1, 0]:
+        torch.distributed.barrier()
+    try:
+        yield
+    finally:
+        if local_rank == 0:
+            torch.distributed.barrier()
+
+
+def build_batch_sampler(dataset, batch_size, train=False, local_rank=-1, bucketing=True, seed=42):
+    """Length-bucketed batches for single process training, plain (sequential when evaluating) batches otherwise."""
+    if train and bucketing and local_rank == -1:
+        return BucketBatchSampler(dataset.lengths, batch_size, seed=seed)
+    if local_rank != -1:
+        sampler = DistributedSampler(dataset, shuffle=train)
+    elif train:
+        sampler = RandomSampler(dataset)
+    else:
+        sampler = SequentialSampler(dataset)
+    return BatchSampler(sampler, batch_size, drop_last=False)
+
+
+def build_dataloader(dataset, batch_size, train=False, local_rank=-1, bucketing=True, seed=42):
+    if isinstance(dataset, IterableDataset):
+        # sharding and shuffling are done by the dataset itself
+        return DataLoader(dataset, batch_size=batch_size, collate_fn=dataset.collate_fn)
+    batch_sampler = build_batch_sampler(dataset, batch_size, train=train, local_rank=local_rank,
+                                        bucketing=bucketing, seed=seed)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_fn)
+
+
+def log_padding_ratio(dataloader, max_seq_length):
+    if isinstance(dataloader.dataset, IterableDataset):
+        return
+    logger.info("  Padding ratio = %.3f (%.3f with max_seq_length)",
+                padding_ratio(dataloader.dataset.lengths, dataloader.batch_sampler),
+                padding_ratio(dataloader.dataset.lengths, dataloader.batch_sampler, max_seq_length))
+
+
+def padding_ratio(lengths, batches, max_length=None):
+    """
+    Fraction of the token positions of `batches` that are padding, when every batch is padded to its longest
+    example, or to `max_length` if given.
+    """
+    lengths = np.asarray(lengths)
+    num_tokens, num_positions = 0, 0
+    for batch in (batches.batches() if isinstance(batches, BucketBatchSampler) else batches):
+        batch_lengths = lengths[batch]
+        num_tokens += int(batch_lengths.sum())
+        num_positions += len(batch) * (max_length or int(batch_lengths.max()))
+    return 1.0 - num_tokens / max(num_positions, 1)
 
 
 def valid_sequence_output(sequence_output, valid_mask, attention_mask):
+    """
+    Moves the outputs of the first sub-token of every word (valid_mask == 1) to the front of the sequence.
+    Every valid token is scattered to its rank among the valid tokens of its row, the others are sent to an
+    extra dump position that is cut off afterwards, so there is no per-token loop and no host sync.
+    """
+    batch_size, max_len, feat_dim = sequence_output.shape
+    valid = valid_mask == 1
+    positions = valid.long().cumsum(dim=1) - 1
+    positions = torch.where(valid, positions, torch.full_like(positions, max_len))
+
+    valid_output = torch.zeros(batch_size, max_len + 1, feat_dim, dtype=torch.float32, device=sequence_output.device)
+    valid_output = valid_output.scatter(1, positions.unsqueeze(-1).expand(-1, -1, feat_dim),
+                                        sequence_output.float())
+    valid_attention_mask = torch.zeros(batch_size, max_len + 1, dtype=torch.long, device=sequence_output.device)
+    valid_attention_mask = valid_attention_mask.scatter(1, positions, attention_mask.long())
+    return valid_output[:, :max_len], valid_attention_mask[:, :max_len]
+
+
+def valid_sequence_output_loop(sequence_output, valid_mask, attention_mask):
+    """Reference implementation of `valid_sequence_output`, kept for benchmarks/bench_valid_sequence_output.py."""
     batch_size, max_len, feat_dim = sequence_output.shape
     valid_output = torch.zeros(batch_size, max_len, feat_dim, dtype=torch.float32,
                                device='cuda' if torch.cuda.is_available() else 'cpu')
@@ -253,4 +879,3 @@ def valid_sequence_output(sequence_output, valid_mask, attention_mask):
                 valid_output[i][jj] = sequence_output[i][j]
                 valid_attention_mask[i][jj] = attention_mask[i][j]
     return valid_output, valid_attention_mask
-
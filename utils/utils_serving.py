@@ -0,0 +1,164 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future, TimeoutError
+from typing import Callable, List, Optional
+
+import numpy as np
+
+'''
+dynamic micro-batching and latency counters of the inference server
+'''
+
+
+class Overloaded(Exception):
+    """Raised by `MicroBatcher.submit` when its queue is full."""
+
+
+class LatencyStats:
+    """
+    Thread-safe request counters; percentiles are taken over the latencies of the last `window` requests.
+    Rejected (queue full) and expired (timed out before their batch) requests are only counted.
+    """
+
+    def __init__(self, window: int = 10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def add_request(self, latency: float, error: bool = False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.latencies.append(latency)
+
+    def add_rejected(self):
+        with self.lock:
+            self.rejected += 1
+
+    def add_expired(self):
+        with self.lock:
+            self.expired += 1
+
+    def add_batch(self, batch_size: int):
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes.append(batch_size)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64) * 1000
+            batch_sizes = np.array(self.batch_sizes, dtype=np.float64)
+            elapsed = time.perf_counter() - self.start
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "batches": self.batches,
+                "rejected": self.rejected,
+                "expired": self.expired,
+                "uptime_s": elapsed,
+                "throughput_rps": self.requests / elapsed if elapsed > 0 else 0.0,
+                "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                "mean_batch_size": float(batch_sizes.mean()) if len(batch_sizes) else None,
+            }
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into micro-batches for `predict_batch` (a list of requests -> a list of results).
+    A batch is run as soon as it has `max_batch_size` requests, or `max_wait_ms` after its first request arrived,
+    whichever comes first. A single worker thread runs the batches, so `predict_batch` is never called concurrently.
+    At most `max_queue_size` requests wait for a batch (0: no bound), the next ones are rejected with `Overloaded`.
+    A request whose timeout passed before its batch was formed is dropped, it never reaches `predict_batch`.
+    """
+
+    def __init__(self, predict_batch: Callable[[list], list], max_batch_size: int = 16, max_wait_ms: float = 10.0,
+                 stats: Optional[LatencyStats] = None, max_queue_size: int = 0):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = stats or LatencyStats()
+        self.requests = queue.Queue(maxsize=max_queue_size)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, request, timeout: Optional[float] = None) -> Future:
+        """Queues the request; it is dropped (its future cancelled) if still queued `timeout` seconds from now."""
+        future = Future()
+        arrival = time.perf_counter()
+        try:
+            self.requests.put_nowait((request, future, arrival, arrival + timeout if timeout is not None else None))
+        except queue.Full:
+            self.stats.add_rejected()
+            raise Overloaded("{} requests are already waiting".format(self.requests.maxsize))
+        return future
+
+    def __call__(self, request, timeout: Optional[float] = None):
+        """Blocks until the request went through its batch and returns its result, raises TimeoutError after
+        `timeout` seconds."""
+        future = self.submit(request, timeout)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            # still queued: dropped from its batch; already running: its result is thrown away
+            future.cancel()
+            raise
+        except CancelledError:
+            # expired while queued, just before the timeout of result() itself
+            raise TimeoutError()
+
+    def _start(self, item) -> bool:
+        """Marks the future of a queued request as running, or drops the request if it expired or was cancelled."""
+        _, future, _, deadline = item
+        if deadline is not None and time.perf_counter() > deadline:
+            future.cancel()
+        if not future.set_running_or_notify_cancel():
+            self.stats.add_expired()
+            return False
+        return True
+
+    def _next_batch(self) -> List[tuple]:
+        batch = []
+        while not batch:
+            item = self.requests.get()
+            if self._start(item):
+                batch.append(item)
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if self._start(item):
+                batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            self.stats.add_batch(len(batch))
+            try:
+                results = self.predict_batch([request for request, _, _, _ in batch])
+                error = None
+                if len(results) != len(batch):
+                    # zip would leave the requests without a result waiting forever, or pair them wrongly
+                    raise RuntimeError("predict_batch returned {} results for a batch of {} requests".format(
+                        len(results), len(batch)))
+            except Exception as e:
+                results, error = [None] * len(batch), e
+            now = time.perf_counter()
+            for (_, future, arrival, _), result in zip(batch, results):
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+                self.stats.add_request(now - arrival, error=error is not None)
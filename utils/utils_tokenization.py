@@ -0,0 +1,137 @@
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+'''
+text side of the feature conversion, shared by the feature extractors: every visual feature type encodes the
+text the same way and only plugs its own image stage into `convert_with_image_stage`
+'''
+# order of the encoded text arrays
+TEXT_FIELDS = ["input_ids", "input_mask", "valid_mask", "segment_ids", "label_ids"]
+
+
+def tokenize_words(tokenizer, sentences: Iterable[List[str]],
+                   batch_size: int = 1024) -> Iterator[Tuple[List[int], List[int]]]:
+    """
+    Yields the sub-token ids and the valid_mask (1 on the first sub-token of every word) of every sentence,
+    without special tokens and without truncation.
+
+    Fast tokenizers encode `batch_size` sentences per call with `is_split_into_words` and valid_mask is derived
+    from the word ids; other tokenizers tokenize word by word. Both give the same output.
+    """
+    if not getattr(tokenizer, "is_fast", False):
+        for words in sentences:
+            yield tokenize_words_slow(tokenizer, words)
+        return
+    batch = []
+    for words in sentences:
+        batch.append(list(words))
+        if len(batch) == batch_size:
+            yield from tokenize_batch_fast(tokenizer, batch)
+            batch = []
+    if batch:
+        yield from tokenize_batch_fast(tokenizer, batch)
+
+
+def tokenize_words_slow(tokenizer, words: List[str]) -> Tuple[List[int], List[int]]:
+    tokens = []
+    valid_mask = []
+    for word in words:
+        word_tokens = tokenizer.tokenize(word)
+        # bert-base-multilingual-cased sometimes output "nothing ([]) when calling tokenize with just a space.
+        for i, word_token in enumerate(word_tokens):
+            if i == 0:
+                valid_mask.append(1)
+            else:
+                valid_mask.append(0)
+            tokens.append(word_token)
+    return tokenizer.convert_tokens_to_ids(tokens), valid_mask
+
+
+def tokenize_batch_fast(tokenizer, batch: List[List[str]]) -> Iterator[Tuple[List[int], List[int]]]:
+    encodings = tokenizer(batch, is_split_into_words=True, add_special_tokens=False,
+                          return_attention_mask=False, return_token_type_ids=False)
+    for i, input_ids in enumerate(encodings["input_ids"]):
+        word_ids = encodings.word_ids(i)
+        # words without any sub-token (e.g. a lone space) have no word id at all, as with tokenize()
+        valid_mask = [1 if word_id != previous else 0 for previous, word_id in zip([None] + word_ids[:-1], word_ids)]
+        yield input_ids, valid_mask
+
+
+def encode_text(examples,
+                label_list,
+                max_seq_length,
+                tokenizer,
+                cls_token_at_end=False,
+                cls_token="[CLS]",
+                cls_token_segment_id=1,
+                sep_token="[SEP]",
+                sep_token_extra=False,
+                pad_token=0,
+                pad_token_segment_id=0,
+                pad_token_label_id=-100,
+                sequence_a_segment_id=0,
+                mask_padding_with_zero=True) -> Dict[str, np.ndarray]:
+    """
+    Encodes the text of all examples into preallocated (num_examples, max_seq_length) int64 arrays, one per
+    name of `TEXT_FIELDS`, plus the `seq_length` of every row. Rows are filled from the left, the positions past
+    `seq_length` hold the pad values.
+            `cls_token_at_end` define the location of the CLS token:
+                - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
+                - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
+            `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+    """
+    examples = list(examples)
+    label_map = {label: i for i, label in enumerate(label_list)}
+    shape = (len(examples), max_seq_length)
+    text = {
+        "input_ids": np.full(shape, pad_token, dtype=np.int64),
+        "input_mask": np.full(shape, 0 if mask_padding_with_zero else 1, dtype=np.int64),
+        "valid_mask": np.zeros(shape, dtype=np.int64),
+        "segment_ids": np.full(shape, pad_token_segment_id, dtype=np.int64),
+        "label_ids": np.full(shape, pad_token_label_id, dtype=np.int64),
+        "seq_length": np.zeros(len(examples), dtype=np.int64),
+    }
+    cls_token_id, sep_token_id = tokenizer.convert_tokens_to_ids([cls_token, sep_token])
+    # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
+    num_sep = 2 if sep_token_extra else 1
+    max_tokens = max_seq_length - num_sep - 1
+    encoded = tokenize_words(tokenizer, (example.words for example in examples))
+    for (ex_index, (example, (input_ids, valid_mask))) in enumerate(zip(examples, encoded)):
+        num_tokens = min(len(input_ids), max_tokens)
+        label_ids = [label_map[label] for label in example.labels[:max_tokens]]
+        # [CLS] first, or last after the [SEP]s; labels are per word and only line up with the valid positions
+        start = 0 if cls_token_at_end else 1
+        end = start + num_tokens
+        length = num_tokens + num_sep + 1
+        cls_index = length - 1 if cls_token_at_end else 0
+
+        text["input_ids"][ex_index, start:end] = input_ids[:num_tokens]
+        text["input_ids"][ex_index, end:end + num_sep] = sep_token_id
+        text["input_ids"][ex_index, cls_index] = cls_token_id
+        text["input_mask"][ex_index, :length] = 1 if mask_padding_with_zero else 0
+        text["valid_mask"][ex_index, start:end] = valid_mask[:num_tokens]
+        text["valid_mask"][ex_index, end:end + num_sep] = 1
+        text["valid_mask"][ex_index, cls_index] = 1
+        text["segment_ids"][ex_index, :length] = sequence_a_segment_id
+        text["segment_ids"][ex_index, cls_index] = cls_token_segment_id
+        text["label_ids"][ex_index, start:start + len(label_ids)] = label_ids
+        text["seq_length"][ex_index] = length
+    return text
+
+
+def convert_with_image_stage(examples, text: Dict[str, np.ndarray],
+                             image_stage: Callable[[int, object], Optional[dict]], feature_class) -> list:
+    """
+    Pairs the encoded text of every example with the output of the image stage of a visual feature type.
+    `image_stage(ex_index, example)` returns the visual keyword arguments of `feature_class`, or None to drop
+    the example (e.g. its image could not be read). The text fields are views of the rows, cut to `seq_length`.
+    """
+    features = []
+    for (ex_index, example) in enumerate(examples):
+        visual = image_stage(ex_index, example)
+        if visual is None:
+            continue
+        length = int(text["seq_length"][ex_index])
+        features.append(feature_class(**{name: text[name][ex_index, :length] for name in TEXT_FIELDS}, **visual))
+    return features